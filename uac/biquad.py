@@ -0,0 +1,429 @@
+import math
+import sys
+
+import numpy as np
+
+from amaranth             import *
+from amaranth.lib         import stream, wiring
+from amaranth.lib.wiring  import In, Out
+from amaranth.lib.memory  import Memory
+
+from amaranth.sim         import *
+
+
+# - coefficients --------------------------------------------------------------
+
+def biquad_coefficients(kind, frequency, sample_rate, q=1 / math.sqrt(2), gain=0.0):
+    """ Design a biquad section, from the Audio EQ Cookbook by Robert Bristow-Johnson.
+
+    ``kind`` is one of "lowpass", "highpass", "bandpass", "notch", "allpass", "peak",
+    "lowshelf" or "highshelf", at ``frequency`` Hz with a quality factor of ``q``, and,
+    for peak and shelving filters, a ``gain`` in dB. Returns ``(b0, b1, b2, a1, a2)``,
+    normalized so that ``a0`` is 1.
+    """
+    if not 0 < frequency < sample_rate / 2:
+        raise ValueError(f"frequency must be between 0 and {sample_rate / 2} Hz, not {frequency}")
+
+    w0    = 2 * math.pi * frequency / sample_rate
+    cos   = math.cos(w0)
+    alpha = math.sin(w0) / (2 * q)
+    A     = 10 ** (gain / 40)
+    shelf = 2 * math.sqrt(A) * alpha
+
+    if kind == "lowpass":
+        b, a = [(1 - cos) / 2, 1 - cos, (1 - cos) / 2],      [1 + alpha, -2 * cos, 1 - alpha]
+    elif kind == "highpass":
+        b, a = [(1 + cos) / 2, -(1 + cos), (1 + cos) / 2],   [1 + alpha, -2 * cos, 1 - alpha]
+    elif kind == "bandpass":
+        b, a = [alpha, 0, -alpha],                           [1 + alpha, -2 * cos, 1 - alpha]
+    elif kind == "notch":
+        b, a = [1, -2 * cos, 1],                             [1 + alpha, -2 * cos, 1 - alpha]
+    elif kind == "allpass":
+        b, a = [1 - alpha, -2 * cos, 1 + alpha],             [1 + alpha, -2 * cos, 1 - alpha]
+    elif kind == "peak":
+        b, a = [1 + alpha * A, -2 * cos, 1 - alpha * A],     [1 + alpha / A, -2 * cos, 1 - alpha / A]
+    elif kind == "lowshelf":
+        b = [A * ((A + 1) - (A - 1) * cos + shelf), 2 * A * ((A - 1) - (A + 1) * cos), A * ((A + 1) - (A - 1) * cos - shelf)]
+        a = [(A + 1) + (A - 1) * cos + shelf, -2 * ((A - 1) + (A + 1) * cos), (A + 1) + (A - 1) * cos - shelf]
+    elif kind == "highshelf":
+        b = [A * ((A + 1) + (A - 1) * cos + shelf), -2 * A * ((A - 1) + (A + 1) * cos), A * ((A + 1) + (A - 1) * cos - shelf)]
+        a = [(A + 1) - (A - 1) * cos + shelf, 2 * ((A - 1) - (A + 1) * cos), (A + 1) - (A - 1) * cos - shelf]
+    else:
+        raise ValueError(f"kind must be one of lowpass, highpass, bandpass, notch, allpass, peak, lowshelf "
+                         f"or highshelf, not '{kind}'")
+
+    return tuple(c / a[0] for c in [*b, *a[1:]])
+
+
+def biquad_response(sections, frequency, sample_rate):
+    """ The magnitude response, in dB, of a cascade of ``(b0, b1, b2, a1, a2)`` sections at ``frequency`` Hz. """
+    z = np.exp(-2j * np.pi * frequency / sample_rate)
+    h = 1
+    for b0, b1, b2, a1, a2 in sections:
+        h *= (b0 + b1 * z + b2 * z * z) / (1 + a1 * z + a2 * z * z)
+    return 20 * np.log10(np.abs(h))
+
+
+# - gateware ------------------------------------------------------------------
+
+class BiquadCascade(wiring.Component):
+    """ Time-multiplexed Biquad IIR Filter Cascade
+
+    Filters each of ``channels`` channels through a cascade of ``sections`` biquad
+    sections, in direct form I:
+
+        y[n] = b0 x[n] + b1 x[n-1] + b2 x[n-2] - a1 y[n-1] - a2 y[n-2]
+
+    Coefficients are ``coef_bits`` bit fixed point, with ``coef_bits - 3`` fractional
+    bits, for a range of -4 to 4, and are held in a memory of five for each section of
+    each channel at each of ``rates`` sample rates, ``b0, b1, b2, a1, a2`` at
+    ``((rate * channels + channel) * sections + section) * 5``, ``rate`` selecting
+    between them as each sample is taken. They start at ``coefficients``, a list of each
+    section's, see :func:`biquad_coefficients`, for every channel, or a list of those for
+    each rate, or pass samples through unchanged, and may be read and written at
+    ``coefficient_addr`` while filtering.
+
+    Each section's output is rounded and saturated to ``bit_depth`` bits, and is the
+    next section's input, so the cascade keeps two samples of history, in memory, for
+    each of its ``sections + 1`` signals. Every tap of every section goes through a
+    single multiplier, a cycle each, so a sample takes ``5 * sections + 2`` cycles per
+    channel, see :meth:`cycles`. Samples are taken from the lowest channel with one,
+    once its output is free.
+    """
+
+    def __init__(self, bit_depth, channels, sections, coefficients=None, coef_bits=24, rates=1):
+        self.bit_depth = bit_depth
+        self.channels  = channels
+        self.sections  = sections
+        self.coef_bits = coef_bits
+        self.frac_bits = coef_bits - 3
+        self.rates     = rates
+
+        if coefficients is None:
+            coefficients = [(1.0, 0.0, 0.0, 0.0, 0.0)] * sections
+        if coefficients and not isinstance(coefficients[0][0], (list, tuple)):
+            coefficients = [coefficients] * rates
+        if len(coefficients) != rates:
+            raise ValueError(f"coefficients must be given for {rates} rates, not {len(coefficients)}")
+        for rate_coefficients in coefficients:
+            if len(rate_coefficients) != sections or any(len(section) != 5 for section in rate_coefficients):
+                raise ValueError(f"coefficients must be a list of (b0, b1, b2, a1, a2) for {sections} sections, "
+                                 f"not {rate_coefficients}")
+            if any(not -4 <= c < 4 for section in rate_coefficients for c in section):
+                raise ValueError(f"coefficients must be from -4 to 4, not {rate_coefficients}")
+        self.coefficients = [round(c * (1 << self.frac_bits))
+                             for rate_coefficients in coefficients
+                             for _ in range(channels)
+                             for section in rate_coefficients for c in section]
+
+        super().__init__({
+            "inputs"             : In  (stream.Signature(signed(bit_depth))).array(channels),
+            "outputs"            : Out (stream.Signature(signed(bit_depth))).array(channels),
+            "rate"               : In  (range(rates)),
+
+            # section coefficients
+            "coefficient_addr"   : In  (range(len(self.coefficients))),
+            "coefficient_r_data" : Out (signed(coef_bits)),
+            "coefficient_w_data" : In  (signed(coef_bits)),
+            "coefficient_w_en"   : In  (1),
+        })
+
+    def cycles(self):
+        """ The cycles taken to filter a sample on every channel. """
+        return self.channels * (5 * self.sections + 2)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        sections = self.sections
+
+        m.submodules.coefficients = coefficients = Memory(shape=signed(self.coef_bits),
+                                                          depth=len(self.coefficients), init=self.coefficients)
+        c_port = coefficients.read_port()
+        h_port = coefficients.read_port()
+        w_port = coefficients.write_port()
+
+        m.d.comb += [
+            w_port.addr              .eq(self.coefficient_addr),
+            w_port.data              .eq(self.coefficient_w_data),
+            w_port.en                .eq(self.coefficient_w_en),
+            h_port.addr              .eq(self.coefficient_addr),
+            self.coefficient_r_data  .eq(h_port.data),
+        ]
+
+        # x[n-1] and x[n-2] of each section's input, and of the last section's output, reading
+        # the values from before any write in the same cycle
+        m.submodules.history = history = Memory(shape=signed(self.bit_depth),
+                                                depth=self.channels * (sections + 1) * 2, init=[])
+        r_port  = history.read_port()
+        hw_port = history.write_port()
+
+        for output in self.outputs:
+            with m.If(output.ready):
+                m.d.sync += output.valid.eq(0)
+
+
+        # - fetch --
+
+        # the tap whose coefficient and history are being fetched, the address of its
+        # coefficient, and of its section's input's history
+        channel   = Signal(range(self.channels))
+        section   = Signal(range(sections))
+        tap       = Signal(range(5))
+        fetching  = Signal()
+        c_addr    = Signal.like(self.coefficient_addr)
+        h_addr    = Signal(range(history.depth + 2))
+
+        # taps 1 and 2 are x[n-1] and x[n-2], and taps 3 and 4 are y[n-1] and y[n-2],
+        # which are the next section's x[n-1] and x[n-2]
+        m.d.comb += [
+            c_port.addr .eq(c_addr),
+            r_port.addr .eq(h_addr + tap - 1),
+        ]
+
+        with m.If(fetching):
+            m.d.sync += [
+                c_addr .eq(c_addr + 1),
+                tap    .eq(tap + 1),
+            ]
+            with m.If(tap == 4):
+                m.d.sync += [
+                    tap     .eq(0),
+                    section .eq(section + 1),
+                    h_addr  .eq(h_addr + 2),
+                ]
+                with m.If(section == sections - 1):
+                    m.d.sync += fetching.eq(0)
+
+
+        # - multiply and accumulate --
+
+        # the tap being summed, a cycle behind its fetch
+        mac_tap     = Signal.like(tap)
+        mac_h_addr  = Signal.like(h_addr)
+        mac_last    = Signal()
+        summing     = Signal()
+        m.d.sync += [
+            mac_tap    .eq(tap),
+            mac_h_addr .eq(h_addr),
+            mac_last   .eq(section == sections - 1),
+            summing    .eq(fetching),
+        ]
+
+        x           = Signal(signed(self.bit_depth))
+        rounding    = 1 << (self.frac_bits - 1)
+        accumulator = Signal(signed(self.bit_depth + self.coef_bits + 3), init=rounding)
+        product     = Signal.like(accumulator)
+        total       = Signal.like(accumulator)
+        y           = Signal(signed(self.bit_depth))
+
+        full_scale  = (1 << (self.bit_depth - 1)) - 1
+        m.d.comb += [
+            product .eq(Mux(mac_tap == 0, x, r_port.data) * c_port.data),
+            total   .eq(Mux(mac_tap >= 3, accumulator - product, accumulator + product) >> self.frac_bits),
+            y       .eq(Mux(total > full_scale, full_scale, Mux(total < -full_scale - 1, -full_scale - 1, total))),
+        ]
+
+        with m.If(summing):
+            m.d.sync += accumulator.eq(Mux(mac_tap >= 3, accumulator - product, accumulator + product))
+
+            # shift each history along after reading it, the input's then, with the last
+            # section, the output's
+            with m.Switch(mac_tap):
+                with m.Case(1):
+                    m.d.comb += [
+                        hw_port.addr .eq(mac_h_addr + 1),
+                        hw_port.data .eq(r_port.data),
+                        hw_port.en   .eq(1),
+                    ]
+                with m.Case(2):
+                    m.d.comb += [
+                        hw_port.addr .eq(mac_h_addr),
+                        hw_port.data .eq(x),
+                        hw_port.en   .eq(1),
+                    ]
+                with m.Case(3):
+                    m.d.comb += [
+                        hw_port.addr .eq(mac_h_addr + 3),
+                        hw_port.data .eq(r_port.data),
+                        hw_port.en   .eq(mac_last),
+                    ]
+                with m.Case(4):
+                    m.d.comb += [
+                        hw_port.addr .eq(mac_h_addr + 2),
+                        hw_port.data .eq(y),
+                        hw_port.en   .eq(mac_last),
+                    ]
+
+            # each section's output is the next's input
+            with m.If(mac_tap == 4):
+                m.d.sync += [
+                    x           .eq(y),
+                    accumulator .eq(rounding),
+                ]
+                with m.If(mac_last):
+                    for n, output in enumerate(self.outputs):
+                        with m.If(channel == n):
+                            m.d.sync += [
+                                output.valid   .eq(1),
+                                output.payload .eq(y),
+                            ]
+
+
+        # - samples --
+
+        busy = fetching | summing
+        with m.If(~busy):
+            # take a sample from the lowest channel with one, once its output is free
+            for n in reversed(range(self.channels)):
+                input  = self.inputs[n]
+                output = self.outputs[n]
+                with m.If(input.valid & (~output.valid | output.ready)):
+                    m.d.comb += [self.inputs[k].ready.eq(k == n) for k in range(self.channels)]
+                    m.d.sync += [
+                        channel  .eq(n),
+                        section  .eq(0),
+                        tap      .eq(0),
+                        fetching .eq(1),
+                        c_addr   .eq((self.rate * self.channels + n) * sections * 5),
+                        h_addr   .eq(n * (sections + 1) * 2),
+                        x        .eq(input.payload),
+                    ]
+
+        return m
+
+
+# - model ---------------------------------------------------------------------
+
+def biquad_model(biquad, frames, writes=None, rate=0):
+    """ Bit-exact model of a :class:`BiquadCascade` at a single rate.
+
+    Takes each frame's samples, and optionally a dictionary of coefficients to write before
+    each, and returns each frame's filtered samples. Channels are filtered together, as arrays.
+    """
+    sections   = biquad.sections
+    frac_bits  = biquad.frac_bits
+    full_scale = (1 << (biquad.bit_depth - 1)) - 1
+
+    coefficients = np.array(biquad.coefficients, dtype=np.int64).reshape(biquad.rates, biquad.channels, sections, 5)
+    b0, b1, b2, a1, a2 = (coefficients[rate, :, :, n] for n in range(5))
+    history      = np.zeros((biquad.channels, sections + 1, 2), dtype=np.int64)
+
+    outputs = []
+    for n, frame in enumerate(np.asarray(frames, dtype=np.int64)):
+        for address, value in (writes[n] if writes else {}).items():
+            coefficients.flat[address] = value
+
+        x = frame
+        for k in range(sections):
+            total = (1 << (frac_bits - 1)) \
+                  + b0[:, k] * x + b1[:, k] * history[:, k, 0]     + b2[:, k] * history[:, k, 1] \
+                                 - a1[:, k] * history[:, k + 1, 0] - a2[:, k] * history[:, k + 1, 1]
+            y = np.clip(total >> frac_bits, -full_scale - 1, full_scale)
+            history[:, k] = np.stack([x, history[:, k, 0]], axis=1)
+            x = y
+        history[:, sections] = np.stack([x, history[:, sections, 0]], axis=1)
+
+        outputs.append(x.tolist())
+
+    return outputs
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(dut, frames, writes=None, rate=0):
+    """ Collect each frame's filtered samples from a :class:`BiquadCascade` simulation at ``rate``,
+    writing each frame's ``writes``, a dictionary of coefficients, before it. Returns the samples,
+    and the cycles from taking the first frame's first sample to its last one's output. """
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+
+    outputs = []
+    latency = []
+
+    async def testbench(ctx):
+        ctx.set(dut.rate, rate)
+        for output in dut.outputs:
+            ctx.set(output.ready, 1)
+
+        for n, frame in enumerate(frames):
+            for address, value in (writes[n] if writes else {}).items():
+                ctx.set(dut.coefficient_addr,   address)
+                ctx.set(dut.coefficient_w_data, value)
+                ctx.set(dut.coefficient_w_en,   1)
+                await ctx.tick()
+            ctx.set(dut.coefficient_w_en, 0)
+
+            # present every channel's sample at once, and take them all back
+            for input, sample in zip(dut.inputs, frame):
+                ctx.set(input.valid,   1)
+                ctx.set(input.payload, sample)
+
+            filtered = {}
+            cycles   = 0
+            while len(filtered) < dut.channels:
+                for c, output in enumerate(dut.outputs):
+                    if ctx.get(output.valid):
+                        filtered[c] = ctx.get(output.payload)
+                taken = [ctx.get(input.ready) for input in dut.inputs]
+                await ctx.tick()
+                cycles += 1
+                for input, ready in zip(dut.inputs, taken):
+                    if ready:
+                        ctx.set(input.valid, 0)
+            outputs.append([filtered[c] for c in range(dut.channels)])
+            latency.append(cycles)
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return outputs, latency[0]
+
+
+if __name__ == "__main__":
+    bit_depth    = 24
+    channels     = 2
+    sample_rates = [44100, 48000]
+    full_scale   = (1 << (bit_depth - 1)) - 1
+
+    # a speaker correction curve: a high-pass below the speaker's range, a dip at its
+    # resonance, a lift to its treble and an anti-alias lowpass, designed for each rate
+    design = [
+        ("highpass",  40,    {}),
+        ("peak",      120,   {"q": 2.0, "gain": -6.0}),
+        ("highshelf", 6000,  {"gain": 3.0}),
+        ("lowpass",   18000, {}),
+    ]
+    sections = [[biquad_coefficients(kind, frequency, sample_rate, **kwargs) for kind, frequency, kwargs in design]
+                for sample_rate in sample_rates]
+
+    # check the gateware against the model at the last rate, with noise, loud enough to saturate,
+    # swapping the last section of the first channel for a notch part way through
+    rate        = len(sample_rates) - 1
+    sample_rate = sample_rates[rate]
+    rng    = np.random.default_rng(0)
+    dut    = BiquadCascade(bit_depth, channels, len(design), coefficients=sections, rates=len(sample_rates))
+    frames = rng.integers(-full_scale // 2, full_scale // 2, (300, channels)).tolist()
+    notch  = biquad_coefficients("notch", 1000, sample_rate, q=4)
+    base   = rate * channels * len(design) * 5
+    writes = [{}] * len(frames)
+    writes[150] = {base + 3 * 5 + n: round(c * (1 << dut.frac_bits)) for n, c in enumerate(notch)}
+
+    filtered, latency = simulate(dut, frames, writes, rate)
+    if filtered != biquad_model(dut, frames, writes, rate):
+        print("gateware doesn't match model")
+        sys.exit(1)
+    print(f"gateware matches model over {len(frames)} frames of {channels} channels, {len(design)} sections each")
+    print(f"{dut.cycles()} cycles a frame, {latency} from the first sample taken to the last filtered, "
+          f"of {60e6 / sample_rate:.0f} per frame at {sample_rate / 1e3} kHz with a 60 MHz clock")
+
+    # the response to a tone, for each frequency, against the designed response, at each rate
+    for rate, sample_rate in enumerate(sample_rates):
+        length = sample_rate // 4
+        for frequency in [30, 120, 1000, 6000, 12000, 20000]:
+            tone     = np.round(full_scale / 4 * np.sin(2 * np.pi * frequency * np.arange(length) / sample_rate))
+            output   = np.array(biquad_model(dut, np.stack([tone] * channels, axis=1), rate=rate))[length // 2:, 0]
+            measured = 20 * np.log10(np.sqrt(np.mean(output.astype(np.float64) ** 2)) / (full_scale / 4 / math.sqrt(2)))
+            designed = biquad_response(sections[rate], frequency, sample_rate)
+            print(f"{sample_rate / 1e3:5} kHz, {frequency:6} Hz: {measured:6.2f} dB, designed {designed:6.2f} dB")
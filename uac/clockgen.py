@@ -14,10 +14,13 @@
 # Original source: https://github.com/GlasgowEmbedded/glasgow/blob/main/software/glasgow/gateware/clockgen.py
 
 
+from fractions import Fraction
+from math import lcm
+
 from amaranth import *
 
 
-__all__ = ["ClockGen"]
+__all__ = ["ClockGen", "FractionalClockGen"]
 
 
 class ClockGen(Elaboratable):
@@ -173,3 +176,133 @@ class ClockGen(Elaboratable):
                          deviation_ppm, duty)
 
         return cyc
+
+
+class FractionalClockGen(Elaboratable):
+    """
+    A fractional clock generator. Where :class:`ClockGen` divides its input clock by an integer,
+    this adds :attr:`steps` ``[sel]`` to a phase accumulator every input clock period, modulo
+    :attr:`modulus`, and starts a new output clock period whenever the accumulator wraps
+    around. The output frequency is then exactly ``input_hz * step / modulus`` on average, with
+    output periods of either of the two whole numbers of input periods closest to the ideal,
+    i.e. with at most one input clock period of jitter.
+
+    The step is selected at run time by :attr:`sel`, which allows e.g. a sample clock to follow
+    the sample rate chosen by a USB host without rebuilding the gateware. A change of
+    :attr:`sel` takes effect immediately.
+
+    :type steps: list of int
+    :param steps:
+        Accumulator steps, one per output frequency. Use :meth:`derive` to compute these
+        values. Every step must be at most half of the modulus.
+    :type modulus: int
+    :param modulus:
+        Accumulator modulus.
+    """
+
+    def __init__(self, steps, modulus):
+        if max(steps) * 2 > modulus:
+            raise ValueError("steps {} include steps larger than half of modulus {}"
+                             .format(steps, modulus))
+
+        self.steps   = list(steps)
+        self.modulus = modulus
+
+        self.sel   = Signal(range(len(self.steps)))
+        self.clk   = Signal()
+        self.stb_r = Signal()
+        self.stb_f = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        steps = Array(Const(step, range(max(self.steps) + 1)) for step in self.steps)
+        phase = Signal(range(self.modulus))
+        total = Signal(range(self.modulus + max(self.steps)))
+        half  = self.modulus // 2
+
+        m.d.comb += total.eq(phase + steps[self.sel])
+        with m.If(total >= self.modulus):
+            m.d.sync += phase.eq(total - self.modulus)
+        with m.Else():
+            m.d.sync += phase.eq(total)
+
+        # the output clock is high for the first half of each turn of the accumulator
+        m.d.comb += [
+            self.stb_r.eq(total >= self.modulus),
+            self.stb_f.eq((phase < half) & (total >= half) & (total < self.modulus)),
+        ]
+        with m.If(self.stb_r):
+            m.d.sync += self.clk.eq(1)
+        with m.If(self.stb_f):
+            m.d.sync += self.clk.eq(0)
+
+        return m
+
+    @staticmethod
+    def calculate(input_hz, output_hzs, max_modulus=1 << 32):
+        """
+        Calculate the accumulator steps and common modulus for dividing an ``input_hz`` clock to
+        each of ``output_hzs``, and return them as well as the actual output frequencies, their
+        deviations from the requested output frequencies, and the jitter of each output clock.
+
+        The division is exact unless it would need a modulus larger than ``max_modulus``.
+
+        Raises ``ValueError`` if any output frequency is not positive or is higher than half of
+        the input frequency.
+        """
+        ratios = []
+        for output_hz in output_hzs:
+            if output_hz <= 0:
+                raise ValueError("output frequency {:.3f} kHz is not positive"
+                                 .format(output_hz / 1000))
+            if output_hz * 2 > input_hz:
+                raise ValueError("output frequency {:.3f} kHz is higher than half of input "
+                                 "frequency {:.3f} kHz"
+                                 .format(output_hz / 1000, input_hz / 1000))
+            ratios.append(Fraction(output_hz) / Fraction(input_hz))
+
+        modulus = lcm(*(ratio.denominator for ratio in ratios))
+        if modulus > max_modulus:
+            modulus = max_modulus
+        steps = [max(1, round(ratio * modulus)) for ratio in ratios]
+
+        actual_output_hzs = [input_hz * step / modulus for step in steps]
+        deviations_ppm    = [round(1000000 * (actual_output_hz - output_hz) // output_hz)
+                             for actual_output_hz, output_hz in zip(actual_output_hzs, output_hzs)]
+        jitters_s         = [0 if modulus % step == 0 else 1 / input_hz for step in steps]
+
+        return steps, modulus, actual_output_hzs, deviations_ppm, jitters_s
+
+    @classmethod
+    def derive(cls, input_hz, output_hzs, max_deviation_ppm=None, max_modulus=1 << 32,
+               logger=None, clock_name=None):
+        """
+        Derive the parameters for :class:`FractionalClockGen`, and log the input frequency,
+        requested output frequencies, actual output frequencies, frequency deviations, and the
+        bound on the jitter of each output clock.
+
+        See :meth:`calculate` for details. Raises ``ValueError`` if an output frequency deviates
+        from the requested frequency by more than ``max_deviation_ppm`` parts per million.
+        """
+        steps, modulus, actual_output_hzs, deviations_ppm, jitters_s = \
+            cls.calculate(input_hz, output_hzs, max_modulus)
+
+        if clock_name is None:
+            clock = "clock"
+        else:
+            clock = f"clock {clock_name}"
+
+        for output_hz, actual_output_hz, deviation_ppm, jitter_s in \
+                zip(output_hzs, actual_output_hzs, deviations_ppm, jitters_s):
+            if max_deviation_ppm is not None and abs(deviation_ppm) > max_deviation_ppm:
+                raise ValueError("output frequency {:.3f} kHz deviates from requested frequency "
+                                 "{:.3f} kHz by {:d} ppm, which is higher than {:d} ppm"
+                                 .format(actual_output_hz / 1000, output_hz / 1000,
+                                         deviation_ppm, max_deviation_ppm))
+            if logger is not None:
+                logger.debug("%s in=%.3f req=%.3f out=%.3f [kHz] error=%d [ppm] jitter=%.1f [ns]",
+                             clock, input_hz / 1000, output_hz / 1000, actual_output_hz / 1000,
+                             deviation_ppm, jitter_s * 1e9)
+
+        return steps, modulus
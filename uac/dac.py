@@ -22,17 +22,27 @@ from amaranth             import *
 from amaranth.lib         import fifo, stream, wiring
 from amaranth.lib.wiring  import In, Out
 
-from .clockgen            import ClockGen
+from .clockgen            import ClockGen, FractionalClockGen
+from .deltasigma          import DeltaSigmaModulator
+from .interpolator        import Interpolator
 
 class Channel(wiring.Component):
-    def __init__(self, bit_depth=16, signed=False):
+    """ First-order Delta-Sigma Modulator
+
+    With ``channels`` greater than one, the channels take turns on a single accumulator
+    adder, one channel per ``stb``, so each is modulated at that fraction of the rate of
+    ``stb``. Their accumulators are kept in a ring of registers which turns with them.
+    """
+
+    def __init__(self, bit_depth=16, signed=False, channels=1):
         super().__init__({
-            "input"  : In  (bit_depth),
-            "output" : Out (1),
+            "inputs"  : In  (bit_depth).array(channels),
+            "outputs" : Out (channels),
         })
 
         self.bit_depth   = bit_depth
         self.signed = signed
+        self.channels = channels
 
         self.stb    = Signal()
         self.update = Signal()
@@ -40,110 +50,244 @@ class Channel(wiring.Component):
     def elaborate(self, platform):
         m = Module()
 
-        input_u = Signal(self.bit_depth)
-        if self.signed:
-            m.d.comb += input_u.eq(self.input - (1 << (self.bit_depth - 1)))
-        else:
-            m.d.comb += input_u.eq(self.input)
-
+        input_r = [Signal(self.bit_depth, name=f"input_r{n}") for n in range(self.channels)]
+        with m.If(self.update):
+            for n in range(self.channels):
+                if self.signed:
+                    m.d.sync += input_r[n].eq(self.inputs[n] - (1 << (self.bit_depth - 1)))
+                else:
+                    m.d.sync += input_r[n].eq(self.inputs[n])
+
+        # the channel whose turn it is, whose accumulator is at the head of the ring
+        channel = Signal(range(self.channels))
+        accums  = [Signal(self.bit_depth, name=f"accum{n}") for n in range(self.channels)]
         accum   = Signal(self.bit_depth)
-        input_r = Signal(self.bit_depth)
+        carry   = Signal()
+        m.d.comb += Cat(accum, carry).eq(accums[0] + Array(input_r)[channel])
 
         with m.If(self.stb):
-            m.d.sync += Cat(accum, self.output).eq(accum + input_r)
-        with m.If(self.update):
-            m.d.sync += input_r.eq(input_u)
+            m.d.sync += [accums[n].eq(accums[n + 1]) for n in range(self.channels - 1)]
+            m.d.sync += accums[-1].eq(accum)
+            for n in range(self.channels):
+                with m.If(channel == n):
+                    m.d.sync += self.outputs[n].eq(carry)
+            m.d.sync += channel.eq(Mux(channel == self.channels - 1, 0, channel + 1))
 
         return m
 
 
 class DAC(wiring.Component):
-    def __init__(self, sample_rate, bit_depth, channels, clock_frequency, signed=False):
+    """ Delta-Sigma DAC
+
+    Each channel is modulated by a first-order :class:`Channel` or, with ``order`` of
+    2 to 5, by a :class:`uac.deltasigma.DeltaSigmaModulator` of that order, to which
+    ``modulator`` passes any further options, e.g. ``dither``. Where the clock is a
+    multiple of the modulation rate, as many channels as that multiple take turns on
+    each modulator.
+
+    Each sample is held by the modulators until the next unless ``interpolation_rate``
+    is given, in which case :class:`uac.interpolator.Interpolator` raises the sample
+    rate by the largest power of two that keeps it within ``interpolation_rate``, with
+    as many channels per interpolator as it has time for.
+
+    Samples are strobed from the clock by a fractional divider unless ``external_clock``
+    is set, in which case they are strobed by ``stb``, which must run at ``strobe_hzs``
+    for each sample rate, e.g. from a :class:`uac.recovery.ClockRecovery`.
+    """
+
+    def __init__(self, sample_rate, bit_depth, channels, clock_frequency, signed=False, sample_rates=None, order=1,
+                 interpolation_rate=None, external_clock=False, **modulator):
+        self.sample_rates = sample_rates or [sample_rate]
+
         super().__init__({
             "inputs"  : In  (stream.Signature(bit_depth)).array(channels),
             "outputs" : Out (channels),
             "latch"   : Out (1),
+            "rate"    : In  (range(len(self.sample_rates)), init=self.sample_rates.index(sample_rate)),
+            **({"stb" : In  (1)} if external_clock else {}),
         })
 
         modulation_freq    = 30e6 # pulse  cycles
 
         self.bit_depth     = bit_depth
+        self.channels      = channels
         self.signed        = signed
+        self.order         = order
+        self.modulator     = modulator
+        self.external      = external_clock
+
+        if order not in range(1, 6):
+            raise ValueError(f"modulator order must be 1, 2, 3, 4 or 5, not {order}")
+
+        # channels per modulator
+        self.sharing       = max(1, min(channels, int(clock_frequency // modulation_freq)))
 
         self.pulse_cycles  = ClockGen.derive(
             clock_name = "modulation",
             input_hz   = clock_frequency,
-            output_hz  = modulation_freq,
+            output_hz  = modulation_freq * self.sharing,
             logger     = logging,
         )
-        self.sample_cycles = ClockGen.derive(
+        self.sample_steps, self.sample_modulus = FractionalClockGen.derive(
             clock_name = "sampling",
             input_hz   = clock_frequency,
-            output_hz  = sample_rate,
+            output_hzs = self.sample_rates,
             logger     = logging,
             max_deviation_ppm = 0,
         )
 
         self.clock         = ClockGen(self.pulse_cycles)
-        self.fifo_0        = fifo.SyncFIFOBuffered(width=self.bit_depth, depth=16)
-        self.fifo_1        = fifo.SyncFIFOBuffered(width=self.bit_depth, depth=16)
+        self.interpolators = None
+        self.strobe_hzs    = self.sample_rates
+        if interpolation_rate is not None:
+            self.clock_hz      = int(clock_frequency)
+            self.interpolators = self._interpolators(interpolation_rate)
+        self.fifos         = [fifo.SyncFIFOBuffered(width=self.bit_depth, depth=16) for _ in range(channels)]
 
 
     def elaborate(self, platform):
         m = Module()
 
-        print(f"pulse_cycles:  {self.pulse_cycles}")
-        print(f"sample_cycles: {self.sample_cycles}")
+        logging.debug(f"pulse_cycles:  {self.pulse_cycles}")
+        logging.debug(f"sample_steps:  {self.sample_steps} / {self.sample_modulus}")
 
         m.submodules.clock  = clock   = self.clock
-        m.submodules.fifo_0 = fifo_0  = self.fifo_0
-        m.submodules.fifo_1 = fifo_1  = self.fifo_1
 
-        m.submodules.channel_0 = channel_0 = Channel(bit_depth=self.bit_depth, signed=self.signed)
-        m.submodules.channel_1 = channel_1 = Channel(bit_depth=self.bit_depth, signed=self.signed)
-        m.d.comb += channel_0.stb.eq(clock.stb_r)
-        m.d.comb += channel_1.stb.eq(clock.stb_r)
+        # the modulators, and the modulator input and output for each channel
+        modulators = []
+        inputs     = []
+        outputs    = []
+        for n in range(0, self.channels, self.sharing):
+            modulator = self._modulator(min(self.sharing, self.channels - n))
+            m.submodules[f"modulator_{len(modulators)}"] = modulator
+            m.d.comb += modulator.stb.eq(clock.stb_r)
+            modulators.append(modulator)
+            inputs    += list(modulator.inputs)
+            outputs   += list(modulator.outputs)
+
+        samples = [Signal(self.bit_depth, name=f"sample_{n}") for n in range(self.channels)]
+
+        if self.interpolators is not None:
+            self._elaborate_interpolators(m, samples, modulators, inputs)
+        else:
+            self._elaborate_hold(m, samples, modulators, inputs)
 
-        timer = Signal(range(self.sample_cycles))
+        # connect input streams to fifo & fifo to channels
+        for n, fifo in enumerate(self.fifos):
+            m.submodules[f"fifo_{n}"] = fifo
+            wiring.connect(m, wiring.flipped(self.inputs[n]), fifo.w_stream)
+            m.d.comb += [
+                fifo.r_en.eq(self.latch & fifo.r_rdy),
+                samples[n].eq(fifo.r_data),
+            ]
 
-        sample_0 = Signal(self.bit_depth)
-        sample_1 = Signal(self.bit_depth)
-        len_channels = 1
+        # connect channel outputs to dac output
+        m.d.comb += self.outputs.eq(Cat(outputs))
 
-        with m.FSM():
-            with m.State("STANDBY"):
-                m.next = "WAIT"
+        return m
 
+
+    def _elaborate_hold(self, m, samples, modulators, inputs):
+        """ Latch each sample into the modulators, which hold it until the next. """
+        if self.external:
+            stb = self.stb
+        else:
+            m.submodules.sample_clock = sample_clock = FractionalClockGen(self.sample_steps, self.sample_modulus)
+            m.d.comb += sample_clock.sel.eq(self.rate)
+            stb = sample_clock.stb_r
+
+        with m.FSM():
             with m.State("WAIT"):
-                with m.If(timer == 0):
-                    m.d.sync += timer.eq(self.sample_cycles - len_channels * (self.bit_depth // 8) - 1)
+                with m.If(stb):
                     m.next = "CHANNEL-READ"
-                with m.Else():
-                    m.d.sync += timer.eq(timer - 1)
 
             with m.State("CHANNEL-READ"):
-                m.d.sync += channel_0.input.eq(sample_0)
-                m.d.sync += channel_1.input.eq(sample_1)
+                m.d.sync += [input.eq(sample) for input, sample in zip(inputs, samples)]
                 m.next = "LATCH"
 
             with m.State("LATCH"):
                 m.d.comb += self.latch.eq(1)
-                m.d.comb += channel_0.update.eq(1)
-                m.d.comb += channel_1.update.eq(1)
+                m.d.comb += [modulator.update.eq(1) for modulator in modulators]
                 m.next = "WAIT"
 
-        # connect input streams to fifo & fifo to channels
-        wiring.connect(m, wiring.flipped(self.inputs[0]), fifo_0.w_stream)
-        wiring.connect(m, wiring.flipped(self.inputs[1]), fifo_1.w_stream)
-        m.d.comb += [
-            fifo_0.r_en.eq(self.latch & fifo_0.r_rdy),
-            sample_0.eq(fifo_0.r_data),
-            fifo_1.r_en.eq(self.latch & fifo_1.r_rdy),
-            sample_1.eq(fifo_1.r_data),
-        ]
 
-        # connect channel outputs to dac output
-        m.d.comb += self.outputs[0].eq(channel_0.output)
-        m.d.comb += self.outputs[1].eq(channel_1.output)
+    def _elaborate_interpolators(self, m, samples, modulators, inputs):
+        """ Interpolate samples, updating the modulators at the interpolated sample rate. """
 
-        return m
+        # interpolated sample strobe, exactly 2 * ratio per sample on average
+        if self.external:
+            stb = self.stb
+        else:
+            m.submodules.interpolation_clock = interpolation_clock = \
+                FractionalClockGen(self.interpolation_steps, self.interpolation_modulus)
+            m.d.comb += interpolation_clock.sel.eq(self.rate)
+            stb = interpolation_clock.stb_r
+
+        m.d.comb += [modulator.update.eq(stb) for modulator in modulators]
+
+        # the interpolators work in lockstep, on signed samples
+        offset  = 0 if self.signed else 1 << (self.bit_depth - 1)
+        channel = 0
+        for n, interpolator in enumerate(self.interpolators):
+            m.submodules[f"interpolator_{n}"] = interpolator
+            m.d.comb += [
+                interpolator.rate .eq(self.rate),
+                interpolator.stb  .eq(stb),
+            ]
+            for k in range(interpolator.channels):
+                m.d.comb += [
+                    interpolator.inputs[k] .eq(samples[channel] ^ offset),
+                    inputs[channel]        .eq(interpolator.outputs[k]),
+                ]
+                channel += 1
+
+        m.d.comb += self.latch.eq(self.interpolators[0].latch)
+
+
+    def _interpolators(self, interpolation_rate):
+        """ Choose the interpolation ratio for each sample rate, and enough interpolators to keep up. """
+        ratios = []
+        for sample_rate in self.sample_rates:
+            ratio = 1
+            while 4 * ratio * sample_rate <= interpolation_rate:
+                ratio *= 2
+            if 2 * ratio * sample_rate > interpolation_rate:
+                raise ValueError(f"interpolation rate {interpolation_rate} is below twice the sample rate {sample_rate}")
+            ratios.append(ratio)
+
+        interpolation_hzs = [2 * ratio * sample_rate for ratio, sample_rate in zip(ratios, self.sample_rates)]
+        self.strobe_hzs   = interpolation_hzs
+        self.interpolation_steps, self.interpolation_modulus = FractionalClockGen.derive(
+            clock_name = "interpolation",
+            input_hz   = self.clock_hz,
+            output_hzs = interpolation_hzs,
+            logger     = logging,
+        )
+
+        # each interpolator's cic filter must be done with each interpolated sample before
+        # the next, and its halfband filter with each sample before the next
+        strobe_cycles = int(self.clock_hz // max(interpolation_hzs))
+        sample_cycles = 2 * min(ratios) * strobe_cycles
+        def fits(channels):
+            strobe_needed, sample_needed = Interpolator.cycles(channels)
+            return strobe_cycles >= strobe_needed and sample_cycles >= sample_needed
+
+        capacity = 0
+        while capacity < self.channels and fits(capacity + 1):
+            capacity += 1
+        if capacity == 0:
+            raise ValueError(f"interpolation rate {max(interpolation_hzs)} Hz leaves {strobe_cycles} cycles "
+                             f"per interpolated sample, too few to interpolate a channel")
+
+        logging.info(f"DAC interpolation ratios: {[2 * ratio for ratio in ratios]}, "
+                     f"{capacity} channels per interpolator")
+        return [Interpolator(self.bit_depth, min(capacity, self.channels - n), ratios)
+                for n in range(0, self.channels, capacity)]
+
+
+    def _modulator(self, channels):
+        signed = self.signed or self.interpolators is not None
+        if self.order == 1:
+            return Channel(bit_depth=self.bit_depth, signed=signed, channels=channels)
+        return DeltaSigmaModulator(bit_depth=self.bit_depth, signed=signed, order=self.order, channels=channels,
+                                   **self.modulator)
@@ -0,0 +1,319 @@
+import math
+import re
+import sys
+
+import numpy as np
+
+from amaranth             import *
+from amaranth.lib         import wiring
+from amaranth.lib.wiring  import In, Out
+
+from amaranth.sim         import *
+
+
+# - coefficients --------------------------------------------------------------
+
+def ntf_coefficients(order, h_inf=1.5):
+    """ Feedback coefficients of a CIFB modulator with a maximally flat highpass NTF.
+
+    The NTF has all of its zeros at DC and Butterworth poles, with the cutoff chosen
+    so that its out-of-band gain is ``h_inf``. For a chain of delaying integrators
+    the NTF is ``(z-1)**order / D(z)``, so the coefficients ``a_1 .. a_order`` are
+    those of ``D(w + 1)``, lowest power first.
+    """
+
+    def poles(cutoff):
+        # analog Butterworth lowpass prototype, transformed to highpass, then bilinear
+        k  = np.arange(order)
+        lp = np.exp(1j * np.pi * (2 * k + order + 1) / (2 * order))
+        hp = 2 * np.tan(np.pi * cutoff) / lp
+        return (2 + hp) / (2 - hp)
+
+    def gain_at_nyquist(cutoff):
+        return 2**order / np.prod(np.abs(-1 - poles(cutoff)))
+
+    # the out-of-band gain rises with the cutoff
+    lo, hi = 1e-6, 0.49
+    for _ in range(64):
+        cutoff = (lo + hi) / 2
+        if gain_at_nyquist(cutoff) > h_inf:
+            hi = cutoff
+        else:
+            lo = cutoff
+
+    d = np.polynomial.Polynomial(np.real(np.poly(poles(lo)))[::-1])
+    return list(d(np.polynomial.Polynomial([1, 1])).coef[:order])
+
+
+# - gateware ------------------------------------------------------------------
+
+class DeltaSigmaModulator(wiring.Component):
+    """ Higher-order 1-bit Delta-Sigma Modulator
+
+    A chain of ``order`` delaying integrators with distributed feedback (CIFB), with
+    coefficients from :func:`ntf_coefficients`. Feedback of the 1-bit output is a
+    +/- constant per integrator, so the modulator itself needs no multipliers; the
+    input is scaled by ``gain`` and the first coefficient once per sample, on ``update``.
+
+    Integrators are clamped to +/-2 full scale so that the loop recovers from overload
+    rather than wrapping around. Orders of 3 and up are only stable for inputs well
+    short of full scale, hence the default ``gain`` of one half.
+
+    With ``dither`` set, uniform dither of +/-2**-dither full scale from an LFSR is
+    added at the quantizer.
+
+    As for :class:`uac.dac.Channel`, ``channels`` channels may take turns on a single
+    modulator, one per ``stb``, with their integrators kept in rings of registers. They
+    share the dither generator.
+
+    Drop-in replacement for :class:`uac.dac.Channel`.
+    """
+
+    lfsr_taps = 0x80200003 # x^32 + x^22 + x^2 + x + 1
+
+    def __init__(self, bit_depth=16, signed=False, order=2, h_inf=1.5, gain=0.5, guard_bits=4, dither=None, channels=1):
+        if order not in range(2, 6):
+            raise ValueError(f"modulator order must be 2, 3, 4 or 5, not {order}")
+
+        super().__init__({
+            "inputs"  : In  (bit_depth).array(channels),
+            "outputs" : Out (channels),
+        })
+
+        self.bit_depth  = bit_depth
+        self.signed     = signed
+        self.order      = order
+        self.dither     = dither
+        self.channels   = channels
+
+        self.stb        = Signal()
+        self.update     = Signal()
+
+        # fixed point, in units of 2**-frac_bits full scale, with enough fractional bits
+        # that the input keeps its resolution after scaling by the first coefficient
+        coefficients    = ntf_coefficients(order, h_inf)
+        self.frac_bits  = bit_depth - 1 + guard_bits + max(0, math.ceil(-math.log2(coefficients[0])))
+        self.width      = self.frac_bits + 3 # +/-4 full scale
+        self.limit      = 2 << self.frac_bits
+
+        self.feedback   = [round(a * (1 << self.frac_bits)) for a in coefficients]
+        self.input_gain = round(coefficients[0] * gain * (1 << self.frac_bits))
+
+        self.dither_bits = None
+        if dither is not None:
+            self.dither_bits = self.frac_bits - dither + 1
+            if not 0 < self.dither_bits <= 32:
+                raise ValueError(f"dither of 2**-{dither} full scale is out of range")
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # inputs, as signed offsets from mid-scale, scaled once per sample
+        input_r = [Signal(signed(self.width), name=f"input_r{n}") for n in range(self.channels)]
+        with m.If(self.update):
+            for n in range(self.channels):
+                if self.signed:
+                    input_s = self.inputs[n].as_signed()
+                else:
+                    input_s = self.inputs[n] - (1 << (self.bit_depth - 1))
+                m.d.sync += input_r[n].eq((input_s * self.input_gain) >> (self.bit_depth - 1))
+
+        # the channel whose turn it is, whose integrators are at the heads of the rings
+        channel = Signal(range(self.channels))
+        rings   = [[Signal(signed(self.width), name=f"state{n}_{c}") for c in range(self.channels)]
+                   for n in range(self.order)]
+        states  = [ring[0] for ring in rings]
+
+        # quantizer, with optional dither
+        y = states[-1]
+        if self.dither is not None:
+            lfsr = Signal(32, init=1)
+            with m.If(self.stb):
+                m.d.sync += lfsr.eq(Mux(lfsr[0], (lfsr >> 1) ^ self.lfsr_taps, lfsr >> 1))
+            y = y + lfsr[:self.dither_bits].as_signed()
+
+        v = Signal()
+        m.d.comb += v.eq(y >= 0)
+
+        # integrators
+        with m.If(self.stb):
+            for c in range(self.channels):
+                with m.If(channel == c):
+                    m.d.sync += self.outputs[c].eq(v)
+            m.d.sync += channel.eq(Mux(channel == self.channels - 1, 0, channel + 1))
+
+            for n, ring in enumerate(rings):
+                feedback = Mux(v, self.feedback[n], -self.feedback[n])
+                previous = Array(input_r)[channel] if n == 0 else states[n - 1]
+                m.d.sync += [ring[c].eq(ring[c + 1]) for c in range(self.channels - 1)]
+                m.d.sync += ring[-1].eq(_clamp(ring[0] + previous - feedback, self.limit))
+
+        return m
+
+
+def _clamp(value, limit):
+    """ Clamp a signed value to +/- ``limit``. """
+    return Mux(value > limit, limit, Mux(value < -limit, -limit, value))
+
+
+# - model ---------------------------------------------------------------------
+
+def deltasigma_model(modulator, inputs, repeat):
+    """ Bit-exact model of a :class:`DeltaSigmaModulator`.
+
+    Takes a list of samples for each channel, holding each sample for ``repeat`` modulator
+    cycles, and returns a list of output bits for each channel.
+    """
+
+    bit_depth = modulator.bit_depth
+    limit     = modulator.limit
+    states    = [[0] * modulator.order for _ in inputs]
+    lfsr      = 1
+
+    bits = [[] for _ in inputs]
+    for samples in zip(*inputs):
+        input_r = []
+        for sample in samples:
+            if modulator.signed:
+                sample = sample - (1 << bit_depth) if sample >> (bit_depth - 1) else sample
+            else:
+                sample = sample - (1 << (bit_depth - 1))
+            input_r.append((sample * modulator.input_gain) >> (bit_depth - 1))
+
+        for _ in range(repeat):
+            # the channels take turns, sharing the dither generator
+            for channel, state in enumerate(states):
+                y = state[-1]
+                if modulator.dither is not None:
+                    d = lfsr & ((1 << modulator.dither_bits) - 1)
+                    y += d - (1 << modulator.dither_bits) if d >> (modulator.dither_bits - 1) else d
+                    lfsr = (lfsr >> 1) ^ modulator.lfsr_taps if lfsr & 1 else lfsr >> 1
+
+                v = y >= 0
+                bits[channel].append(int(v))
+
+                previous = [input_r[channel]] + state[:-1]
+                for n in range(modulator.order):
+                    feedback = modulator.feedback[n] if v else -modulator.feedback[n]
+                    state[n] = max(-limit, min(limit, state[n] + previous[n] - feedback))
+
+    return bits
+
+
+def channel_model(bit_depth, signed, samples, repeat):
+    """ Model of the first-order :class:`uac.dac.Channel`, for comparison. """
+
+    accum = 0
+    bits  = []
+    for sample in samples:
+        if signed:
+            sample = (sample - (1 << (bit_depth - 1))) % (1 << bit_depth)
+        for _ in range(repeat):
+            accum += sample
+            bits.append(accum >> bit_depth)
+            accum &= (1 << bit_depth) - 1
+    return bits
+
+
+def snr(bits, signal_bin, band_bins):
+    """ In-band signal to noise and distortion ratio of a modulator's output, in dB.
+
+    The signal must complete ``signal_bin`` whole cycles over ``bits``. A Blackman
+    window keeps the modulator's out-of-band noise from leaking into the band, and
+    spreads the signal over the bins either side of ``signal_bin``.
+    """
+    bits     = 2 * np.asarray(bits, dtype=np.float64) - 1
+    spectrum = np.abs(np.fft.rfft(bits * np.blackman(len(bits))))**2
+    signal   = spectrum[signal_bin - 3:signal_bin + 4].sum()
+    noise    = spectrum[1:band_bins + 1].sum() - signal
+    return 10 * math.log10(signal / noise)
+
+
+def cost(elaboratable):
+    """ Estimate the cost of a design as flip-flops and adder/comparator bits, before synthesis. """
+    from amaranth.back import rtlil
+
+    text  = rtlil.convert(elaboratable)
+    ffs   = 0
+    adder = 0
+    for cell, parameters in re.findall(r"cell \$(\w+) \S+\n((?:\s+parameter .*\n)*)", text):
+        parameters = dict(re.findall(r"parameter \\(\w+) (\S+)", parameters))
+        if cell in ("dff", "adff", "sdff"):
+            ffs += int(parameters["WIDTH"])
+        elif cell in ("add", "sub"):
+            adder += int(parameters["Y_WIDTH"])
+        elif cell in ("lt", "le", "gt", "ge"):
+            adder += max(int(parameters["A_WIDTH"]), int(parameters["B_WIDTH"]))
+    return ffs, adder
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(dut, inputs, repeat):
+    """ Collect the outputs of a modulator simulation, holding each sample for ``repeat`` modulator cycles. """
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+
+    bits = [[] for _ in inputs]
+
+    async def testbench(ctx):
+        for samples in zip(*inputs):
+            for n, sample in enumerate(samples):
+                ctx.set(dut.inputs[n], sample)
+            ctx.set(dut.update, 1)
+            await ctx.tick()
+            ctx.set(dut.update, 0)
+
+            ctx.set(dut.stb, 1)
+            for _ in range(repeat):
+                for n in range(len(inputs)):
+                    await ctx.tick()
+                    bits[n].append(ctx.get(dut.outputs[n]))
+            ctx.set(dut.stb, 0)
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return bits
+
+
+if __name__ == "__main__":
+    from .dac import Channel
+
+    bit_depth       = 24
+    sample_rate     = 48000
+    modulation_freq = 30e6
+    repeat          = int(modulation_freq // sample_rate)
+    bandwidth       = 20e3
+
+    # a -6 dBFS tone completing a whole number of cycles over the run
+    length    = 512
+    cycles    = 11
+    amplitude = 0.5 * ((1 << (bit_depth - 1)) - 1)
+    samples   = [round(amplitude * math.sin(2 * math.pi * cycles * n / length)) & ((1 << bit_depth) - 1)
+                 for n in range(length)]
+    band_bins = int(bandwidth * length / sample_rate)
+
+    # check the gateware against the model, for a single channel and for channels taking turns
+    for order in range(2, 6):
+        for dither in [None, 8]:
+            for channels in [1, 3]:
+                dut    = DeltaSigmaModulator(bit_depth, signed=True, order=order, dither=dither, channels=channels)
+                inputs = [samples[n:n + 4] for n in range(channels)]
+                if simulate(dut, inputs, repeat) != deltasigma_model(dut, inputs, repeat):
+                    print(f"order {order} gateware doesn't match model")
+                    sys.exit(1)
+    print("gateware matches model")
+
+    # benchmark in-band SNR against cost, the modulator settling over the first pass --
+    # the 24-bit tone itself limits SNR to around 140 dB, and at -6 dBFS needs no input gain
+    print(f"{'order':>5}  {'SNR':>8}  {'FFs':>5}  {'adder bits':>10}")
+    ffs, adder = cost(Channel(bit_depth, signed=True))
+    bits = channel_model(bit_depth, True, samples * 2, repeat)[-length * repeat:]
+    print(f"{1:>5}  {snr(bits, cycles, band_bins):5.1f} dB  {ffs:>5}  {adder:>10}")
+    for order in range(2, 6):
+        dut  = DeltaSigmaModulator(bit_depth, signed=True, order=order, gain=1.0)
+        ffs, adder = cost(dut)
+        bits = deltasigma_model(dut, [samples * 2], repeat)[0][-length * repeat:]
+        print(f"{order:>5}  {snr(bits, cycles, band_bins):5.1f} dB  {ffs:>5}  {adder:>10}")
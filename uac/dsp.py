@@ -1,3 +1,12 @@
+from .biquad              import BiquadCascade, biquad_coefficients
 from .dac                 import DAC
+from .deltasigma          import DeltaSigmaModulator
+from .interpolator        import Interpolator
+from .jitterbuffer        import JitterBuffer
+from .latency             import LatencyProbe, Loopback
+from .mixer               import Mixer
 from .nco                 import NCO, sinusoid_lut
+from .ncobank             import NCOBank
+from .recovery            import ClockRecovery
+from .volume              import Volume
 from .vu                  import VU
@@ -0,0 +1,176 @@
+import sys
+
+from fractions                            import Fraction
+
+from amaranth                             import *
+from amaranth.lib                         import wiring
+from amaranth.lib.wiring                  import In, Out
+
+from amaranth.sim                         import *
+
+
+class FeedbackGenerator(wiring.Component):
+    """ UAC 2.0 Asynchronous Feedback Generator
+
+    Counts the samples consumed by the device's sample clock over a window of
+    ``2**window`` USB microframes and reports the rate as a high-speed Q16.16
+    feedback value (samples per microframe), smoothed by a first-order
+    low-pass filter with a time constant of ``2**filter_shift`` windows.
+
+    ``sof`` and ``sample`` are plain single-cycle strobes, so a testbench can
+    drive the generator directly without a USB core. ``measured`` carries the
+    raw, unfiltered value of the most recent window.
+
+    When ``rate`` selects a different entry of ``sample_rates`` the filter is
+    preloaded with the nominal value of the new rate and measurement restarts.
+    """
+
+    def __init__(self, sample_rate, window=7, filter_shift=3, sample_rates=None):
+        if not 0 < window <= 16:
+            raise ValueError(f"feedback window of 2**{window} microframes is out of range")
+
+        self.window       = window
+        self.filter_shift = filter_shift
+        self.sample_rates = sample_rates or [sample_rate]
+
+        # nominal feedback values: samples per microframe as Q16.16
+        microframes_per_second = 8000
+        self.nominals = [round(rate / microframes_per_second * (2**16)) for rate in self.sample_rates]
+        self.nominal  = self.nominals[self.sample_rates.index(sample_rate)]
+
+        super().__init__({
+            "sof"      : In  (1),
+            "sample"   : In  (1),
+            "rate"     : In  (range(len(self.sample_rates)), init=self.sample_rates.index(sample_rate)),
+            "measured" : Out (32, init=self.nominal),
+            "value"    : Out (32, init=self.nominal),
+        })
+
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # microframes elapsed in the current measurement window
+        microframe = Signal(self.window)
+
+        # samples consumed during the current measurement window
+        count      = Signal(16 + self.window)
+        count_next = Signal.like(count)
+
+        # don't measure the partial window leading up to the first SOF
+        primed     = Signal()
+
+        # filter accumulator holds 2**filter_shift times the filtered value
+        accum      = Signal(32 + self.filter_shift, init=self.nominal << self.filter_shift)
+
+        # the rate selected during the previous cycle
+        rate       = Signal.like(self.rate, init=self.rate.init)
+        nominals   = Array(Const(nominal, 32) for nominal in self.nominals)
+
+        m.d.comb += [
+            count_next  .eq(count + self.sample),
+            self.value  .eq(accum >> self.filter_shift),
+        ]
+        m.d.usb += [
+            count.eq(count_next),
+            rate.eq(self.rate),
+        ]
+
+        with m.If(self.rate != rate):
+            m.d.usb += [
+                primed          .eq(0),
+                self.measured   .eq(nominals[self.rate]),
+                accum           .eq(nominals[self.rate] << self.filter_shift),
+            ]
+
+        with m.Elif(self.sof):
+            m.d.usb += microframe.eq(microframe + 1)
+
+            with m.If(~primed):
+                m.d.usb += [
+                    primed      .eq(1),
+                    microframe  .eq(0),
+                    count       .eq(0),
+                ]
+
+            with m.Elif(microframe == (2**self.window) - 1):
+                # samples per window -> samples per microframe as Q16.16
+                measured = count_next << (16 - self.window)
+
+                m.d.usb += [
+                    self.measured  .eq(measured),
+                    accum          .eq(accum - (accum >> self.filter_shift) + measured),
+                    count          .eq(0),
+                ]
+
+        return m
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(dut, sof_cycles, rates):
+    """ Drive a :class:`FeedbackGenerator` with an SOF every ``sof_cycles`` cycles and samples
+    at each of ``rates``, as ``(rate, samples_per_microframe, microframes)``, in turn.
+    Returns, for each, ``measured`` and ``value`` just after ``rate`` is selected, and ``value``
+    at the end. """
+
+    m = Module()
+    m.domains.usb = ClockDomain()
+    m.submodules.dut = dut
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6, domain="usb")
+
+    values = []
+
+    async def testbench(ctx):
+        phase = Fraction(0)
+        for rate, samples_per_microframe, microframes in rates:
+            ctx.set(dut.rate, rate)
+            await ctx.tick("usb").repeat(2)
+            preloaded = (ctx.get(dut.measured), ctx.get(dut.value))
+
+            # a sample whenever the sample clock's phase passes a whole sample
+            step = Fraction(samples_per_microframe) / sof_cycles
+            for cycle in range(microframes * sof_cycles):
+                ctx.set(dut.sof, cycle % sof_cycles == 0)
+                ctx.set(dut.sample, int(phase + step) > int(phase))
+                phase += step
+                await ctx.tick("usb")
+            values.append((preloaded, ctx.get(dut.value)))
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return values
+
+
+if __name__ == "__main__":
+    sample_rates = [44100, 48000, 96000]
+    window       = 5
+    sof_cycles   = 100
+
+    # a device sample clock running slow, then fast, of the nominal rate, switching rates in between
+    rates = [
+        (1, Fraction(48000, 8000) * Fraction(1_000_000 - 500, 1_000_000)),
+        (0, Fraction(44100, 8000) * Fraction(1_000_000 + 300, 1_000_000)),
+        (2, Fraction(96000, 8000) * Fraction(1_000_000 + 800, 1_000_000)),
+    ]
+    microframes = 40 << window
+
+    dut    = FeedbackGenerator(48000, window=window, sample_rates=sample_rates)
+    values = simulate(dut, sof_cycles, [(rate, spm, microframes) for rate, spm in rates])
+
+    # each window counts whole samples, so the value is within a sample per window
+    resolution = 1 << (16 - window)
+    for (rate, samples_per_microframe), ((measured, preloaded), value) in zip(rates, values):
+        nominal  = dut.nominals[rate]
+        expected = round(samples_per_microframe * (1 << 16))
+        if measured != nominal or preloaded != nominal:
+            print(f"{sample_rates[rate]} Hz: preloaded with {hex(preloaded)}, not {hex(nominal)}")
+            sys.exit(1)
+        if abs(value - expected) > resolution:
+            print(f"{sample_rates[rate]} Hz: feedback {hex(value)} didn't converge to {hex(expected)}")
+            sys.exit(1)
+        print(f"{sample_rates[rate]:6} Hz: preloaded with {hex(nominal)}, converged to {hex(value)}, "
+              f"expected {hex(expected)}, within {abs(value - expected)} of {resolution}")
@@ -0,0 +1,408 @@
+import math
+import sys
+
+import numpy as np
+
+from amaranth             import *
+from amaranth.lib         import wiring
+from amaranth.lib.wiring  import In, Out
+from amaranth.lib.memory  import Memory
+from amaranth.utils       import ceil_log2, exact_log2
+
+from amaranth.sim         import *
+
+
+# - coefficients --------------------------------------------------------------
+
+def halfband_coefficients(taps, coef_bits=18, attenuation=80):
+    """ Design a Kaiser-windowed halfband interpolation filter of ``taps`` taps.
+
+    Returns the first half of the filter's non-trivial polyphase branch, scaled for
+    unity gain and quantized to ``coef_bits`` bit integers with ``coef_bits - 1``
+    fractional bits. The other branch is a single tap, a delay of ``taps // 4`` samples.
+    """
+    if taps % 4 != 3:
+        raise ValueError(f"halfband filters have 4n - 1 taps, not {taps}")
+
+    beta = 0.1102 * (attenuation - 8.7)
+    n    = np.arange(taps)
+    g    = np.sinc((n - (taps - 1) / 2) / 2) * np.kaiser(taps, beta)
+
+    # the polyphase branch through the even taps, for unity gain
+    h = g[0::2] / g[0::2].sum()
+
+    return [int(round(c * (1 << (coef_bits - 1)))) for c in h[:(taps + 1) // 4]]
+
+
+# - gateware ------------------------------------------------------------------
+
+class Interpolator(wiring.Component):
+    """ Halfband FIR and CIC Interpolator
+
+    Raises the sample rate of ``channels`` channels by ``2 * ratio``: first by two with a
+    halfband FIR filter, which removes the images around the input sample rate, then by
+    ``ratio`` with a CIC filter of ``stages`` stages, which removes those around multiples
+    of twice the input sample rate. ``ratios`` lists the CIC ratio, a power of two, to use
+    at each of the sample rates selected between by ``rate``.
+
+    Every ``stb`` produces a new sample on each of the ``outputs``, and every ``2 * ratio``
+    strobes a new sample is taken from each of the ``inputs``, in the same cycle as
+    ``latch`` is asserted.
+
+    Both filters are time-multiplexed over the channels. The FIR filter has a single
+    multiplier, keeps its history in memory and takes ``taps // 4 + 7`` cycles per channel
+    per input sample. The CIC filter has a single adder, keeps its state in memory and
+    takes up to ``2 * stages`` cycles per channel per strobe, plus three. See :meth:`cycles`.
+
+    The CIC filter's passband droops by about ``stages * 0.6`` dB at 20 kHz for 48 kHz input.
+    """
+
+    def __init__(self, bit_depth, channels, ratios, taps=63, stages=3, coef_bits=18):
+        for ratio in ratios:
+            exact_log2(ratio)
+
+        super().__init__({
+            "inputs"  : In  (signed(bit_depth)).array(channels),
+            "outputs" : Out (signed(bit_depth)).array(channels),
+            "stb"     : In  (1),
+            "latch"   : Out (1),
+            "rate"    : In  (range(len(ratios))),
+        })
+
+        self.bit_depth    = bit_depth
+        self.channels     = channels
+        self.ratios       = ratios
+        self.stages       = stages
+
+        # halfband filter
+        self.coefficients = halfband_coefficients(taps, coef_bits)
+        self.coef_bits    = coef_bits
+        self.half_taps    = len(self.coefficients)
+        exact_log2(self.half_taps)
+
+        # cic filter, wide enough for its gain and that of its combs
+        self.cic_width    = bit_depth + stages * (exact_log2(max(ratios)) + 1)
+        self.shifts       = [(stages - 1) * exact_log2(ratio) for ratio in ratios]
+
+    @staticmethod
+    def cycles(channels, taps=63, stages=3):
+        """ The cycles needed between strobes, and between input samples, for ``channels`` channels. """
+        return 2 * channels * stages + 3, channels * (taps // 4 + 7) + 1
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # - schedule --
+
+        # strobes since the last input sample, two of which are cic filter input samples
+        phase    = Signal(range(2 * max(self.ratios)))
+        ratio    = Array(self.ratios)[self.rate]
+        boundary = Signal()
+        odd      = Signal()
+
+        # the input samples, and the halfband filter's output pairs for them -- the pair
+        # being computed from the latest input sample, and the pair being interpolated
+        held     = [Signal(signed(self.bit_depth), name=f"held{n}")     for n in range(self.channels)]
+        next     = [Signal(signed(self.bit_depth), name=f"next{n}_{k}") for n in range(self.channels) for k in range(2)]
+        current  = [Signal(signed(self.bit_depth), name=f"cur{n}_{k}")  for n in range(self.channels) for k in range(2)]
+
+        m.d.comb += self.latch.eq(self.stb & (phase == 0))
+        with m.If(self.stb):
+            m.d.sync += [
+                phase    .eq(Mux(phase >= 2 * ratio - 1, 0, phase + 1)),
+                boundary .eq((phase == 0) | (phase == ratio)),
+                odd      .eq(phase == ratio),
+            ]
+        with m.If(self.latch):
+            m.d.sync += [held[n].eq(self.inputs[n]) for n in range(self.channels)]
+            m.d.sync += [current[n].eq(next[n]) for n in range(2 * self.channels)]
+
+
+        # - halfband fir filter --
+
+        K       = self.half_taps
+        m.submodules.history = history = Memory(shape=signed(self.bit_depth), depth=self.channels * 2 * K, init=[])
+        write   = history.write_port()
+        read_a  = history.read_port()
+        read_b  = history.read_port()
+
+        frac_bits = self.coef_bits - 1
+        coeffs    = Array(C(c, signed(self.coef_bits)) for c in self.coefficients)
+
+        position  = Signal(range(2 * K))        # where the latest input sample is kept
+        fir_ch    = Signal(range(self.channels))
+        tap       = Signal(range(K + 4))
+
+        tap_d     = Signal.like(tap)
+        valid_d   = Signal()
+        pre       = Signal(signed(self.bit_depth + 1))
+        coeff     = Signal(signed(self.coef_bits))
+        valid_p   = Signal()
+        product   = Signal(signed(self.bit_depth + 1 + self.coef_bits))
+        valid_m   = Signal()
+        accum     = Signal(signed(len(product) + ceil_log2(K) + 1))
+        delayed   = Signal(signed(self.bit_depth))
+
+        # the pair of samples either side of the centre, for each tap of the even branch
+        m.d.comb += [
+            read_a.addr .eq(Cat((position - tap)[:exact_log2(2 * K)], fir_ch)),
+            read_b.addr .eq(Cat((position + 1 + tap)[:exact_log2(2 * K)], fir_ch)),
+        ]
+
+        # multiply-accumulate pipeline
+        m.d.sync += [
+            tap_d   .eq(tap),
+            pre     .eq(read_a.data + read_b.data),
+            coeff   .eq(coeffs[tap_d]),
+            valid_p .eq(valid_d),
+            product .eq(pre * coeff),
+            valid_m .eq(valid_p),
+        ]
+        with m.If(valid_m):
+            m.d.sync += accum.eq(accum + product)
+        with m.If(valid_d & (tap_d == K - 1)):
+            m.d.sync += delayed.eq(read_a.data)
+
+        result = accum >> frac_bits
+        limit  = (1 << (self.bit_depth - 1)) - 1
+
+        with m.FSM(name="fir"):
+            with m.State("IDLE"):
+                with m.If(self.latch):
+                    m.d.sync += [
+                        fir_ch   .eq(0),
+                        position .eq(position + 1),
+                    ]
+                    m.next = "WRITE"
+
+            with m.State("WRITE"):
+                m.d.comb += [
+                    write.addr .eq(Cat(position, fir_ch)),
+                    write.data .eq(Array(held)[fir_ch]),
+                    write.en   .eq(1),
+                ]
+                m.d.sync += [
+                    tap   .eq(0),
+                    accum .eq(0),
+                ]
+                m.next = "TAPS"
+
+            with m.State("TAPS"):
+                m.d.sync += [
+                    tap     .eq(tap + 1),
+                    valid_d .eq(tap < K),
+                ]
+                with m.If(tap == K + 3):
+                    m.next = "RESULT"
+
+            with m.State("RESULT"):
+                # clip the output, which may overshoot full scale
+                for n in range(self.channels):
+                    with m.If(fir_ch == n):
+                        m.d.sync += [
+                            next[2 * n]     .eq(Mux(result > limit, limit, Mux(result < -limit - 1, -limit - 1, result))),
+                            next[2 * n + 1] .eq(delayed),
+                        ]
+                with m.If(fir_ch == self.channels - 1):
+                    m.next = "IDLE"
+                with m.Else():
+                    m.d.sync += fir_ch.eq(fir_ch + 1)
+                    m.next = "WRITE"
+
+
+        # - cic filter --
+
+        N       = self.stages
+        op_bits = ceil_log2(2 * N)
+        m.submodules.state = state = Memory(shape=signed(self.cic_width), depth=self.channels << op_bits, init=[])
+        s_write = state.write_port()
+        s_read  = state.read_port()
+
+        # each channel's combs then integrators, or just the integrators between cic input samples
+        busy    = Signal()
+        cic_ch  = Signal(range(self.channels))
+        op      = Signal(range(2 * N))
+        start   = Signal()
+        first   = Signal()
+
+        op_d    = Signal.like(op)
+        ch_d    = Signal.like(cic_ch)
+        first_d = Signal()
+        valid_c = Signal()
+        carry   = Signal(signed(self.cic_width))
+
+        m.d.comb += s_read.addr.eq(Cat(op, cic_ch))
+        m.d.sync += [
+            start   .eq(self.stb),
+            op_d    .eq(op),
+            ch_d    .eq(cic_ch),
+            first_d .eq(first),
+            valid_c .eq(busy),
+        ]
+
+        with m.If(start):
+            m.d.sync += [
+                busy   .eq(1),
+                first  .eq(1),
+                cic_ch .eq(0),
+                op     .eq(Mux(boundary, 0, N)),
+            ]
+        with m.Elif(busy):
+            with m.If(op == 2 * N - 1):
+                m.d.sync += [
+                    busy   .eq(cic_ch != self.channels - 1),
+                    first  .eq(1),
+                    cic_ch .eq(cic_ch + 1),
+                    op     .eq(Mux(boundary, 0, N)),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    first  .eq(0),
+                    op     .eq(op + 1),
+                ]
+
+        # the first operation for a channel takes its input sample, or zero between them
+        sample   = Array(current)[Cat(odd, ch_d)]
+        carry_in = Mux(first_d, Mux(boundary, sample, 0), carry)
+        integral = Signal(signed(self.cic_width))
+        m.d.comb += integral.eq(s_read.data + carry_in)
+
+        with m.If(valid_c):
+            m.d.comb += [
+                s_write.addr .eq(Cat(op_d, ch_d)),
+                s_write.en   .eq(1),
+            ]
+            with m.If(op_d < N):
+                m.d.comb += s_write.data.eq(carry_in)
+                m.d.sync += carry.eq(carry_in - s_read.data)
+            with m.Else():
+                m.d.comb += s_write.data.eq(integral)
+                m.d.sync += carry.eq(integral)
+
+            with m.If(op_d == 2 * N - 1):
+                for n in range(self.channels):
+                    with m.If(ch_d == n):
+                        m.d.sync += self.outputs[n].eq(integral >> Array(self.shifts)[self.rate])
+
+        return m
+
+
+# - model ---------------------------------------------------------------------
+
+def interpolator_model(interpolator, inputs, rate=0):
+    """ Bit-exact model of an :class:`Interpolator`.
+
+    Takes a list of samples for each channel and returns, for each channel, the
+    output following each strobe.
+    """
+
+    K       = interpolator.half_taps
+    N       = interpolator.stages
+    ratio   = interpolator.ratios[rate]
+    shift   = interpolator.shifts[rate]
+    width   = interpolator.cic_width
+    frac    = interpolator.coef_bits - 1
+    limit   = (1 << (interpolator.bit_depth - 1)) - 1
+    out_bits = interpolator.bit_depth
+
+    def wrap(value, bits):
+        return ((value + (1 << (bits - 1))) % (1 << bits)) - (1 << (bits - 1))
+
+    outputs = []
+    for samples in inputs:
+        history = [0] * (2 * K)
+        pair    = (0, 0)
+        combs   = [0] * N
+        integs  = [0] * N
+        output  = []
+
+        for sample in samples:
+            current = pair
+
+            # halfband filter
+            history = [sample] + history[:-1]
+            accum   = sum(c * (history[i] + history[2 * K - 1 - i]) for i, c in enumerate(interpolator.coefficients))
+            pair    = (max(-limit - 1, min(limit, accum >> frac)), history[K - 1])
+
+            # cic filter
+            for phase in range(2 * ratio):
+                if phase in (0, ratio):
+                    carry = current[phase // ratio]
+                    for n in range(N):
+                        carry, combs[n] = wrap(carry - combs[n], width), carry
+                else:
+                    carry = 0
+                for n in range(N):
+                    integs[n] = carry = wrap(integs[n] + carry, width)
+                output.append(wrap(carry >> shift, out_bits))
+
+        outputs.append(output)
+
+    return outputs
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(dut, inputs, period=20):
+    """ Collect the outputs of an :class:`Interpolator` simulation, strobed every ``period`` cycles. """
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+
+    outputs = [[] for _ in inputs]
+
+    async def testbench(ctx):
+        samples = list(zip(*inputs))
+        index   = 0
+        # the outputs for each strobe are ready by the next
+        for _ in range(len(samples) * 2 * dut.ratios[0]):
+            if index < len(samples):
+                for n, sample in enumerate(samples[index]):
+                    ctx.set(dut.inputs[n], sample)
+            ctx.set(dut.stb, 1)
+            if ctx.get(dut.latch):
+                index += 1
+            await ctx.tick()
+            ctx.set(dut.stb, 0)
+            await ctx.tick().repeat(period - 1)
+            for n in range(len(inputs)):
+                outputs[n].append(ctx.get(dut.outputs[n]))
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return outputs
+
+
+if __name__ == "__main__":
+    bit_depth   = 24
+    sample_rate = 48000
+    ratio       = 32
+
+    # check the gateware against the model
+    rng    = np.random.default_rng(0)
+    inputs = [rng.integers(-(1 << 23), 1 << 23, 40).tolist() for _ in range(2)]
+    dut    = Interpolator(bit_depth, 2, [8, ratio])
+    model  = interpolator_model(dut, inputs)
+    if simulate(dut, inputs) != model:
+        print("gateware doesn't match model")
+        sys.exit(1)
+    print("gateware matches model")
+
+    # compare the images of a 1 kHz tone after a zero-order hold and after interpolation,
+    # completing a whole number of cycles over the run
+    length    = 1024
+    cycles    = 21
+    amplitude = 0.5 * ((1 << (bit_depth - 1)) - 1)
+    samples   = [round(amplitude * math.sin(2 * math.pi * cycles * n / length)) for n in range(length)]
+
+    for name, output in [("zero-order hold", np.repeat(samples * 2, 2 * ratio)),
+                         ("interpolated",    interpolator_model(dut, [samples * 2], rate=1)[0])]:
+        output   = np.asarray(output[-length * 2 * ratio:], dtype=np.float64)
+        spectrum = np.abs(np.fft.rfft(output))
+        signal   = spectrum[cycles]
+        images   = {k * length + s * cycles: spectrum[k * length + s * cycles]
+                    for k in range(1, ratio) for s in (-1, 1)}
+        image    = max(images, key=images.get)
+        print(f"{name:>16}: largest image {20 * math.log10(images[image] / signal):6.1f} dBc "
+              f"at {image * sample_rate / length / 1e3:.1f} kHz")
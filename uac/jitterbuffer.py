@@ -0,0 +1,239 @@
+import random
+import sys
+
+from amaranth             import *
+from amaranth.lib         import stream, wiring
+from amaranth.lib.wiring  import In, Out
+from amaranth.lib.memory  import Memory
+
+from amaranth.sim         import *
+
+from .stream              import _saturating_increment
+
+
+class JitterBuffer(wiring.Component):
+    """ Jitter Buffer
+
+    Holds up to ``depth`` audio frames, a sample from each of the ``inputs``, in block
+    RAM. A frame is taken once every input has a sample for it, or dropped and counted
+    as an overrun if the buffer is full.
+
+    After reset, and after running dry, the buffer holds back its ``outputs`` until it
+    has been prefilled to ``target`` frames, which sets its latency. Running dry with
+    the ``outputs`` ready for another frame is counted as an underrun. Any FIFOs
+    downstream of the buffer add their depth to its latency, so ``target`` should be
+    enough to fill them too.
+
+    ``fill`` is the number of frames held, and ``min_fill`` and ``max_fill`` its lowest
+    and highest since ``clear`` was last strobed, while running.
+    """
+
+    def __init__(self, bit_depth, channels, depth=512, target=None, counter_width=16):
+        self.bit_depth = bit_depth
+        self.channels  = channels
+        self.depth     = depth
+
+        target = depth // 2 if target is None else target
+        if target > depth:
+            raise ValueError(f"target fill {target} is more than the buffer's depth {depth}")
+
+        super().__init__({
+            "inputs"    : In  (stream.Signature(signed(bit_depth))).array(channels),
+            "outputs"   : Out (stream.Signature(signed(bit_depth))).array(channels),
+
+            # frames to prefill before starting
+            "target"    : In  (range(depth + 1), init=target),
+
+            # occupancy telemetry
+            "running"   : Out (1),
+            "fill"      : Out (range(depth + 1)),
+            "min_fill"  : Out (range(depth + 1), init=depth),
+            "max_fill"  : Out (range(depth + 1)),
+            "clear"     : In  (1),
+            "underruns" : Out (counter_width),
+            "overruns"  : Out (counter_width),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.memory = memory = Memory(shape=self.bit_depth * self.channels, depth=self.depth, init=[])
+        w_port = memory.write_port()
+        r_port = memory.read_port(transparent_for=(w_port,))
+
+        def increment(address):
+            return Mux(address == self.depth - 1, 0, address + 1)
+
+
+        # - write --
+
+        w_addr = Signal(range(self.depth))
+        frame  = Cat(input.valid for input in self.inputs).all()
+        full   = self.fill == self.depth
+        push   = Signal()
+
+        m.d.comb += [input.ready.eq(frame) for input in self.inputs]
+        m.d.comb += [
+            push         .eq(frame & ~full),
+            w_port.addr  .eq(w_addr),
+            w_port.data  .eq(Cat(input.payload for input in self.inputs)),
+            w_port.en    .eq(push),
+        ]
+        with m.If(push):
+            m.d.sync += w_addr.eq(increment(w_addr))
+
+        _saturating_increment(m, self.overruns, frame & full, domain="sync")
+
+
+        # - read --
+
+        r_addr = Signal(range(self.depth))
+        empty  = ~Cat(output.valid for output in self.outputs).any()
+        free   = Cat(~output.valid | output.ready for output in self.outputs).all()
+        wanted = Cat(output.ready for output in self.outputs).all()
+        pop    = Signal()
+
+        # the frame at r_addr is on the read port a cycle after r_addr moves on to it
+        fresh  = Signal()
+        m.d.sync += fresh.eq(~pop)
+
+        m.d.comb += [
+            pop          .eq(self.running & free & fresh & (self.fill != 0)),
+            r_port.addr  .eq(r_addr),
+        ]
+
+        for n, output in enumerate(self.outputs):
+            with m.If(output.ready):
+                m.d.sync += output.valid.eq(0)
+
+        with m.If(pop):
+            m.d.sync += r_addr.eq(increment(r_addr))
+            for n, output in enumerate(self.outputs):
+                m.d.sync += [
+                    output.valid   .eq(1),
+                    output.payload .eq(r_port.data.word_select(n, self.bit_depth)),
+                ]
+
+
+        # - prefill --
+
+        with m.Switch(Cat(push, pop)):
+            with m.Case(0b01):
+                m.d.sync += self.fill.eq(self.fill + 1)
+            with m.Case(0b10):
+                m.d.sync += self.fill.eq(self.fill - 1)
+
+        underrun = self.running & empty & wanted & (self.fill == 0)
+        with m.If(~self.running & (self.fill >= self.target)):
+            m.d.sync += self.running.eq(1)
+        with m.Elif(underrun):
+            m.d.sync += self.running.eq(0)
+
+        _saturating_increment(m, self.underruns, underrun, domain="sync")
+
+
+        # - watermarks --
+
+        with m.If(self.clear):
+            m.d.sync += [
+                self.min_fill .eq(self.fill),
+                self.max_fill .eq(self.fill),
+            ]
+        with m.Elif(self.running):
+            with m.If(self.fill < self.min_fill):
+                m.d.sync += self.min_fill.eq(self.fill)
+            with m.If(self.fill > self.max_fill):
+                m.d.sync += self.max_fill.eq(self.fill)
+
+        return m
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(dut, cycles, packet_cycles, frames_per_packet, frame_cycles, jitter=0, seed=0,
+             produce=None, consume=None):
+    """ Feed a :class:`JitterBuffer` a packet of frames every ``packet_cycles``, each up to
+    ``jitter`` cycles late, and drain it a frame every ``frame_cycles``.
+
+    ``produce`` and ``consume`` optionally take a cycle and return whether the host sends
+    a packet, or the consumer takes a frame, then. Returns the frames sent and not dropped,
+    the frames received, the fill each cycle, the underrun and overrun counts, and the
+    fill watermarks.
+    """
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+
+    rng      = random.Random(seed)
+    now      = [0]
+    sent     = []
+    received = []
+    fills    = []
+    limit    = 1 << (dut.bit_depth - 1)
+
+    async def producer(ctx):
+        frame  = 0
+        packet = 0
+        while True:
+            start   = packet * packet_cycles + rng.randrange(jitter + 1)
+            packet += 1
+            while now[0] < start:
+                await ctx.tick()
+            if produce is not None and not produce(start):
+                continue
+            for _ in range(frames_per_packet):
+                samples  = [(frame * dut.channels + n) % (2 * limit) - limit for n in range(dut.channels)]
+                overruns = ctx.get(dut.overruns)
+                for input, sample in zip(dut.inputs, samples):
+                    ctx.set(input.valid,   1)
+                    ctx.set(input.payload, sample)
+                await ctx.tick()
+                if ctx.get(dut.overruns) == overruns:
+                    sent.append(samples)
+                frame += 1
+            for input in dut.inputs:
+                ctx.set(input.valid, 0)
+
+    async def consumer(ctx):
+        for now[0] in range(cycles):
+            active = now[0] % frame_cycles == 0 and (consume is None or consume(now[0]))
+            for output in dut.outputs:
+                ctx.set(output.ready, active)
+            if active and all(ctx.get(output.valid) for output in dut.outputs):
+                received.append([ctx.get(output.payload) for output in dut.outputs])
+            fills.append(ctx.get(dut.fill))
+            await ctx.tick()
+        counts.extend([ctx.get(dut.underruns), ctx.get(dut.overruns), ctx.get(dut.min_fill), ctx.get(dut.max_fill)])
+
+    counts = []
+    sim.add_testbench(producer, background=True)
+    sim.add_testbench(consumer)
+    sim.run()
+
+    return sent, received, fills, *counts
+
+
+if __name__ == "__main__":
+    bit_depth = 24
+    channels  = 2
+    depth     = 64
+    target    = 24
+
+    # a packet of 6 frames every 150 cycles, taken a frame every 25 cycles
+    packet_cycles, frames_per_packet, frame_cycles = 150, 6, 25
+    cycles = 40000
+
+    for name, kwargs in [
+        ("steady host",      {}),
+        ("jittery host",     {"jitter": 450}),
+        ("stalled host",     {"produce": lambda n: not 15000 <= n < 17000}),
+        ("stalled consumer", {"consume": lambda n: not 15000 <= n < 17000}),
+    ]:
+        dut = JitterBuffer(bit_depth, channels, depth=depth, target=target)
+        sent, received, fills, underruns, overruns, min_fill, max_fill = \
+            simulate(dut, cycles, packet_cycles, frames_per_packet, frame_cycles, **kwargs)
+        if received != sent[:len(received)]:
+            print(f"{name}: received frames don't match those sent")
+            sys.exit(1)
+        print(f"{name:16}: {len(received)} frames in order, fill {min_fill:2} to {max_fill:2} of {depth} "
+              f"for a target of {target}, {underruns} underruns, {overruns} overruns")
@@ -0,0 +1,236 @@
+import sys
+
+from amaranth             import *
+from amaranth.lib         import stream, wiring
+from amaranth.lib.wiring  import In, Out
+from amaranth.lib.memory  import Memory
+from amaranth.utils       import ceil_log2
+
+from amaranth.sim         import *
+
+from .stream              import _saturating_increment
+
+
+class Loopback(wiring.Component):
+    """ Loopback Delay Line
+
+    Returns each audio frame taken from the ``inputs`` on the ``outputs`` ``delay`` frames
+    later, which is to say that for every frame taken the frame from ``delay`` frames before
+    it is given back, or silence until there is one. Frames are taken once every input
+    has a sample for them, and a frame that hasn't been taken from the ``outputs`` by the
+    time the next is ready is overwritten, so that neither side can stall the other.
+    """
+
+    def __init__(self, bit_depth, channels, max_delay=1023):
+        self.bit_depth = bit_depth
+        self.channels  = channels
+        self.max_delay = max_delay
+
+        super().__init__({
+            "inputs"  : In  (stream.Signature(signed(bit_depth))).array(channels),
+            "outputs" : Out (stream.Signature(signed(bit_depth))).array(channels),
+            "delay"   : In  (range(max_delay + 1)),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        depth  = 1 << ceil_log2(self.max_delay + 1)
+
+        m.submodules.memory = memory = Memory(shape=self.bit_depth * self.channels, depth=depth, init=[])
+        w_port = memory.write_port()
+        r_port = memory.read_port(transparent_for=(w_port,))
+
+        # frames written, up to the longest delay
+        written = Signal(range(self.max_delay + 1))
+        w_addr  = Signal(range(depth))
+        frame   = Cat(input.valid for input in self.inputs).all()
+
+        m.d.comb += [input.ready.eq(frame) for input in self.inputs]
+        m.d.comb += [
+            w_port.addr  .eq(w_addr),
+            w_port.data  .eq(Cat(input.payload for input in self.inputs)),
+            w_port.en    .eq(frame),
+            r_port.addr  .eq(w_addr - self.delay),
+        ]
+
+        # the delayed frame is on the read port the cycle after its replacement is written
+        delayed = Signal()
+        silent  = Signal()
+        m.d.sync += [
+            delayed .eq(frame),
+            silent  .eq(written < self.delay),
+        ]
+        with m.If(frame):
+            m.d.sync += w_addr.eq(w_addr + 1)
+            with m.If(written != self.max_delay):
+                m.d.sync += written.eq(written + 1)
+
+        for n, output in enumerate(self.outputs):
+            with m.If(output.ready):
+                m.d.sync += output.valid.eq(0)
+            with m.If(delayed):
+                m.d.sync += [
+                    output.valid   .eq(1),
+                    output.payload .eq(Mux(silent, 0, r_port.data.word_select(n, self.bit_depth))),
+                ]
+
+        return m
+
+
+class LatencyProbe(wiring.Component):
+    """ Round-Trip Latency Probe
+
+    Watches samples leave the OUT path, on ``out_sample`` while ``out_stb`` is asserted,
+    and come back on the IN path, on ``in_sample`` and ``in_stb``, for a marker: a
+    sample whose magnitude is at least ``threshold`` after one that is below it.
+
+    Each marker is timestamped, as ``Cat(cycle, frame)`` where ``frame`` is the USB frame
+    and microframe number and ``cycle`` the cycles since its SOF, in ``out_time`` and
+    ``in_time``. ``latency`` is the number of cycles from the last marker to leave to
+    the marker coming back, and ``round_trips`` counts such returns.
+    """
+
+    def __init__(self, bit_depth, counter_width=16):
+        self.bit_depth = bit_depth
+
+        super().__init__({
+            "sof"         : In  (1),
+            "frame"       : In  (14),
+
+            "out_sample"  : In  (signed(bit_depth)),
+            "out_stb"     : In  (1),
+            "in_sample"   : In  (signed(bit_depth)),
+            "in_stb"      : In  (1),
+            "threshold"   : In  (bit_depth - 1, init=1 << (bit_depth - 2)),
+
+            "out_time"    : Out (32),
+            "in_time"     : Out (32),
+            "latency"     : Out (32),
+            "round_trips" : Out (counter_width),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # - timebase --
+
+        cycles    = Signal(32)
+        subframe  = Signal(32 - len(self.frame))
+        timestamp = Cat(subframe, self.frame)
+        m.d.sync += cycles.eq(cycles + 1)
+        with m.If(self.sof):
+            m.d.sync += subframe.eq(1)
+        with m.Elif(subframe != (1 << len(subframe)) - 1):
+            m.d.sync += subframe.eq(subframe + 1)
+
+
+        # - markers --
+
+        def marker(sample, stb):
+            """ Strobe on a sample at or above threshold following one below it. """
+            armed  = Signal()
+            above  = abs(sample) >= self.threshold
+            strobe = Signal()
+            with m.If(stb):
+                m.d.sync += armed.eq(~above)
+                m.d.comb += strobe.eq(armed & above)
+            return strobe
+
+        sent      = Signal()
+        sent_at   = Signal(32)
+
+        with m.If(marker(self.out_sample, self.out_stb)):
+            m.d.sync += [
+                self.out_time .eq(timestamp),
+                sent_at       .eq(cycles),
+                sent          .eq(1),
+            ]
+
+        returned = marker(self.in_sample, self.in_stb) & sent
+        with m.If(returned):
+            m.d.sync += [
+                self.in_time  .eq(timestamp),
+                self.latency  .eq(cycles - sent_at),
+            ]
+        _saturating_increment(m, self.round_trips, returned, domain="sync")
+
+        return m
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(bit_depth, channels, delay, frame_cycles, frames, markers, sof_cycles=7500):
+    """ Loop frames, a frame every ``frame_cycles``, through a :class:`Loopback` of ``delay``
+    frames, with a full scale marker in the frames listed in ``markers``, and report the
+    ``out_time``, ``in_time`` and ``latency`` measured by a :class:`LatencyProbe` for each.
+    """
+
+    m = Module()
+    m.submodules.loopback = loopback = Loopback(bit_depth, channels, max_delay=max(delay, 1))
+    m.submodules.probe    = probe    = LatencyProbe(bit_depth)
+    m.d.comb += [
+        probe.out_sample  .eq(loopback.inputs[0].payload),
+        probe.out_stb     .eq(loopback.inputs[0].valid & loopback.inputs[0].ready),
+        probe.in_sample   .eq(loopback.outputs[0].payload),
+        probe.in_stb      .eq(loopback.outputs[0].valid & loopback.outputs[0].ready),
+    ]
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+
+    measured = []
+
+    async def testbench(ctx):
+        ctx.set(loopback.delay, delay)
+        for output in loopback.outputs:
+            ctx.set(output.ready, 1)
+
+        round_trips = 0
+        for cycle in range(frames * frame_cycles + (delay + 2) * frame_cycles):
+            ctx.set(probe.sof,   cycle % sof_cycles == 0)
+            ctx.set(probe.frame, (cycle // sof_cycles) % (1 << 14))
+
+            frame = cycle // frame_cycles
+            valid = cycle % frame_cycles == 0 and frame < frames
+            for input in loopback.inputs:
+                ctx.set(input.valid,   valid)
+                ctx.set(input.payload, (1 << (bit_depth - 1)) - 1 if frame in markers else 0)
+
+            await ctx.tick()
+
+            if ctx.get(probe.round_trips) != round_trips:
+                round_trips = ctx.get(probe.round_trips)
+                measured.append((ctx.get(probe.out_time), ctx.get(probe.in_time), ctx.get(probe.latency)))
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return measured
+
+
+if __name__ == "__main__":
+    bit_depth    = 24
+    channels     = 2
+    frame_cycles = 1250 # 48 kHz at 60 MHz
+    sof_cycles   = 7500
+
+    for delay in [0, 1, 7]:
+        markers  = [3, 20]
+        measured = simulate(bit_depth, channels, delay, frame_cycles, 30, markers, sof_cycles)
+
+        # the marker comes back two cycles after `delay` frames
+        expected = []
+        for marker in markers:
+            out_cycle = marker * frame_cycles
+            in_cycle  = (marker + delay) * frame_cycles + 2
+            expected.append((
+                (out_cycle // sof_cycles) << 18 | (out_cycle % sof_cycles),
+                (in_cycle  // sof_cycles) << 18 | (in_cycle  % sof_cycles),
+                in_cycle - out_cycle,
+            ))
+        if measured != expected:
+            print(f"delay {delay}: measured {measured}, expected {expected}")
+            sys.exit(1)
+        print(f"delay {delay}: round trip of {measured[0][2]} cycles, {delay} frames and "
+              f"{measured[0][2] - delay * frame_cycles} cycles of gateware")
@@ -0,0 +1,338 @@
+import random
+import sys
+
+from amaranth             import *
+from amaranth.lib         import stream, wiring
+from amaranth.lib.fifo    import SyncFIFOBuffered
+from amaranth.lib.wiring  import In, Out
+from amaranth.lib.memory  import Memory
+from amaranth.utils       import ceil_log2
+
+from amaranth.sim         import *
+
+
+class Mixer(wiring.Component):
+    """ Routing Matrix Mixer
+
+    Mixes frames of ``inputs`` channels into frames of ``outputs`` channels, each output
+    the sum of every input scaled by the gain at their crosspoint, saturated to full scale.
+    Gains are fixed point, with unity at ``2**(gain_bits - 2)``, for a range of -2 to 2,
+    and are held in a memory of ``inputs * outputs`` crosspoints, the gain from input
+    ``i`` to output ``o`` at ``o * inputs + i``. They start at ``gains``, a list of
+    each output's input gains, or with each input routed to the output of the same
+    number, and may be read and written at ``gain_addr`` while mixing.
+
+    Crosspoints are summed one at a time through a single multiplier, a cycle each.
+    A frame is taken once every input in ``inputs_active`` has a sample for it, the
+    others being silent, and every output in ``outputs_paced`` is free for its mix.
+    Other outputs' mixes are overwritten if they haven't been taken by the time the
+    next is ready, so that their consumers can't stall the mixer.
+    """
+
+    def __init__(self, bit_depth, inputs, outputs, gains=None, gain_bits=18):
+        self.bit_depth = bit_depth
+        self.gain_bits = gain_bits
+
+        unity = 1 << (gain_bits - 2)
+        if gains is None:
+            gains = [[1.0 if i == o else 0.0 for i in range(inputs)] for o in range(outputs)]
+        if len(gains) != outputs or any(len(row) != inputs for row in gains):
+            raise ValueError(f"gains must be a list of {outputs} outputs' gains for {inputs} inputs, not {gains}")
+        if any(not -2 <= gain < 2 for row in gains for gain in row):
+            raise ValueError(f"gains must be from -2 to 2, not {gains}")
+        self.gains = [round(gain * unity) for row in gains for gain in row]
+
+        super().__init__({
+            "inputs"        : In  (stream.Signature(signed(bit_depth))).array(inputs),
+            "outputs"       : Out (stream.Signature(signed(bit_depth))).array(outputs),
+            "inputs_active" : In  (inputs,  init=(1 << inputs) - 1),
+            "outputs_paced" : In  (outputs, init=(1 << outputs) - 1),
+
+            # crosspoint gains
+            "gain_addr"     : In  (range(inputs * outputs)),
+            "gain_r_data"   : Out (signed(gain_bits)),
+            "gain_w_data"   : In  (signed(gain_bits)),
+            "gain_w_en"     : In  (1),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        inputs  = len(self.inputs)
+        outputs = len(self.outputs)
+
+        m.submodules.memory = memory = Memory(shape=signed(self.gain_bits), depth=inputs * outputs, init=self.gains)
+        w_port = memory.write_port()
+        r_port = memory.read_port()
+        h_port = memory.read_port()
+
+        m.d.comb += [
+            w_port.addr       .eq(self.gain_addr),
+            w_port.data       .eq(self.gain_w_data),
+            w_port.en         .eq(self.gain_w_en),
+            h_port.addr       .eq(self.gain_addr),
+            self.gain_r_data  .eq(h_port.data),
+        ]
+
+
+        # - frames --
+
+        samples = Array(Signal(signed(self.bit_depth), name=f"sample_{n}") for n in range(inputs))
+        ready   = Cat(input.valid | ~active for input, active in zip(self.inputs, self.inputs_active)).all() & \
+                  Cat(~output.valid | output.ready | ~paced for output, paced in zip(self.outputs, self.outputs_paced)).all()
+
+        for output in self.outputs:
+            with m.If(output.ready):
+                m.d.sync += output.valid.eq(0)
+
+
+        # - mixing --
+
+        # the crosspoint being summed, from a source input to a destination output, and its gain's address
+        source      = Signal(range(inputs))
+        destination = Signal(range(outputs))
+        crosspoint  = Signal(range(inputs * outputs))
+        accumulator = Signal(signed(self.bit_depth + self.gain_bits + ceil_log2(inputs)))
+        total       = Signal.like(accumulator)
+        mix         = Signal(signed(self.bit_depth))
+
+        full_scale  = (1 << (self.bit_depth - 1)) - 1
+        m.d.comb += [
+            total .eq((accumulator + samples[source] * r_port.data) >> (self.gain_bits - 2)),
+            mix   .eq(Mux(total > full_scale, full_scale, Mux(total < -full_scale - 1, -full_scale - 1, total))),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                # take a frame, with silence for any inactive inputs, and fetch the first gain
+                with m.If(ready):
+                    for n, (input, active) in enumerate(zip(self.inputs, self.inputs_active)):
+                        m.d.comb += input.ready.eq(active)
+                        m.d.sync += samples[n].eq(Mux(active, input.payload, 0))
+                    m.d.comb += r_port.addr.eq(0)
+                    m.d.sync += [
+                        source      .eq(0),
+                        destination .eq(0),
+                        crosspoint  .eq(0),
+                        accumulator .eq(0),
+                    ]
+                    m.next = "MIX"
+
+            with m.State("MIX"):
+                # sum each crosspoint, fetching the next one's gain
+                m.d.comb += r_port.addr.eq(crosspoint + 1)
+                m.d.sync += [
+                    crosspoint  .eq(crosspoint + 1),
+                    accumulator .eq(accumulator + samples[source] * r_port.data),
+                    source      .eq(source + 1),
+                ]
+
+                # ... until an output's mix is complete
+                with m.If(source == inputs - 1):
+                    for n, output in enumerate(self.outputs):
+                        with m.If(destination == n):
+                            m.d.sync += [
+                                output.valid   .eq(1),
+                                output.payload .eq(mix),
+                            ]
+                    m.d.sync += [
+                        source      .eq(0),
+                        destination .eq(destination + 1),
+                        accumulator .eq(0),
+                    ]
+                    with m.If(destination == outputs - 1):
+                        m.next = "IDLE"
+
+        return m
+
+
+# - model ---------------------------------------------------------------------
+
+def mixer_model(mixer, frames, gains=None):
+    """ Bit-exact model of a :class:`Mixer`, mixing each frame with its gains, or their initial values. """
+    inputs     = len(mixer.inputs)
+    full_scale = (1 << (mixer.bit_depth - 1)) - 1
+
+    mixes = []
+    for frame, frame_gains in zip(frames, gains or [mixer.gains] * len(frames)):
+        mix = []
+        for o in range(len(mixer.outputs)):
+            total = sum(sample * frame_gains[o * inputs + i] for i, sample in enumerate(frame)) >> (mixer.gain_bits - 2)
+            mix.append(min(max(total, -full_scale - 1), full_scale))
+        mixes.append(mix)
+
+    return mixes
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(dut, frames, writes=None):
+    """ Collect each frame's mix from a :class:`Mixer` simulation, writing each frame's
+    ``writes``, a dictionary of crosspoint gains, before it. Returns the mixes, and the
+    cycles from taking the first frame to its last output's mix. """
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+
+    mixes   = []
+    latency = []
+
+    async def testbench(ctx):
+        for output in dut.outputs:
+            ctx.set(output.ready, 1)
+
+        for n, frame in enumerate(frames):
+            for crosspoint, gain in (writes[n] if writes else {}).items():
+                ctx.set(dut.gain_addr,   crosspoint)
+                ctx.set(dut.gain_w_data, gain)
+                ctx.set(dut.gain_w_en,   1)
+                await ctx.tick()
+            ctx.set(dut.gain_w_en, 0)
+
+            for input, sample in zip(dut.inputs, frame):
+                ctx.set(input.valid,   1)
+                ctx.set(input.payload, sample)
+
+            mix    = {}
+            cycles = 0
+            while len(mix) < len(dut.outputs):
+                for o, output in enumerate(dut.outputs):
+                    if ctx.get(output.valid):
+                        mix[o] = ctx.get(output.payload)
+                taken = ctx.get(dut.inputs[0].ready)
+                await ctx.tick()
+                cycles += 1
+                if taken:
+                    cycles = 0
+                    for input in dut.inputs:
+                        ctx.set(input.valid, 0)
+            mixes.append([mix[o] for o in range(len(dut.outputs))])
+            latency.append(cycles)
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return mixes, latency[0]
+
+
+def simulate_recording(dut, channels, depth, packets, packet_frames, packet_gap, playing=False):
+    """ Collect the frames a :class:`Mixer` sends the host, as in ``Top``: from its first
+    ``channels`` inputs, the host's, and the rest, the oscillators', which are always ready,
+    to its first ``channels`` outputs, the ∆Σ DAC's, and the rest, the host's, through FIFOs
+    of ``depth`` frames into a :class:`SamplesToUAC2Stream`. The serializer takes ``packets``
+    packets of ``packet_frames`` frames, ``packet_gap`` cycles apart, the first once the FIFOs
+    have filled. The host's inputs are only active, and the DAC's outputs paced, if ``playing``.
+    Returns the frames of samples sent. """
+
+    from .stream import SamplesToUAC2Stream
+
+    m = Module()
+    m.domains.usb = ClockDomain()
+    m.submodules.mixer      = mixer      = DomainRenamer({"sync": "usb"})(dut)
+    m.submodules.serializer = serializer = SamplesToUAC2Stream(dut.bit_depth, channels, 4)
+    m.d.comb += [
+        mixer.inputs_active .eq(Cat(C(playing).replicate(channels), C(1).replicate(channels))),
+        mixer.outputs_paced .eq(Cat(C(playing).replicate(channels), C(1).replicate(channels))),
+    ]
+    for n in range(channels):
+        m.submodules[f"fifo{n}"] = fifo = DomainRenamer({"sync": "usb"})(SyncFIFOBuffered(width=dut.bit_depth, depth=depth))
+        output = mixer.outputs[channels + n]
+        input  = serializer.inputs[n]
+        m.d.comb += [
+            fifo.w_data    .eq(output.payload),
+            fifo.w_en      .eq(output.valid),
+            output.ready   .eq(fifo.w_rdy),
+            input.valid    .eq(fifo.r_rdy),
+            input.payload  .eq(fifo.r_data),
+            fifo.r_en      .eq(input.ready),
+        ]
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6, domain="usb")
+
+    sent = []
+
+    async def testbench(ctx):
+        # count samples up on every input, distinctly for each
+        counts = [0] * len(dut.inputs)
+        for n, input in enumerate(dut.inputs):
+            ctx.set(input.valid,   1)
+            ctx.set(input.payload, n + 1)
+        for output in dut.outputs[:channels]:
+            ctx.set(output.ready, 1)
+
+        packet_bytes = packet_frames * channels * 4
+        subslots     = []
+        cycle        = 0
+        start        = depth * (len(dut.inputs) * len(dut.outputs) + 1)
+        while len(subslots) < packets * packet_bytes:
+            in_packet = (cycle >= start) and (cycle - start) % packet_gap < packet_bytes
+            ctx.set(serializer.output.ready, in_packet)
+
+            if in_packet:
+                subslots.append(ctx.get(serializer.output.payload))
+            taken = [ctx.get(input.ready) for input in dut.inputs]
+
+            await ctx.tick("usb")
+            cycle += 1
+
+            for n, (input, ready) in enumerate(zip(dut.inputs, taken)):
+                if ready:
+                    counts[n] += 1
+                    ctx.set(input.payload, counts[n] * len(dut.inputs) + n + 1)
+
+        # each subslot's top three bytes are a sample
+        samples = [int.from_bytes(bytes(subslots[k + 1:k + 4]), "little", signed=True)
+                   for k in range(0, len(subslots), 4)]
+        sent.extend(samples[k:k + channels] for k in range(0, len(samples), channels))
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return sent
+
+
+if __name__ == "__main__":
+    bit_depth = 24
+    inputs    = 4
+    outputs   = 4
+    frames    = 200
+
+    # random gains and loud random frames, which sometimes saturate
+    rng   = random.Random(0)
+    limit = 1 << (bit_depth - 1)
+    dut   = Mixer(bit_depth, inputs, outputs, gains=[[rng.uniform(-1, 1) for _ in range(inputs)] for _ in range(outputs)])
+    mix   = [[rng.randrange(-limit, limit) for _ in range(inputs)] for _ in range(frames)]
+
+    # rewrite a crosspoint every tenth frame
+    unity  = 1 << (dut.gain_bits - 2)
+    writes = [{rng.randrange(inputs * outputs): rng.randrange(-2 * unity, 2 * unity)} if n % 10 == 0 else {}
+              for n in range(frames)]
+    gains  = []
+    for frame_writes in writes:
+        gains.append(list(gains[-1] if gains else dut.gains))
+        for crosspoint, gain in frame_writes.items():
+            gains[-1][crosspoint] = gain
+
+    mixes, latency = simulate(dut, mix, writes)
+    if mixes != mixer_model(dut, mix, gains):
+        print("gateware doesn't match model")
+        sys.exit(1)
+    saturated = sum(abs(sample) >= limit - 1 for mix in mixes for sample in mix)
+    print(f"gateware matches model over {frames} frames of {inputs} x {outputs}, with {saturated} saturated samples")
+    print(f"frames mixed in {latency} cycles, {inputs * outputs} crosspoints through one multiplier")
+
+    # every frame of the oscillators, routed to the host, reaches it without silence, recording
+    # alone and while playing, for packets of the most frames at 48 kHz through FIFOs of two packets
+    channels      = 2
+    packet_frames = 7
+    for playing in [False, True]:
+        dut      = Mixer(bit_depth, 2 * channels, 2 * channels)
+        sent     = simulate_recording(dut, channels, 2 * packet_frames, packets=8, packet_frames=packet_frames,
+                                      packet_gap=200, playing=playing)
+        expected = [[n * 2 * channels + channels + k + 1 for k in range(channels)] for n in range(len(sent))]
+        if sent != expected:
+            print(f"frames mixed for the host aren't all sent to it {'while playing' if playing else 'recording alone'}")
+            sys.exit(1)
+        print(f"{'playing and recording' if playing else 'recording alone':21}: "
+              f"all {len(sent)} frames mixed for the host are sent to it, without silence")
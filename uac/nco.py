@@ -1,4 +1,10 @@
+import hashlib
+import logging
 import math
+import os
+import sys
+
+import numpy as np
 
 from amaranth             import *
 from amaranth.lib         import stream, wiring
@@ -13,45 +19,125 @@ from amaranth.sim         import *
 
 TAU = math.pi * 2.
 
+# bump to invalidate cached tables whenever sinusoid_lut changes its output
+LUT_VERSION = 1
+
+# where generated tables are kept, override with UAC_LUT_CACHE or disable with UAC_LUT_CACHE=""
+LUT_CACHE = os.environ.get("UAC_LUT_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "cynthion-uac", "lut"))
+
 def fsin(x, fs, phi=0):
     T = 1.0 / float(fs)
     w = TAU
-    return math.cos(w * x * T + phi)
+    return np.cos(w * x * T + phi)
+
+def sinusoid_lut(bit_depth, length, gain=1.0, signed=False, quarter=False, dither=False, clip=True):
+    """ Generate a sinusoid lookup table.
+
+    With ``quarter`` set the table holds just the first quarter of a sine wave,
+    sampled half a step off zero so that the remaining quarters are exact mirror
+    images of it. The table must then be ``signed``.
+
+    Values are truncated to integers, or with ``dither`` set rounded after adding
+    triangular dither of +/-1 LSB from a generator seeded with ``dither``, so tables
+    are reproducible. Values outside of the range of ``bit_depth`` are clipped, or
+    with ``clip`` unset raise a ``ValueError``.
+
+    Tables are cached on disk in ``LUT_CACHE``, keyed on a hash of their parameters.
+    """
+    if quarter and not signed:
+        raise ValueError("quarter-wave lookup tables must be signed")
 
-def sinusoid_lut(bit_depth, length, gain=1.0, signed=False):
+    params = (LUT_VERSION, bit_depth, length, float(gain), signed, quarter, int(dither), clip)
+    key    = hashlib.sha256(repr(params).encode()).hexdigest()
+    path   = os.path.join(LUT_CACHE, f"{key}.npy") if LUT_CACHE else None
+
+    if path is not None and os.path.exists(path):
+        try:
+            return np.load(path).tolist()
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable lut cache entry {path}: {e}")
+
+    ys = _sinusoid(bit_depth, length, gain, signed, quarter, dither, clip)
+
+    if path is not None:
+        try:
+            os.makedirs(LUT_CACHE, exist_ok=True)
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, "wb") as f:
+                np.save(f, ys)
+            os.replace(temporary, path)
+        except OSError as e:
+            logging.warning(f"Could not cache lut in {LUT_CACHE}: {e}")
+
+    return ys.tolist()
+
+def _sinusoid(bit_depth, length, gain, signed, quarter, dither, clip):
+    """ Compute a sinusoid lookup table, see :func:`sinusoid_lut`. """
     fs = length
     scale = math.pow(2, bit_depth) - 1
 
-    ys = [fsin(x, fs) for x in range(int(fs))]
+    x = np.arange(int(fs), dtype=np.float64)
+    if quarter:
+        ys = np.sin((x + 0.5) * TAU / (4 * fs))
+    else:
+        ys = fsin(x, fs)
 
     # scale signal to integer range
-    ys = [y * (scale/2) for y in ys]
+    ys = ys * (scale/2)
 
     # optional: convert to unsigned
     if not signed:
-        ys = [y + (scale/2) for y in ys]
+        ys = ys + (scale/2)
 
     # signal gain
-    ys = [y * gain for y in ys]
+    ys = ys * gain
 
     # convert to integer
-    ys = [int(y) for y in ys]
+    if dither:
+        rng = np.random.default_rng(int(dither))
+        ys  = np.round(ys + rng.uniform(-0.5, 0.5, ys.shape) + rng.uniform(-0.5, 0.5, ys.shape))
+    else:
+        ys = np.trunc(ys)
+
+    # keep within range
+    lo, hi = (-(1 << (bit_depth - 1)), (1 << (bit_depth - 1)) - 1) if signed else (0, (1 << bit_depth) - 1)
+    if clip:
+        ys = np.clip(ys, lo, hi)
+    elif ys.min() < lo or ys.max() > hi:
+        raise ValueError(f"sinusoid with gain {gain} does not fit in {bit_depth} bits")
 
-    return ys
+    return ys.astype(np.int64)
 
 
 # - gateware ------------------------------------------------------------------
 
 class NCO(wiring.Component):
-    def __init__(self, lut, twos_complement=False):
+    """ Numerically Controlled Oscillator
+
+    Each sample is linearly interpolated between the two lookup table entries either
+    side of the phase accumulator, weighted by the ``frac_bits`` phase bits below the
+    table index. Both entries are fetched through a single synchronous read port, so
+    a sample takes three cycles to produce, the next sample's entries being fetched
+    while the last is waiting to be taken.
+
+    With ``quarter`` set, ``lut`` holds a quarter wave as generated by
+    ``sinusoid_lut(..., quarter=True)`` and the other three quarters are derived
+    from it by symmetry, making for a table four times the size in the same memory.
+    """
+
+    def __init__(self, lut, twos_complement=False, quarter=False, frac_bits=16):
         # create a read port for the lut
-        self.read_port0 = lut.read_port(domain="comb")
-        self.read_port1 = lut.read_port(domain="comb")
+        self.read_port  = lut.read_port()
+        self.quarter    = quarter
 
         # calculate accumulator parameters
         self.phi_bits   = 32
         self.phi_tau    = 1 << self.phi_bits
-        self.index_bits = log2_int(lut.depth)
+        self.index_bits = log2_int(lut.depth) + (2 if quarter else 0)
+        self.frac_bits  = min(frac_bits, self.phi_bits - self.index_bits)
+
+        if quarter and not lut.shape.signed:
+            raise ValueError("quarter-wave lookup tables must be signed")
 
         super().__init__({
             "phi_delta" : In  (signed(self.phi_bits)), # frequency (in terms of phi_tau)
@@ -62,29 +148,186 @@ class NCO(wiring.Component):
         m = Module()
 
         stream = self.output
+        shape  = stream.payload.shape()
 
         # accumulator
-        phi = Signal(self.phi_bits)
+        phi  = Signal(self.phi_bits)
 
-        # lut indices for current and next sample
-        index0 = Signal(self.index_bits)
+        # lut indices for the entries either side of the current phase, and the distance between them
+        index0 = phi[-self.index_bits:]
         index1 = Signal(self.index_bits)
+        frac   = phi[-self.index_bits - self.frac_bits:-self.index_bits]
+        m.d.comb += index1.eq(index0 + 1)
+
+        # the lut entries, as they are read back
+        y0     = Signal(shape)
+        y1     = Signal(shape)
 
-        # connect stream to lut
-        m.d.comb += [
-            self.read_port0.addr .eq(index0),
-            self.read_port1.addr .eq(index1),
-            stream.valid         .eq(1), # driven by producer (us)
-            stream.payload       .eq((self.read_port0.data + self.read_port1.data) >> 1),
-        ]
+        # the quadrant of the lut entry being read, as it is read back
+        negate = Signal()
 
-        # for each sample
         with m.If(stream.ready):
-            # increment phase and update lut indices
-            m.d.sync += [
-                phi.eq(phi + self.phi_delta),
-                index0.eq(phi[-self.index_bits:]),
-                index1.eq(index0 + 1),
-            ]
+            m.d.sync += stream.valid.eq(0)
+
+        with m.FSM():
+            with m.State("Y0"):
+                m.d.comb += self.read_port.addr.eq(_lut_address(index0, self.quarter))
+                m.d.sync += negate.eq(_lut_negate(index0, self.quarter))
+                m.next = "Y1"
+
+            with m.State("Y1"):
+                m.d.comb += self.read_port.addr.eq(_lut_address(index1, self.quarter))
+                m.d.sync += [
+                    y0      .eq(Mux(negate, -self.read_port.data, self.read_port.data)),
+                    negate  .eq(_lut_negate(index1, self.quarter)),
+                ]
+                m.next = "INTERPOLATE"
+
+            with m.State("INTERPOLATE"):
+                # hold the read port on y1 until the last sample has been taken, then for each
+                # sample, increment phase and start on the next one
+                m.d.comb += [
+                    self.read_port.addr .eq(_lut_address(index1, self.quarter)),
+                    y1                  .eq(Mux(negate, -self.read_port.data, self.read_port.data)),
+                ]
+                with m.If(~stream.valid | stream.ready):
+                    m.d.sync += [
+                        stream.valid    .eq(1),
+                        stream.payload  .eq(y0 + (((y1 - y0) * frac) >> self.frac_bits)),
+                        phi             .eq(phi + self.phi_delta),
+                    ]
+                    m.next = "Y0"
 
         return m
+
+
+def _lut_address(index, quarter):
+    """ Map a full-wave table index to a lut address. """
+    if not quarter:
+        return index
+
+    # the second and fourth quarters are the first and third reversed
+    address = index[:-2]
+    return Mux(index[-2], ~address, address)
+
+
+def _lut_negate(index, quarter):
+    """ Is the lut entry at a full-wave table index to be negated? """
+    if not quarter:
+        return C(0)
+
+    # the second half of the wave is the first half negated
+    return index[-1]
+
+
+# - model ---------------------------------------------------------------------
+
+def nco_model(lut, phi_delta, length, quarter=False, frac_bits=16, phi_bits=32):
+    """ Bit-exact model of :class:`NCO`, returning ``length`` samples. """
+
+    depth      = len(lut)
+    index_bits = log2_int(depth) + (2 if quarter else 0)
+    frac_bits  = min(frac_bits, phi_bits - index_bits)
+
+    def entry(index):
+        index %= 1 << index_bits
+        if not quarter:
+            return lut[index]
+        address = index % depth
+        if (index // depth) % 2:
+            address = depth - 1 - address
+        return -lut[address] if index >= 2 * depth else lut[address]
+
+    samples = []
+    phi = 0
+    for _ in range(length):
+        index = phi >> (phi_bits - index_bits)
+        frac  = (phi >> (phi_bits - index_bits - frac_bits)) & ((1 << frac_bits) - 1)
+        y0    = entry(index)
+        y1    = entry(index + 1)
+        samples.append(y0 + (((y1 - y0) * frac) >> frac_bits))
+        phi = (phi + phi_delta) % (1 << phi_bits)
+
+    return samples
+
+
+def sfdr(samples):
+    """ Spurious-free dynamic range of a sinusoid, in dBc.
+
+    The sinusoid must complete a whole number of cycles over ``samples``, so that
+    its spectrum needs no window.
+    """
+    samples  = np.asarray(samples, dtype=np.float64)
+    spectrum = np.abs(np.fft.rfft(samples - samples.mean()))
+
+    carrier  = int(np.argmax(spectrum))
+    spurs    = np.delete(spectrum, carrier)
+
+    return 20 * math.log10(spectrum[carrier] / spurs.max())
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(lut, phi_delta, length, quarter=False, frac_bits=16, ready=None):
+    """ Collect ``length`` samples from an :class:`NCO` simulation, with its output ready on
+    the cycles ``ready`` returns true for, or every cycle. Returns the samples, and the cycles
+    taken to produce them. """
+
+    m = Module()
+    m.submodules.lut = lut
+    m.submodules.dut = dut = NCO(lut, quarter=quarter, frac_bits=frac_bits)
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+
+    samples = []
+    cycles  = []
+
+    async def testbench(ctx):
+        ctx.set(dut.phi_delta, phi_delta)
+        cycle = 0
+        while len(samples) < length:
+            ctx.set(dut.output.ready, ready is None or ready(cycle))
+            if ctx.get(dut.output.valid) and ctx.get(dut.output.ready):
+                samples.append(ctx.get(dut.output.payload))
+            await ctx.tick()
+            cycle += 1
+        cycles.append(cycle)
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return samples, cycles[0]
+
+
+if __name__ == "__main__":
+    bit_depth   = 24
+    sample_rate = 48000
+    frequency   = 1000.
+
+    # ~1 kHz, completing a whole, odd, number of cycles every 2^16 samples
+    cycles      = int(frequency * (1 << 16) / sample_rate) | 1
+    phi_delta   = cycles << 16
+
+    # check the gateware against the model, with its output always ready, and stalling
+    length  = 256
+    table   = sinusoid_lut(bit_depth, length, signed=True, quarter=True)
+    model   = nco_model(table, phi_delta, 1024, quarter=True)
+    samples, taken  = simulate(Memory(shape=signed(bit_depth), depth=length, init=table), phi_delta, 1024,
+                               quarter=True)
+    stalled, _      = simulate(Memory(shape=signed(bit_depth), depth=length, init=table), phi_delta, 1024,
+                               quarter=True, ready=lambda cycle: cycle % 7 < 2)
+    if samples != model or stalled != model:
+        print("gateware doesn't match model")
+        sys.exit(1)
+    if taken > 3 * len(samples) + 1:
+        print(f"gateware takes {taken} cycles for {len(samples)} samples, more than 3 each")
+        sys.exit(1)
+    print(f"gateware matches model over {len(samples)} samples, produced in {taken} cycles")
+
+    # compare spurious-free dynamic range of a full-wave and quarter-wave table of the same size
+    for quarter in [False, True]:
+        for frac_bits in [0, 16]:
+            table = sinusoid_lut(bit_depth, length, signed=True, quarter=quarter)
+            dbc   = sfdr(nco_model(table, phi_delta, 1 << 16, quarter=quarter, frac_bits=frac_bits))
+            print(f"{'quarter' if quarter else 'full'}-wave {length} entry lut, {frac_bits:2} fractional bits: SFDR {dbc:6.1f} dBc")
@@ -0,0 +1,331 @@
+import sys
+
+from amaranth             import *
+from amaranth.lib         import data, stream, wiring
+from amaranth.lib.fifo    import SyncFIFOBuffered
+from amaranth.lib.wiring  import In, Out
+from amaranth.lib.memory  import Memory
+from amaranth.utils       import log2_int, bits_for
+
+from amaranth.sim         import *
+
+from .nco                 import _lut_address, _lut_negate, nco_model, sinusoid_lut
+
+
+class NCOBank(wiring.Component):
+    """ Time-multiplexed bank of Numerically Controlled Oscillators
+
+    Serves ``oscillators`` phase accumulators in turn through a single read port on
+    ``lut``, two cycles per oscillator. Each oscillator is interpolated as by
+    :class:`NCO`, scaled by its ``amplitude`` -- a fraction of ``2**amplitude_bits`` --
+    and summed into the output selected by its ``route``. Sums are clipped to the
+    range of ``lut.shape``.
+
+    Oscillators keep a ``phi_delta`` for each of ``rates`` sample rates, ``rate``
+    selecting between them. Their settings may be given up front as ``phi_deltas``
+    (a list of per-rate lists, or of ints if there is only one rate), ``amplitudes``
+    and ``routes``, and changed at run time through the ``w_*`` ports.
+
+    Frames are produced ahead of demand into a FIFO of ``fifo_depth`` samples per
+    output, so a bank takes ``2 * oscillators`` cycles per frame on average but
+    can be drained a whole packet at a time.
+    """
+
+    def __init__(self, lut, oscillators, outputs, rates=1, quarter=False, frac_bits=16, amplitude_bits=16,
+                 phi_deltas=None, amplitudes=None, routes=None, fifo_depth=64):
+        if not lut.shape.signed:
+            raise ValueError("oscillator banks need a signed lookup table")
+
+        # create a read port for the lut
+        self.read_port      = lut.read_port()
+        self.quarter        = quarter
+
+        self.oscillators    = oscillators
+        self.rates          = rates
+        self.amplitude_bits = amplitude_bits
+        self.fifo_depth     = fifo_depth
+
+        # calculate accumulator parameters
+        self.phi_bits       = 32
+        self.phi_tau        = 1 << self.phi_bits
+        self.index_bits     = log2_int(lut.depth) + (2 if quarter else 0)
+        self.frac_bits      = min(frac_bits, self.phi_bits - self.index_bits)
+
+        # oscillator settings
+        phi_deltas = phi_deltas or [0] * oscillators
+        phi_deltas = [delta if isinstance(delta, (list, tuple)) else [delta] * rates for delta in phi_deltas]
+        self.phi_deltas = [phi_deltas[n][rate] for rate in range(rates) for n in range(oscillators)]
+        self.settings   = data.StructLayout({
+            "amplitude" : unsigned(amplitude_bits),
+            "route"     : range(outputs),
+        })
+        self.settings_init = [
+            {"amplitude": amplitude, "route": route}
+            for amplitude, route in zip(amplitudes or [0] * oscillators, routes or [0] * oscillators)
+        ]
+
+        super().__init__({
+            "outputs"     : Out (stream.Signature(lut.shape)).array(outputs),
+            "rate"        : In  (range(rates)),
+
+            # runtime oscillator settings, written while w_en is asserted
+            "w_en"        : In  (1),
+            "w_index"     : In  (range(oscillators)),
+            "w_rate"      : In  (range(rates)),
+            "w_phi_delta" : In  (signed(self.phi_bits)),
+            "w_settings"  : In  (self.settings),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        shape = self.read_port.data.shape()
+        n     = self.oscillators
+
+        # - oscillator state and settings --
+
+        m.submodules.phases = phases = Memory(shape=unsigned(self.phi_bits), depth=n, init=[])
+        m.submodules.deltas = deltas = Memory(shape=signed(self.phi_bits), depth=n * self.rates, init=self.phi_deltas)
+        m.submodules.settings = settings = Memory(shape=self.settings, depth=n, init=self.settings_init)
+
+        phases_r   = phases.read_port()
+        phases_w   = phases.write_port()
+        deltas_r   = deltas.read_port()
+        deltas_w   = deltas.write_port()
+        settings_r = settings.read_port()
+        settings_w = settings.write_port()
+
+        m.d.comb += [
+            deltas_w.addr    .eq(self.w_rate * n + self.w_index),
+            deltas_w.data    .eq(self.w_phi_delta),
+            deltas_w.en      .eq(self.w_en),
+            settings_w.addr  .eq(self.w_index),
+            settings_w.data  .eq(self.w_settings),
+            settings_w.en    .eq(self.w_en),
+        ]
+
+
+        # - output fifos --
+
+        fifos = []
+        for channel, output in enumerate(self.outputs):
+            fifo = SyncFIFOBuffered(width=shape.width, depth=self.fifo_depth)
+            m.submodules[f"fifo{channel}"] = fifo
+            m.d.comb += [
+                output.valid    .eq(fifo.r_rdy),
+                output.payload  .eq(fifo.r_data),
+                fifo.r_en       .eq(output.ready),
+            ]
+            fifos.append(fifo)
+
+
+        # - sequencer --
+
+        # one sum per output, with room for every oscillator at full scale
+        accumulators = [Signal(signed(shape.width + bits_for(n)), name=f"accumulator{channel}")
+                        for channel in range(len(fifos))]
+
+        busy    = Signal() # working on a frame
+        issuing = Signal() # issuing oscillators to the pipeline
+        slot    = Signal() # each oscillator takes two cycles of the lut read port
+        osc     = Signal(range(n))
+        issue   = issuing & ~slot
+
+        # pipeline stages, each valid for one cycle in two
+        s1_valid, s2_valid, s3_valid, s4_valid, s5_valid = (Signal(name=f"s{k}_valid") for k in range(1, 6))
+
+        with m.If(~busy & Cat(fifo.w_rdy for fifo in fifos).all()):
+            # start on the next frame once every output has room for it
+            m.d.sync += [
+                busy     .eq(1),
+                issuing  .eq(1),
+                slot     .eq(0),
+                osc      .eq(0),
+            ]
+            m.d.sync += [accumulator.eq(0) for accumulator in accumulators]
+
+        with m.Elif(issuing):
+            m.d.sync += slot.eq(~slot)
+            with m.If(slot):
+                with m.If(osc == n - 1):
+                    m.d.sync += issuing.eq(0)
+                with m.Else():
+                    m.d.sync += osc.eq(osc + 1)
+
+        with m.Elif(busy & ~Cat(s1_valid, s2_valid, s3_valid, s4_valid, s5_valid).any()):
+            # the pipeline has drained, so the frame is complete
+            m.d.sync += busy.eq(0)
+            for fifo, accumulator in zip(fifos, accumulators):
+                m.d.comb += [
+                    fifo.w_data  .eq(_clip(accumulator, shape)),
+                    fifo.w_en    .eq(1),
+                ]
+
+
+        # - pipeline --
+
+        # s0: read the oscillator's phase and settings
+        m.d.comb += [
+            phases_r.addr    .eq(osc),
+            deltas_r.addr    .eq(self.rate * n + osc),
+            settings_r.addr  .eq(osc),
+        ]
+        s1_osc = Signal.like(osc)
+        m.d.sync += [
+            s1_valid  .eq(issue),
+            s1_osc    .eq(osc),
+        ]
+
+        # s1: look up the lut entry at the phase ...
+        phi    = phases_r.data
+        index0 = phi[-self.index_bits:]
+
+        s2_osc, s2_phi, s2_delta, s2_settings, s2_negate = \
+            Signal.like(osc), Signal.like(phi), Signal.like(deltas_r.data), Signal(self.settings), Signal()
+        m.d.sync += [
+            s2_valid     .eq(s1_valid),
+            s2_osc       .eq(s1_osc),
+            s2_phi       .eq(phi),
+            s2_delta     .eq(deltas_r.data),
+            s2_settings  .eq(settings_r.data),
+            s2_negate    .eq(_lut_negate(index0, self.quarter)),
+        ]
+
+        # s2: ... and the one after it, and advance the oscillator's phase
+        index1 = Signal(self.index_bits)
+        m.d.comb += index1.eq(s2_phi[-self.index_bits:] + 1)
+
+        with m.If(s1_valid):
+            m.d.comb += self.read_port.addr.eq(_lut_address(index0, self.quarter))
+        with m.Else():
+            m.d.comb += self.read_port.addr.eq(_lut_address(index1, self.quarter))
+
+        m.d.comb += [
+            phases_w.addr  .eq(s2_osc),
+            phases_w.data  .eq(s2_phi + s2_delta),
+            phases_w.en    .eq(s2_valid),
+        ]
+
+        s3_y0, s3_frac, s3_settings, s3_negate = \
+            Signal(shape), Signal(self.frac_bits), Signal(self.settings), Signal()
+        m.d.sync += [
+            s3_valid     .eq(s2_valid),
+            s3_y0        .eq(Mux(s2_negate, -self.read_port.data, self.read_port.data)),
+            s3_frac      .eq(s2_phi[-self.index_bits - self.frac_bits:-self.index_bits]),
+            s3_settings  .eq(s2_settings),
+            s3_negate    .eq(_lut_negate(index1, self.quarter)),
+        ]
+
+        # s3: interpolate between the two entries
+        y1 = Signal(shape)
+        m.d.comb += y1.eq(Mux(s3_negate, -self.read_port.data, self.read_port.data))
+
+        s4_sample, s4_settings = Signal(shape), Signal(self.settings)
+        m.d.sync += [
+            s4_valid     .eq(s3_valid),
+            s4_sample    .eq(s3_y0 + (((y1 - s3_y0) * s3_frac) >> self.frac_bits)),
+            s4_settings  .eq(s3_settings),
+        ]
+
+        # s4: scale by the oscillator's amplitude
+        s5_product, s5_route = Signal(shape), Signal.like(s4_settings.route)
+        m.d.sync += [
+            s5_valid    .eq(s4_valid),
+            s5_product  .eq((s4_sample * s4_settings.amplitude) >> self.amplitude_bits),
+            s5_route    .eq(s4_settings.route),
+        ]
+
+        # s5: and add it to its output's sum
+        with m.If(s5_valid):
+            for channel, accumulator in enumerate(accumulators):
+                with m.If(s5_route == channel):
+                    m.d.sync += accumulator.eq(accumulator + s5_product)
+
+        return m
+
+
+def _clip(value, shape):
+    """ Clip a signed value to the range of a narrower signed shape. """
+    max_value =  (1 << (shape.width - 1)) - 1
+    min_value = -(1 << (shape.width - 1))
+    return Mux(value > max_value, max_value, Mux(value < min_value, min_value, value))
+
+
+# - model ---------------------------------------------------------------------
+
+def nco_bank_model(lut, bit_depth, outputs, phi_deltas, amplitudes, routes, length,
+                   quarter=False, frac_bits=16, amplitude_bits=16):
+    """ Bit-exact model of :class:`NCOBank` at a single rate, returning ``length`` frames. """
+
+    frames = [[0] * outputs for _ in range(length)]
+    for phi_delta, amplitude, route in zip(phi_deltas, amplitudes, routes):
+        samples = nco_model(lut, phi_delta, length, quarter=quarter, frac_bits=frac_bits)
+        for frame, sample in zip(frames, samples):
+            frame[route] += (sample * amplitude) >> amplitude_bits
+
+    limit = 1 << (bit_depth - 1)
+    return [[max(-limit, min(limit - 1, sample)) for sample in frame] for frame in frames]
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(bank, lut, length):
+    """ Collect ``length`` frames from an :class:`NCOBank` simulation, draining its outputs in bursts. """
+
+    m = Module()
+    m.submodules.lut  = lut
+    m.submodules.bank = bank
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+
+    frames = []
+
+    async def testbench(ctx):
+        while len(frames) < length:
+            # let the bank get ahead ...
+            await ctx.tick().repeat(4 * bank.oscillators * 16)
+
+            # ... then drain it
+            while all(ctx.get(output.valid) for output in bank.outputs) and len(frames) < length:
+                frames.append([ctx.get(output.payload) for output in bank.outputs])
+                for output in bank.outputs:
+                    ctx.set(output.ready, 1)
+                await ctx.tick()
+                for output in bank.outputs:
+                    ctx.set(output.ready, 0)
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return frames
+
+
+if __name__ == "__main__":
+    bit_depth   = 24
+    sample_rate = 48000
+    outputs     = 2
+
+    # a tone ladder on the first output and an IMD pair on the second, with enough
+    # oscillators at full scale to exercise clipping
+    frequencies = [1000., 2000., 3000., 4000., 19000., 20000., 440., 441.]
+    amplitudes  = [8192, 8192, 8192, 8192, 32768, 32768, 65535, 65535]
+    routes      = [0, 0, 0, 0, 1, 1, 1, 1]
+    phi_deltas  = [int(frequency * (1 << 32) / sample_rate) for frequency in frequencies]
+
+    length = 64
+    lut    = Memory(
+        shape = signed(bit_depth),
+        depth = 256,
+        init  = sinusoid_lut(bit_depth, 256, signed=True, quarter=True),
+    )
+    bank   = NCOBank(lut, len(frequencies), outputs, quarter=True,
+                     phi_deltas=phi_deltas, amplitudes=amplitudes, routes=routes, fifo_depth=16)
+
+    frames = simulate(bank, lut, length)
+    model  = nco_bank_model(list(lut.init), bit_depth, outputs, phi_deltas, amplitudes, routes, length, quarter=True)
+
+    if frames != model:
+        print("gateware doesn't match model")
+        sys.exit(1)
+    print(f"gateware matches model over {len(frames)} frames of {len(frequencies)} oscillators")
@@ -0,0 +1,319 @@
+import csv
+import math
+import sys
+
+from amaranth             import *
+from amaranth.lib         import wiring
+from amaranth.lib.wiring  import In, Out
+
+from amaranth.sim         import *
+
+
+class ClockRecovery(wiring.Component):
+    """ Adaptive Sample Clock Recovery from USB SOF Timing
+
+    A digital PLL which locks a fractional strobe generator to the host's clock, as seen
+    in the arrival of USB start-of-frame packets, so that the device consumes exactly as
+    many samples as the host sends without relying on the host to act on feedback.
+
+    ``stb`` runs at ``multipliers[rate]`` times the sample rate, for consumers which need
+    a faster strobe than the sample rate, e.g. an interpolating DAC, and ``sample_stb``
+    every ``multipliers[rate]`` strobes.
+
+    At each SOF the phase of the strobe generator, as whole strobes and a fraction, is
+    compared with where it should be after another ``rate / 8000 * multiplier`` strobes.
+    A proportional-integral loop filter steers the generator's step by up to
+    ``2**-trim_shift`` of its nominal value.
+    """
+
+    def __init__(self, sample_rate, clock_frequency, sample_rates=None, multipliers=None,
+                 trim_shift=8, damping_shift=5):
+        self.sample_rates = sample_rates or [sample_rate]
+        self.multipliers  = multipliers or [1] * len(self.sample_rates)
+
+        super().__init__({
+            "sof"        : In  (1),
+            "rate"       : In  (range(len(self.sample_rates)), init=self.sample_rates.index(sample_rate)),
+            "stb"        : Out (1),
+            "sample_stb" : Out (1),
+            "step"       : Out (32),
+            "locked"     : Out (1),
+        })
+
+        self.frac_bits     = 32
+        self.count_bits    = 16
+        self.phase_bits    = self.frac_bits + self.count_bits
+
+        microframes_per_second = 8000
+        cycles_per_microframe  = clock_frequency / microframes_per_second
+
+        self.nominals      = [round(rate * multiplier / clock_frequency * (1 << self.frac_bits))
+                              for rate, multiplier in zip(self.sample_rates, self.multipliers)]
+        self.expected      = [round(rate * multiplier / microframes_per_second * (1 << self.frac_bits))
+                              for rate, multiplier in zip(self.sample_rates, self.multipliers)]
+        self.limits        = [nominal >> trim_shift for nominal in self.nominals]
+
+        if max(self.nominals) >= 1 << (self.frac_bits - 1):
+            raise ValueError(f"strobe rates of more than half of {clock_frequency / 1e6} MHz are not supported")
+
+        # a loop gain of 1/16 per microframe, critically damped
+        self.kp_shift      = round(math.log2(cycles_per_microframe)) + 4
+        self.ki_shift      = self.kp_shift + damping_shift
+
+    def elaborate(self, platform):
+        m = Module()
+
+        nominals  = Array(Const(n, self.frac_bits) for n in self.nominals)
+        expected  = Array(Const(e, self.phase_bits) for e in self.expected)
+        limits    = Array(Const(l, self.frac_bits) for l in self.limits)
+        multiplier = Array(Const(n - 1, range(max(self.multipliers))) for n in self.multipliers)
+
+        # - strobe generator --
+
+        step   = Signal(self.frac_bits, init=self.nominals[self.rate.init])
+        frac   = Signal(self.frac_bits)
+        count  = Signal(self.count_bits)
+        carry  = Signal()
+        m.d.comb += [
+            carry     .eq((frac + step)[-1]),
+            self.stb  .eq(carry),
+            self.step .eq(step),
+        ]
+        m.d.sync += frac.eq(frac + step)
+        with m.If(carry):
+            m.d.sync += count.eq(count + 1)
+
+        divider = Signal.like(multiplier[0])
+        with m.If(carry):
+            with m.If(divider == multiplier[self.rate]):
+                m.d.comb += self.sample_stb.eq(1)
+                m.d.sync += divider.eq(0)
+            with m.Else():
+                m.d.sync += divider.eq(divider + 1)
+
+
+        # - phase detector --
+
+        # where the strobe generator is, and where it should be
+        phase     = Cat(frac, count)
+        reference = Signal(self.phase_bits)
+        error     = Signal(signed(self.phase_bits))
+        update    = Signal()
+        primed    = Signal()
+
+        # the rate selected during the previous cycle
+        rate      = Signal.like(self.rate, init=self.rate.init)
+        m.d.sync += rate.eq(self.rate)
+
+        m.d.sync += update.eq(0)
+        with m.If(self.rate != rate):
+            m.d.sync += [
+                primed .eq(0),
+                step   .eq(nominals[self.rate]),
+            ]
+        with m.Elif(self.sof):
+            with m.If(~primed):
+                m.d.sync += [
+                    primed    .eq(1),
+                    reference .eq(phase),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    reference .eq(reference + expected[self.rate]),
+                    error     .eq(phase - (reference + expected[self.rate])),
+                    update    .eq(1),
+                ]
+
+
+        # - loop filter --
+
+        integral   = Signal(signed(self.phase_bits + self.ki_shift))
+        integrated = Signal.like(integral)
+        trim       = Signal(signed(self.phase_bits + 1))
+        limit      = limits[self.rate]
+
+        m.d.comb += [
+            integrated .eq(integral + error),
+            trim       .eq((error >> self.kp_shift) + (integrated >> self.ki_shift)),
+        ]
+
+        with m.If(~primed):
+            m.d.sync += integral.eq(0)
+        with m.Elif(update):
+            # ahead of the host when the error is positive, so slow down, within limits,
+            # only integrating while within limits
+            with m.If(trim > limit):
+                m.d.sync += step.eq(nominals[self.rate] - limit)
+            with m.Elif(trim < -limit):
+                m.d.sync += step.eq(nominals[self.rate] + limit)
+            with m.Else():
+                m.d.sync += [
+                    step     .eq(nominals[self.rate] - trim),
+                    integral .eq(integrated),
+                ]
+
+            # locked while within a strobe of the host
+            m.d.sync += self.locked.eq((error < (1 << self.frac_bits)) & (error > -(1 << self.frac_bits)))
+
+        return m
+
+
+# - model ---------------------------------------------------------------------
+
+def recovery_model(recovery, sofs, rate=0, adaptive=True):
+    """ Bit-exact model of a :class:`ClockRecovery`, strobe by strobe between SOFs.
+
+    Takes the cycle of each SOF and returns, for each SOF, the step in use after it and
+    the number of strobes counted up to it. With ``adaptive`` unset the strobe generator
+    runs free at its nominal rate.
+    """
+    frac_bits  = recovery.frac_bits
+    mask       = (1 << recovery.phase_bits) - 1
+    nominal    = recovery.nominals[rate]
+    expected   = recovery.expected[rate]
+    limit      = recovery.limits[rate]
+
+    def signed(value, bits):
+        value &= (1 << bits) - 1
+        return value - (1 << bits) if value >> (bits - 1) else value
+
+    step      = nominal
+    phase     = 0
+    strobes   = 0
+    reference = None
+    integral  = 0
+    cycle     = 0
+
+    steps   = []
+    counts  = []
+    for sof in sofs:
+        # the step changes two cycles after the previous SOF
+        elapsed  = sof - cycle
+        phase   += elapsed * step
+        strobes += elapsed * step
+        cycle    = sof
+
+        if reference is None:
+            reference = phase & mask
+        elif adaptive:
+            reference = (reference + expected) & mask
+            error     = signed(phase - reference, recovery.phase_bits)
+            integrated = integral + error
+            trim      = (error >> recovery.kp_shift) + (integrated >> recovery.ki_shift)
+            if trim > limit:
+                new_step = nominal - limit
+            elif trim < -limit:
+                new_step = nominal + limit
+            else:
+                new_step = nominal - trim
+                integral = integrated
+            # the old step runs on until the new one takes effect
+            phase   += 2 * (step - new_step)
+            strobes += 2 * (step - new_step)
+            step     = new_step
+
+        steps.append(step)
+        counts.append(strobes >> frac_bits)
+
+    return steps, counts
+
+
+def sof_cycles(clock_frequency, ppm, microframes, start=1000):
+    """ The cycle of each SOF from a host whose clock is ``ppm`` parts per million fast. """
+    cycles_per_microframe = clock_frequency / 8000 / (1 + ppm * 1e-6)
+    return [start + int(n * cycles_per_microframe) for n in range(microframes)]
+
+
+def fifo_fill(recovery, sample_rate, sofs, counts, rate=0, microframes_per_packet=1):
+    """ FIFO fill, in samples, at each SOF, with the host sending a packet at the start of each interval. """
+    multiplier = recovery.multipliers[rate]
+    fills      = []
+    sent       = 0
+    for n, count in enumerate(counts):
+        if n % microframes_per_packet == 0:
+            sent = (n + microframes_per_packet) * sample_rate // 8000
+        fills.append(sent - count // multiplier)
+    return fills
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(dut, sofs):
+    """ Collect the step after each SOF, and the strobes up to it, from a :class:`ClockRecovery` simulation. """
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+
+    steps  = []
+    counts = []
+
+    async def testbench(ctx):
+        strobes = 0
+        for cycle in range(sofs[-1] + 3):
+            ctx.set(dut.sof, cycle in sofs_set)
+            if cycle - 2 in sofs_set:
+                steps.append(ctx.get(dut.step))
+            if cycle in sofs_set:
+                counts.append(strobes)
+            strobes += ctx.get(dut.stb)
+            await ctx.tick()
+
+    sofs_set = set(sofs)
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return steps, counts
+
+
+if __name__ == "__main__":
+    clock_frequency = 60e6
+    sample_rate     = 48000
+    multiplier      = 64
+
+    # check the gateware against the model, for a host running fast
+    dut  = ClockRecovery(sample_rate, clock_frequency, multipliers=[multiplier])
+    sofs = sof_cycles(clock_frequency, 500, 24)
+    if simulate(dut, sofs) != recovery_model(dut, sofs):
+        print("gateware doesn't match model")
+        sys.exit(1)
+    print("gateware matches model")
+
+    # FIFO fill over some minutes of host clock drift, free running and recovering the host's clock
+    minutes     = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    microframes = int(minutes * 60 * 8000)
+    path        = sys.argv[2] if len(sys.argv) > 2 else None
+
+    series = {}
+    for ppm in [-250, -50, 50, 250]:
+        sofs = sof_cycles(clock_frequency, ppm, microframes)
+        for adaptive in [False, True]:
+            _, counts = recovery_model(dut, sofs, adaptive=adaptive)
+            fills     = fifo_fill(dut, sample_rate, sofs, counts)
+            settled   = fills[8000:]
+            print(f"{ppm:+5} ppm, {'adaptive' if adaptive else 'free running'}: "
+                  f"fill {min(settled)} to {max(settled)} samples over {minutes} minutes")
+            series[f"{ppm:+} ppm {'adaptive' if adaptive else 'free running'}"] = fills[::800]
+
+    # write fill every 100 ms as csv, and plot it if we can
+    if path is not None:
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["seconds", *series])
+            for n, row in enumerate(zip(*series.values())):
+                writer.writerow([n / 10, *row])
+        print(f"wrote {path}")
+
+        try:
+            import matplotlib
+            matplotlib.use("Agg")
+            import matplotlib.pyplot as plt
+        except ImportError:
+            sys.exit(0)
+
+        for name, fills in series.items():
+            plt.plot([n / 10 for n in range(len(fills))], fills, label=name)
+        plt.xlabel("seconds")
+        plt.ylabel("FIFO fill (samples)")
+        plt.legend()
+        plt.savefig(f"{path.rsplit('.', 1)[0]}.png")
+        print(f"plotted {path.rsplit('.', 1)[0]}.png")
@@ -1,4 +1,5 @@
 from amaranth                             import *
+from amaranth.utils                       import bits_for
 
 from usb_protocol.emitters.descriptors    import uac2, standard
 from usb_protocol.types                   import (
@@ -10,7 +11,7 @@ from usb_protocol.types                   import (
     USBTransferType,
     USBUsageType,
 )
-from usb_protocol.types.descriptors.uac2  import AudioClassSpecificRequestCodes
+from usb_protocol.types.descriptors.uac2  import AudioClassSpecificRequestCodes, FeatureUnitControlSelectors
 
 from luna.gateware.stream.generator       import StreamSerializer
 from luna.gateware.usb.stream             import USBInStreamInterface
@@ -18,12 +19,33 @@ from luna.gateware.usb.usb2.request       import USBRequestHandler
 
 
 class UAC2RequestHandler(USBRequestHandler):
-    """ USB Audio Class Request Handler """
+    """ USB Audio Class Request Handler
 
-    def __init__(self, sample_rate):
+    With a ``feature_unit`` ID, also handles its mute and volume controls for the master
+    channel, 0, and each of its ``channels``. Volumes are in 1/256 dB, within
+    ``volume_range``, as ``(MIN, MAX, RES)``.
+    """
+
+    def __init__(self, sample_rate, sample_rates=None, interfaces=(1, 2, 2),
+                 feature_unit=None, channels=0, volume_range=(-0x7f80, 0, 0x80)):
         super().__init__()
 
-        self.sample_rate = int(sample_rate)
+        self.sample_rates = sorted(int(rate) for rate in (sample_rates or [sample_rate]))
+
+        # index into sample_rates of the sample rate currently selected by the host
+        self.rate = Signal(range(len(self.sample_rates)), init=self.sample_rates.index(int(sample_rate)))
+
+        # the number of alternate settings of each interface
+        self.interfaces   = interfaces
+
+        # alternate setting currently selected by the host, for each interface
+        self.alt_settings = [Signal(8, name=f"alt_setting_{n}") for n in range(len(interfaces))]
+
+        # the feature unit's current volume and mute for each channel, the master first
+        self.feature_unit = feature_unit
+        self.volume_range = volume_range
+        self.volumes      = [Signal(signed(16), name=f"volume_{n}") for n in range(channels + 1)]
+        self.mutes        = Signal(channels + 1)
 
     def elaborate(self, platform):
         m = Module()
@@ -31,10 +53,14 @@ class UAC2RequestHandler(USBRequestHandler):
         interface         = self.interface
         setup             = self.interface.setup
 
+        # A RANGE response carries a 2 byte count followed by 12 bytes per subrange.
+        range_length    = 2 + 12 * len(self.sample_rates)
+        max_packet_size = 64
+
         m.submodules.transmitter = transmitter = StreamSerializer(
-            data_length=14,     # The maximum length of data to be sent.
+            data_length=range_length,   # The maximum length of data to be sent.
             stream_type=USBInStreamInterface,
-            max_length_width=4, # Provides a `max_length` signal to limit total length transmitted
+            max_length_width=bits_for(max(range_length, max_packet_size)), # Limits the length of each packet
             domain="usb",
         )
 
@@ -42,12 +68,53 @@ class UAC2RequestHandler(USBRequestHandler):
         standard_set_interface = (setup.type == USBRequestType.STANDARD) & \
                                  (setup.recipient == USBRequestRecipient.INTERFACE) & \
                                  (setup.request == USBStandardRequests.SET_INTERFACE)
+        standard_get_interface = (setup.type == USBRequestType.STANDARD) & \
+                                 (setup.recipient == USBRequestRecipient.INTERFACE) & \
+                                 (setup.request == USBStandardRequests.GET_INTERFACE)
         uac2_request_range = (setup.type == USBRequestType.CLASS) & \
                              (setup.request == AudioClassSpecificRequestCodes.RANGE)
         uac2_request_cur   = (setup.type == USBRequestType.CLASS) & \
                              (setup.request == AudioClassSpecificRequestCodes.CUR)
         request_clock_freq = (setup.value == 0x100) & (setup.index == 0x0100)
 
+        # Feature unit controls are addressed by control selector and channel.
+        if self.feature_unit is not None:
+            channel            = setup.value[0:8]
+            request_feature    = (setup.index == self.feature_unit << 8) & (channel < len(self.volumes))
+            request_mute       = request_feature & (setup.value[8:16] == FeatureUnitControlSelectors.FU_MUTE_CONTROL)
+            request_volume     = request_feature & (setup.value[8:16] == FeatureUnitControlSelectors.FU_VOLUME_CONTROL)
+
+        sample_rates       = Array(Const(rate, 32) for rate in self.sample_rates)
+
+        # Responses longer than our control endpoint's max packet size are sent
+        # as a sequence of packets, advancing each time the host ACKs one.
+        start_position     = Signal(16)
+        expecting_ack      = Signal()
+        bytes_remaining    = setup.length - start_position
+
+        m.d.comb += transmitter.start_position.eq(start_position)
+
+        # Start every request from the beginning with a DATA1 pid, per [USB 2.0: 8.5.3].
+        with m.If(setup.received):
+            m.d.usb += [
+                start_position            .eq(0),
+                expecting_ack             .eq(0),
+                interface.tx_data_pid     .eq(1),
+            ]
+
+        # Every interface returns to its default alternate setting whenever the
+        # device is configured, unconfigured or reset, per [USB 2.0: 9.1.1.5].
+        active_config = Signal(8)
+        m.d.usb += active_config.eq(interface.active_config)
+        with m.If(interface.active_config != active_config):
+            m.d.usb += [alt_setting.eq(0) for alt_setting in self.alt_settings]
+
+        # Is the interface and alternate setting addressed by the request one of ours?
+        valid_alt_setting = Signal()
+        for n, alt_settings in enumerate(self.interfaces):
+            with m.If((setup.index[0:8] == n) & (setup.value < alt_settings)):
+                m.d.comb += valid_alt_setting.eq(1)
+
         with m.If(standard_set_interface):
             # Because we have multiple interfaces ('quiet' and 'active' we need
             # to handle SET_INTERFACE ourselves.
@@ -63,39 +130,82 @@ class UAC2RequestHandler(USBRequestHandler):
             with m.If(interface.rx_ready_for_response):
                 m.d.comb += interface.handshakes_out.ack.eq(1)
 
-            # ... and accept whatever the request was.
+            # ... and select the requested alternate setting if we have it, or stall if we don't.
+            with m.If(interface.status_requested):
+                with m.If(valid_alt_setting):
+                    m.d.comb += self.send_zlp()
+                    for n, alt_setting in enumerate(self.alt_settings):
+                        with m.If(setup.index[0:8] == n):
+                            m.d.usb += alt_setting.eq(setup.value[0:8])
+                with m.Else():
+                    m.d.comb += interface.handshakes_out.stall.eq(1)
+
+        with m.Elif(standard_get_interface & (setup.index[0:8] < len(self.interfaces))):
+            # Return the alternate setting currently selected for the interface.
+
+            # claim interface
+            if hasattr(interface, "claim"):
+                m.d.comb += interface.claim.eq(1)
+
+            m.d.comb += transmitter.stream.attach(self.interface.tx)
+            m.d.comb += [
+                transmitter.data[0]     .eq(Array(self.alt_settings)[setup.index[0:8]]),
+                transmitter.max_length  .eq(1),
+            ]
+
+            # ... trigger it to respond when data's requested...
+            with m.If(interface.data_requested):
+                m.d.comb += transmitter.start.eq(1)
+
+            # ... and ACK our status stage.
             with m.If(interface.status_requested):
-                m.d.comb += self.send_zlp()
+                m.d.comb += interface.handshakes_out.ack.eq(1)
 
-        with m.Elif(uac2_request_range & request_clock_freq):
-            # Return the valid values for the interface's clock.
+        with m.Elif(uac2_request_range & request_clock_freq & setup.is_in_request):
+            # Return the valid values for the interface's clock, as one
+            # discrete subrange per supported sample rate.
 
             # claim interface
             if hasattr(interface, "claim"):
                 m.d.comb += interface.claim.eq(1)
 
+            subranges = [
+                Cat(
+                    Const(rate, 32),                # MIN
+                    Const(rate, 32),                # MAX
+                    Const(0, 32),                   # RES
+                ) for rate in self.sample_rates
+            ]
+
             m.d.comb += transmitter.stream.attach(self.interface.tx)
             m.d.comb += [
                 Cat(transmitter.data)   .eq(
                     Cat(
-                       Const(0x1, 16),              # num subranges
-                       Const(self.sample_rate, 32), # MIN
-                       Const(self.sample_rate, 32), # MAX
-                       Const(0, 32),                # RES
+                       Const(len(subranges), 16),   # num subranges
+                       *subranges,
                     )
                 ),
-                transmitter.max_length  .eq(setup.length)
+                transmitter.max_length  .eq(Mux(bytes_remaining > max_packet_size, max_packet_size, bytes_remaining))
             ]
 
             # ... trigger it to respond when data's requested...
             with m.If(interface.data_requested):
                 m.d.comb += transmitter.start.eq(1)
+                m.d.usb  += expecting_ack.eq(1)
+
+            # ... move on to the next packet each time one is ACKed...
+            with m.If(interface.handshakes_in.ack & expecting_ack):
+                m.d.usb += [
+                    start_position         .eq(start_position + max_packet_size),
+                    interface.tx_data_pid  .eq(~interface.tx_data_pid),
+                    expecting_ack          .eq(0),
+                ]
 
             # ... and ACK our status stage.
             with m.If(interface.status_requested):
                 m.d.comb += interface.handshakes_out.ack.eq(1)
 
-        with m.Elif(uac2_request_cur & request_clock_freq):
+        with m.Elif(uac2_request_cur & request_clock_freq & setup.is_in_request):
             # Return the current value of the interface's clock
 
             # claim interface
@@ -105,7 +215,7 @@ class UAC2RequestHandler(USBRequestHandler):
             m.d.comb += transmitter.stream.attach(self.interface.tx)
             m.d.comb += [
                 Cat(transmitter.data[0:4]).eq(
-                    Const(self.sample_rate, 32)
+                    sample_rates[self.rate]
                 ),
                 transmitter.max_length.eq(4)
             ]
@@ -118,9 +228,215 @@ class UAC2RequestHandler(USBRequestHandler):
             with m.If(interface.status_requested):
                 m.d.comb += interface.handshakes_out.ack.eq(1)
 
+        with m.Elif(uac2_request_cur & request_clock_freq & ~setup.is_in_request):
+            # Set the current value of the interface's clock
+
+            # claim interface
+            if hasattr(interface, "claim"):
+                m.d.comb += interface.claim.eq(1)
+
+            # Receive the requested sample rate, least significant byte first...
+            rx_rate = Signal(32)
+            with m.If(interface.rx.valid & interface.rx.next):
+                m.d.usb += rx_rate.eq(Cat(rx_rate[8:], interface.rx.payload))
+
+            # ... ACK the data out...
+            with m.If(interface.rx_ready_for_response):
+                m.d.comb += interface.handshakes_out.ack.eq(1)
+
+            # ... and adopt it if it's one of ours, or stall if it isn't.
+            with m.If(interface.status_requested):
+                supported = Signal()
+                for n, rate in enumerate(self.sample_rates):
+                    with m.If(rx_rate == rate):
+                        m.d.comb += supported.eq(1)
+                        m.d.usb  += self.rate.eq(n)
+
+                with m.If(supported):
+                    m.d.comb += self.send_zlp()
+                with m.Else():
+                    m.d.comb += interface.handshakes_out.stall.eq(1)
+
+        if self.feature_unit is not None:
+            volume_min, volume_max, volume_res = self.volume_range
+
+            with m.Elif(uac2_request_range & request_volume & setup.is_in_request):
+                # Return the valid values for the channel's volume, as a single subrange.
+
+                # claim interface
+                if hasattr(interface, "claim"):
+                    m.d.comb += interface.claim.eq(1)
+
+                m.d.comb += transmitter.stream.attach(self.interface.tx)
+                m.d.comb += [
+                    Cat(transmitter.data[0:8]).eq(
+                        Cat(
+                            Const(1, 16),                   # num subranges
+                            Const(volume_min, signed(16)),  # MIN
+                            Const(volume_max, signed(16)),  # MAX
+                            Const(volume_res, 16),          # RES
+                        )
+                    ),
+                    transmitter.max_length  .eq(Mux(setup.length < 8, setup.length, 8))
+                ]
+
+                # ... trigger it to respond when data's requested...
+                with m.If(interface.data_requested):
+                    m.d.comb += transmitter.start.eq(1)
+
+                # ... and ACK our status stage.
+                with m.If(interface.status_requested):
+                    m.d.comb += interface.handshakes_out.ack.eq(1)
+
+            with m.Elif(uac2_request_cur & (request_mute | request_volume) & setup.is_in_request):
+                # Return the current value of the channel's mute or volume
+
+                # claim interface
+                if hasattr(interface, "claim"):
+                    m.d.comb += interface.claim.eq(1)
+
+                m.d.comb += transmitter.stream.attach(self.interface.tx)
+                with m.If(request_mute):
+                    m.d.comb += [
+                        transmitter.data[0]     .eq(self.mutes.bit_select(channel, 1)),
+                        transmitter.max_length  .eq(1),
+                    ]
+                with m.Else():
+                    m.d.comb += [
+                        Cat(transmitter.data[0:2]).eq(Array(self.volumes)[channel]),
+                        transmitter.max_length    .eq(2),
+                    ]
+
+                # ... trigger it to respond when data's requested...
+                with m.If(interface.data_requested):
+                    m.d.comb += transmitter.start.eq(1)
+
+                # ... and ACK our status stage.
+                with m.If(interface.status_requested):
+                    m.d.comb += interface.handshakes_out.ack.eq(1)
+
+            with m.Elif(uac2_request_cur & (request_mute | request_volume) & ~setup.is_in_request):
+                # Set the current value of the channel's mute or volume
+
+                # claim interface
+                if hasattr(interface, "claim"):
+                    m.d.comb += interface.claim.eq(1)
+
+                # Receive the requested value, least significant byte first, so that a
+                # mute's single byte ends up in the upper half...
+                rx_value = Signal(16)
+                with m.If(interface.rx.valid & interface.rx.next):
+                    m.d.usb += rx_value.eq(Cat(rx_value[8:], interface.rx.payload))
+
+                # ... ACK the data out...
+                with m.If(interface.rx_ready_for_response):
+                    m.d.comb += interface.handshakes_out.ack.eq(1)
+
+                # ... and adopt it, limiting volumes to our range.
+                with m.If(interface.status_requested):
+                    m.d.comb += self.send_zlp()
+                    volume = rx_value.as_signed()
+                    for n, channel_volume in enumerate(self.volumes):
+                        with m.If(channel == n):
+                            with m.If(request_mute):
+                                m.d.usb += self.mutes[n].eq(rx_value[8:16] != 0)
+                            with m.Elif(volume < volume_min):
+                                m.d.usb += channel_volume.eq(volume_min)
+                            with m.Elif(volume > volume_max):
+                                m.d.usb += channel_volume.eq(volume_max)
+                            with m.Else():
+                                m.d.usb += channel_volume.eq(volume)
+
         # Stall any unsupported requests.
         with m.Else():
             with m.If(interface.status_requested | interface.data_requested):
                 m.d.comb += interface.handshakes_out.stall.eq(1)
 
         return m
+
+
+class VendorRegisterRequestHandler(USBRequestHandler):
+    """ Vendor Register Request Handler
+
+    Gives the host access to a bank of 32-bit registers through vendor requests to the
+    device, the register addressed by ``wIndex``:
+
+        * ``REGISTER_READ``  -- an IN request for the register's 4 bytes, least significant first.
+        * ``REGISTER_WRITE`` -- an OUT request carrying its 4 new bytes, least significant first.
+
+    The register bank itself is outside of the handler, which presents ``addr`` to it and
+    expects the register's value on ``r_data`` in the same cycle. Writes strobe ``w_en``
+    with ``w_data`` at the end of a request.
+    """
+
+    REGISTER_READ  = 0x00
+    REGISTER_WRITE = 0x01
+
+    def __init__(self):
+        super().__init__()
+
+        self.addr   = Signal(16)
+        self.r_data = Signal(32)
+        self.w_data = Signal(32)
+        self.w_en   = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        interface         = self.interface
+        setup             = self.interface.setup
+
+        m.submodules.transmitter = transmitter = StreamSerializer(
+            data_length=4,
+            stream_type=USBInStreamInterface,
+            max_length_width=3,
+            domain="usb",
+        )
+
+        # The requests we'll be handling.
+        vendor_request = (setup.type == USBRequestType.VENDOR) & \
+                         (setup.recipient == USBRequestRecipient.DEVICE)
+        register_read  = vendor_request & (setup.request == self.REGISTER_READ) & setup.is_in_request
+        register_write = vendor_request & (setup.request == self.REGISTER_WRITE) & ~setup.is_in_request
+
+        m.d.comb += self.addr.eq(setup.index)
+
+        with m.If(register_read):
+            # Return the register's value.
+            m.d.comb += interface.claim.eq(1)
+
+            m.d.comb += transmitter.stream.attach(self.interface.tx)
+            m.d.comb += [
+                Cat(transmitter.data[0:4])  .eq(self.r_data),
+                transmitter.max_length      .eq(Mux(setup.length < 4, setup.length, 4)),
+            ]
+
+            # ... trigger it to respond when data's requested...
+            with m.If(interface.data_requested):
+                m.d.comb += transmitter.start.eq(1)
+
+            # ... and ACK our status stage.
+            with m.If(interface.status_requested):
+                m.d.comb += interface.handshakes_out.ack.eq(1)
+
+        with m.Elif(register_write):
+            # Set the register's value.
+            m.d.comb += interface.claim.eq(1)
+
+            # Receive the value, least significant byte first...
+            with m.If(interface.rx.valid & interface.rx.next):
+                m.d.usb += self.w_data.eq(Cat(self.w_data[8:], interface.rx.payload))
+
+            # ... ACK the data out...
+            with m.If(interface.rx_ready_for_response):
+                m.d.comb += interface.handshakes_out.ack.eq(1)
+
+            # ... and write it if it's a whole register, or stall if it isn't.
+            with m.If(interface.status_requested):
+                with m.If(setup.length == 4):
+                    m.d.comb += self.send_zlp()
+                    m.d.comb += self.w_en.eq(1)
+                with m.Else():
+                    m.d.comb += interface.handshakes_out.stall.eq(1)
+
+        return m
@@ -0,0 +1,138 @@
+import sys
+
+from amaranth                             import *
+from amaranth.lib                         import wiring
+from amaranth.lib.wiring                  import In, Out
+
+from amaranth.sim                         import *
+
+
+class PacketScheduler(wiring.Component):
+    """ Isochronous Packet Size Scheduler
+
+    Works out how many audio frames to transmit in each USB microframe so that the
+    long-term average matches the sample rate exactly, e.g. 44.1 kHz is sent as a
+    sequence of 5 and 6 frame packets averaging 5.5125 frames per microframe.
+
+    Each microframe carries ``rate // 8000`` frames, plus one more whenever the
+    accumulated remainder of ``rate % 8000`` reaches a whole frame.
+
+    With an ``interval`` of more than one microframe the frames of a whole service
+    interval are sent in a single packet, so ``frames`` is worked out on every
+    ``interval``-th SOF and held for the rest of the interval.
+    """
+
+    microframes_per_second = 8000
+
+    def __init__(self, sample_rate, sample_rates=None, interval=1):
+        self.sample_rates = [int(rate) for rate in (sample_rates or [sample_rate])]
+        self.interval     = interval
+
+        # The most frames we'll ever need to send in a single packet.
+        self.max_frames = max(-(-rate * interval // self.microframes_per_second) for rate in self.sample_rates)
+
+        super().__init__({
+            "sof"    : In  (1),
+            "rate"   : In  (range(len(self.sample_rates)), init=self.sample_rates.index(int(sample_rate))),
+            "frames" : Out (range(self.max_frames + 1)),
+        })
+
+
+    def elaborate(self, platform):
+        m = Module()
+
+        n = self.microframes_per_second
+
+        # whole frames and remainder per packet, for each sample rate
+        quotients  = Array(Const(rate * self.interval // n, range(self.max_frames + 1)) for rate in self.sample_rates)
+        remainders = Array(Const(rate * self.interval %  n, range(n)) for rate in self.sample_rates)
+
+        # microframes elapsed in the current service interval
+        microframe = Signal(range(self.interval))
+
+        # accumulated fractional frames, in units of 1/8000 of a frame
+        accum      = Signal(range(2 * n))
+        accum_next = Signal.like(accum)
+
+        # the rate selected during the previous cycle
+        rate       = Signal.like(self.rate, init=self.rate.init)
+        m.d.usb += rate.eq(self.rate)
+
+        m.d.comb += accum_next.eq(accum + remainders[self.rate])
+
+        with m.If(self.rate != rate):
+            # start afresh when the host selects a new rate
+            m.d.usb += [
+                accum        .eq(0),
+                microframe   .eq(0),
+                self.frames  .eq(quotients[self.rate]),
+            ]
+
+        with m.Elif(self.sof):
+            m.d.usb += microframe.eq(Mux(microframe == self.interval - 1, 0, microframe + 1))
+
+            # schedule the next packet at the start of each service interval
+            with m.If(microframe == 0):
+                with m.If(accum_next >= n):
+                    m.d.usb += [
+                        accum        .eq(accum_next - n),
+                        self.frames  .eq(quotients[self.rate] + 1),
+                    ]
+                with m.Else():
+                    m.d.usb += [
+                        accum        .eq(accum_next),
+                        self.frames  .eq(quotients[self.rate]),
+                    ]
+
+        return m
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(sample_rates, seconds=10, interval=1):
+    """ Count the frames scheduled over ``seconds`` of simulated microframes at each sample rate. """
+
+    dut = PacketScheduler(sample_rates[0], sample_rates, interval=interval)
+
+    m = Module()
+    m.domains.usb = ClockDomain()
+    m.submodules.dut = dut
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6, domain="usb")
+
+    results = {}
+
+    async def testbench(ctx):
+        for index, rate in enumerate(sample_rates):
+            ctx.set(dut.rate, index)
+            await ctx.tick("usb")
+
+            total = 0
+            ctx.set(dut.sof, 1)
+            for microframe in range(seconds * PacketScheduler.microframes_per_second):
+                await ctx.tick("usb")
+                if microframe % interval == 0:
+                    total += ctx.get(dut.frames)
+            ctx.set(dut.sof, 0)
+
+            results[rate] = total
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return results
+
+
+if __name__ == "__main__":
+    sample_rates = [44100, 48000, 88200, 96000, 176400, 192000]
+    seconds      = 10
+
+    failed = False
+    for interval in [1, 2, 4, 8]:
+        for rate, frames in simulate(sample_rates, seconds, interval).items():
+            error = frames - (rate * seconds)
+            print(f"{rate / 1000:7.1f} kHz, {interval} microframe interval: {frames} frames in {seconds} s, error: {error}")
+            failed |= error != 0
+
+    sys.exit(1 if failed else 0)
@@ -1,20 +1,52 @@
 from amaranth                             import *
 from amaranth.lib                         import data, stream, wiring
+from amaranth.lib.fifo                    import SyncFIFOBuffered
 from amaranth.lib.wiring                  import In, Out
 
 from luna.gateware.stream.future          import Packet
 
 class UAC2StreamToSamples(wiring.Component):
-    """ Serialize an UAC 2.0 Audio Stream to Samples """
+    """ Deserialize an UAC 2.0 Audio Stream to Samples
 
-    def __init__(self, bit_depth, channels, subslot_size):
-        self.bit_depth    = bit_depth
-        self.channels     = channels
-        self.subslot_size = subslot_size
+    Bytes are shifted into a subslot register one per cycle, least significant byte
+    first. Once a subslot is complete, its ``bit_depth`` most significant bits are
+    presented on the output stream of the channel it belongs to.
+
+    In ``wide`` mode the samples of an audio frame are held until the frame is
+    complete, and then presented on every output in the same cycle.
+
+    ``subslot_size`` may also be a sequence of sizes, e.g. ``(4, 3)`` for padded and
+    packed 24-bit audio, in which case ``format`` selects between them at run time.
+
+    Every packet is taken to begin a new audio frame, so when a microframe is split over
+    several high-bandwidth transactions each of them must carry whole audio frames.
+
+    Received bytes pass through a skid FIFO of ``fifo_depth`` bytes so that a stalled
+    output doesn't lose data. Should the FIFO fill up, bytes are dropped up to the start
+    of the next packet. Glitches are tallied by
+    saturating counters:
+
+        * ``dropped``        -- bytes dropped because the skid FIFO was full.
+        * ``framing_errors`` -- packets that started part way through an audio frame.
+        * ``short_packets``  -- packets that ended part way through an audio frame.
+    """
+
+    def __init__(self, bit_depth, channels, subslot_size, wide=False, fifo_depth=64, counter_width=16):
+        self.bit_depth     = bit_depth
+        self.channels      = channels
+        self.subslot_sizes = _subslot_sizes(bit_depth, subslot_size)
+        self.subslot_size  = max(self.subslot_sizes)
+        self.wide          = wide
+        self.fifo_depth    = fifo_depth
 
         super().__init__({
-            "input"   : In  (stream.Signature(Packet(unsigned(8)))),
-            "outputs" : Out (stream.Signature(signed(self.bit_depth))).array(channels),
+            "input"          : In  (stream.Signature(Packet(unsigned(8)))),
+            "outputs"        : Out (stream.Signature(signed(self.bit_depth))).array(channels),
+            "format"         : In  (range(len(self.subslot_sizes))),
+
+            "dropped"        : Out (counter_width),
+            "framing_errors" : Out (counter_width),
+            "short_packets"  : Out (counter_width),
         })
 
 
@@ -24,89 +56,161 @@ class UAC2StreamToSamples(wiring.Component):
         input_stream   = self.input
         output_streams = self.outputs
 
-        first      = input_stream.payload.first
-        channel    = Signal(range(0, self.channels))
+        # - skid fifo --
+
+        m.submodules.fifo = fifo = DomainRenamer({"sync": "usb"})(
+            SyncFIFOBuffered(width=10, depth=self.fifo_depth)
+        )
+
+        # always receive audio from host, dropping it up to the next packet if we can't keep up
+        dropping = Signal()
+        accept   = fifo.w_rdy & (~dropping | input_stream.payload.first)
+
+        m.d.comb += [
+            input_stream.ready .eq(1), # stream.ready driven by the consumer
+            fifo.w_data        .eq(Cat(input_stream.payload.data,
+                                       input_stream.payload.first,
+                                       input_stream.payload.last)),
+            fifo.w_en          .eq(input_stream.valid & accept),
+        ]
+        with m.If(input_stream.valid):
+            m.d.usb += dropping.eq(~accept)
+            _saturating_increment(m, self.dropped, ~accept)
+
+        payload = fifo.r_data[0:8]
+        first   = fifo.r_data[8]
+        last    = fifo.r_data[9]
+
+
+        # - deserializer --
+
+        channel    = Signal(range(self.channels))
+        byte       = Signal(range(self.subslot_size))
         subslot    = Signal(self.subslot_size * 8)
-        sample     = Signal(self.bit_depth)
-        got_sample = Signal()
-        error      = Signal()
 
-        # always receive audio from host
-        m.d.comb += input_stream.ready .eq(1) # stream.ready driven by the consumer
+        # a new packet always starts a new audio frame
+        position_channel = Mux(first, 0, channel)
+        position_byte    = Mux(first, 0, byte)
+        last_channel     = (position_channel == self.channels - 1)
+        last_byte        = (position_byte == Array(self.subslot_sizes)[self.format] - 1)
+
+        # the subslot including the byte currently being received, with its
+        # sample left-justified -- whatever the size of the current format's
+        # subslots, their bytes are shifted in from the top of the register
+        subslot_next = Cat(subslot[8:], payload)
+        sample_next  = subslot_next[-self.bit_depth:]
 
-        out_ready = output_streams[0].ready | output_streams[1].ready
+        # outputs are free once their previous sample has been taken
+        for n in range(self.channels):
+            with m.If(output_streams[n].ready):
+                m.d.usb += output_streams[n].valid.eq(0)
+        free = [~output_streams[n].valid | output_streams[n].ready for n in range(self.channels)]
+        if self.wide:
+            can_deliver = ~last_channel | Cat(free).all()
+        else:
+            can_deliver = Array(free)[position_channel]
+
+        # only take a byte from the fifo once we know its sample can be delivered
+        m.d.comb += fifo.r_en.eq(fifo.r_rdy & (~last_byte | can_deliver))
 
         # De-serialize byte stream to samples
-        with m.If(input_stream.valid & out_ready):
-            with m.FSM(domain="usb") as fsm:
-                with m.State("B0"):
-                    with m.If(first):
-                        m.d.usb += channel.eq(0)
-                    with m.Else():
-                        m.d.usb += channel.eq(channel + 1)
-
-                    m.d.usb += subslot[0:8].eq(input_stream.payload.data)
-                    m.next = "B1"
-
-                with m.State("B1"):
-                    with m.If(first):
-                        m.next = "ERROR"
-
-                    with m.Else():
-                        m.d.usb += subslot[8:16].eq(input_stream.payload.data)
-                        m.next = "B2"
-
-                with m.State("B2"):
-                    with m.If(first):
-                        m.next = "ERROR"
-
-                    with m.Else():
-                        m.d.usb += subslot[16:24].eq(input_stream.payload.data)
-                        m.next = "B3"
-
-                with m.State("B3"):
-                    with m.If(first):
-                        m.next = "ERROR"
-
-                    with m.Else():
-                        m.d.usb += sample.eq(Cat(subslot[8:24], input_stream.payload.data))
-                        m.d.comb += got_sample.eq(1)
-                        m.next = "B0"
-
-                with m.State("ERROR"):
-                    m.d.comb += error.eq(1)
-                    m.d.usb += channel.eq(0)
-                    m.d.usb += subslot[0:8].eq(input_stream.payload.data)
-                    m.next = "B1"
+        with m.If(fifo.r_en):
+            m.d.usb += subslot.eq(subslot_next)
 
-        with m.Else():
-            m.d.usb += channel.eq(0)
-            m.d.usb += subslot.eq(0)
+            # keep track of packets starting and ending part way through audio frames
+            _saturating_increment(m, self.framing_errors, first & ((byte != 0) | (channel != 0)))
+            _saturating_increment(m, self.short_packets,  last  & ~(last_byte & last_channel))
 
-        # dump samples to output streams
-        for n in range(self.channels):
-            m.d.comb += [
-                # stream.valid is driven by the producer
-                output_streams[n].valid   .eq(got_sample & (channel == n)),
-                output_streams[n].payload .eq(sample),
-            ]
+            with m.If(~last_byte):
+                m.d.usb += [
+                    channel .eq(position_channel),
+                    byte    .eq(position_byte + 1),
+                ]
+
+            with m.Else():
+                # the subslot is complete, deliver its sample ...
+                self._deliver(m, position_channel, sample_next, last_channel)
+
+                # ... and move on to the next channel
+                m.d.usb += [
+                    channel .eq(Mux(last_channel, 0, position_channel + 1)),
+                    byte    .eq(0),
+                ]
 
         return m
 
 
+    def _deliver(self, m, channel, sample, end_of_frame):
+        """ Present a completed sample on the output stream(s). """
+
+        output_streams = self.outputs
+
+        if not self.wide:
+            for n in range(self.channels):
+                with m.If(channel == n):
+                    m.d.usb += [
+                        output_streams[n].valid   .eq(1),
+                        output_streams[n].payload .eq(sample),
+                    ]
+            return
+
+        # hold samples until the audio frame is complete ...
+        held = [Signal(self.bit_depth, name=f"held_{n}") for n in range(self.channels - 1)]
+        for n in range(self.channels - 1):
+            with m.If(channel == n):
+                m.d.usb += held[n].eq(sample)
+
+        # ... then present them all at once
+        with m.If(end_of_frame):
+            for n in range(self.channels):
+                m.d.usb += [
+                    output_streams[n].valid   .eq(1),
+                    output_streams[n].payload .eq(held[n] if n < self.channels - 1 else sample),
+                ]
+
+
+def _subslot_sizes(bit_depth, subslot_size):
+    """ Normalise and check a subslot size, or a sequence of them, against a bit depth. """
+    subslot_sizes = tuple(subslot_size) if isinstance(subslot_size, (list, tuple)) else (subslot_size,)
+    for subslot_size in subslot_sizes:
+        if subslot_size not in (1, 2, 3, 4):
+            raise ValueError(f"subslot_size must be 1, 2, 3 or 4, not {subslot_size}")
+        if bit_depth > subslot_size * 8:
+            raise ValueError(f"bit_depth {bit_depth} does not fit in a {subslot_size} byte subslot")
+    return subslot_sizes
+
+
+def _saturating_increment(m, counter, condition, domain="usb"):
+    """ Count ``condition`` in ``counter``, holding at its maximum value rather than wrapping. """
+    with m.If(condition & (counter != (1 << len(counter)) - 1)):
+        m.d[domain] += counter.eq(counter + 1)
+
+
 
 
 class SamplesToUAC2Stream(wiring.Component):
-    """ Serialize Samples to an UAC 2.0 Audio Stream """
+    """ Serialize Samples to an UAC 2.0 Audio Stream
+
+    Takes a sample from each of the input streams in turn and transmits it,
+    left-justified in its subslot, one byte per cycle, least significant byte
+    first. A channel that doesn't have a sample ready when its turn comes is
+    sent as silence, without consuming anything from its stream, so the
+    channel order of the audio stream is always maintained.
+
+    As for :class:`UAC2StreamToSamples`, ``subslot_size`` may be a sequence of sizes
+    selected between at run time by ``format``.
+    """
 
     def __init__(self, bit_depth, channels, subslot_size):
-        self.bit_depth    = bit_depth
-        self.channels     = channels
-        self.subslot_size = subslot_size
+        self.bit_depth     = bit_depth
+        self.channels      = channels
+        self.subslot_sizes = _subslot_sizes(bit_depth, subslot_size)
+        self.subslot_size  = max(self.subslot_sizes)
 
         super().__init__({
             "inputs" : In  (stream.Signature(signed(self.bit_depth))).array(channels),
             "output" : Out (stream.Signature(unsigned(8))),
+            "format" : In  (range(len(self.subslot_sizes))),
         })
 
 
@@ -117,37 +221,56 @@ class SamplesToUAC2Stream(wiring.Component):
         output_stream = self.output
 
         # frame counters
-        next_channel = Signal(1)
-        next_byte = Signal(2)
-
-        # Subslot Frame Format for 24-bit int with subslot_size=4 is:
+        channel = Signal(range(self.channels))
+        byte    = Signal(range(self.subslot_size))
+
+        # Subslot Frame Format for e.g. 24-bit int with subslot_size=4 is:
+        #    00:08  - padding
+        #    08:15  - lsb
+        #    16:23  -
+        #    24:31  - msb
+        #
+        # ... and with subslot_size=3 (packed):
         #    00:08  - lsb
         #    08:15  -
         #    16:23  - msb
-        #    24:31  - padding
-        subslot = Signal(32)
-
-        with m.If(next_channel == 0):
-            with m.If(next_byte == 3):
-                m.d.comb += input_streams[0].ready.eq(1)
-            m.d.comb += [
-                subslot[8:].eq(input_streams[0].payload)
-            ]
+        subslot = Signal(self.subslot_size * 8)
+        held    = Signal.like(subslot)
+
+        # the input stream whose turn it is
+        valid   = Array(input_streams[n].valid   for n in range(self.channels))[channel]
+        sample  = Array(input_streams[n].payload for n in range(self.channels))[channel]
+
+        # take a new sample at the start of each subslot, or silence if there isn't one ...
+        with m.If(byte == 0):
+            with m.If(valid):
+                for n, subslot_size in enumerate(self.subslot_sizes):
+                    padding = subslot_size * 8 - self.bit_depth
+                    with m.If(self.format == n):
+                        m.d.comb += subslot.eq(sample.as_unsigned() << padding)
+        # ... and hold on to it for the remainder of the subslot
         with m.Else():
-            with m.If(next_byte == 3):
-                m.d.comb += input_streams[1].ready.eq(1)
-            m.d.comb += [
-                subslot[8:].eq(input_streams[1].payload)
-            ]
+            m.d.comb += subslot.eq(held)
 
         m.d.comb += [
             output_stream.valid.eq(1), # driven by producer (moi-même)
-            output_stream.payload.eq(subslot.word_select(next_byte, 8)),
+            output_stream.payload.eq(subslot[0:8]),
         ]
+
         with m.If(output_stream.ready):
-            m.d.usb += next_byte.eq(next_byte + 1)
-            with m.If(next_byte == 3):
-                m.d.usb += next_channel.eq(~next_channel)
+            for n in range(self.channels):
+                with m.If((channel == n) & (byte == 0)):
+                    m.d.comb += input_streams[n].ready.eq(1)
 
+            m.d.usb += held.eq(subslot >> 8)
+
+            with m.If(byte == Array(self.subslot_sizes)[self.format] - 1):
+                m.d.usb += byte.eq(0)
+                with m.If(channel == self.channels - 1):
+                    m.d.usb += channel.eq(0)
+                with m.Else():
+                    m.d.usb += channel.eq(channel + 1)
+            with m.Else():
+                m.d.usb += byte.eq(byte + 1)
 
         return m
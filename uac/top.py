@@ -4,6 +4,7 @@ import logging
 
 from amaranth            import *
 from amaranth.lib        import wiring
+from amaranth.lib.fifo   import SyncFIFOBuffered
 from amaranth.lib.memory import Memory
 
 from luna                import top_level_cli
@@ -21,11 +22,42 @@ class Top(Elaboratable):
         }
 
         self.sample_rate         = 48e3
+        self.sample_rates        = [44.1e3, 48e3, 88.2e3, 96e3, 176.4e3, 192e3]
         self.bit_depth           = 24
         self.channels            = 2
 
         self.lut_length          = 256
 
+        # ∆Σ modulator order, 1 to 5
+        self.dac_order           = 1
+
+        # rate the ∆Σ DAC interpolates samples up to before modulating them, or None to hold them
+        self.dac_interp_rate      = 3.072e6
+
+        # VU meter segment thresholds: "log", "dbfs", "linear" or a list of dBFS, one per led
+        self.vu_scale            = "log"
+
+        # frames of jitter buffer between host and ∆Σ DAC, and how many to prefill, or None for no buffer
+        self.jitter_depth        = 512
+        self.jitter_target       = 96
+
+        # recover the host's sample clock from SOF timing, rather than divide our own
+        self.adaptive_clock      = False
+
+        # routing matrix mixer gains, for each output, the DAC's channels then the host's, from each
+        # input, the host's channels then the oscillators', or None to play the host's audio and
+        # send it the oscillators'
+        self.mixer_gains         = None
+
+        # biquad sections to filter the ∆Σ DAC's audio through, as (kind, frequency, q, gain) for
+        # dsp.biquad_coefficients, designed for each of sample_rates and selected by the host's, e.g.
+        # for speaker correction, or None for no filter
+        self.dac_eq              = None
+
+        # loop audio from the host back to it through a delay of up to this many frames, rather
+        # than play it, to measure round-trip latency, or None to play it
+        self.loopback            = None
+
 
     def elaborate(self, platform):
         m = Module()
@@ -35,74 +67,265 @@ class Top(Elaboratable):
 
         # Instantiate our UAC 2.0 Device.
         m.submodules.uac2 = uac2 = USBAudioClass2Device(
-            sample_rate = self.sample_rate,
-            bit_depth   = self.bit_depth,
-            channels    = self.channels,
-            bus         = platform.request("target_phy"),
+            sample_rate  = self.sample_rate,
+            bit_depth    = self.bit_depth,
+            channels     = self.channels,
+            bus          = platform.request("target_phy"),
+            sample_rates = self.sample_rates,
+            registers    = True,
         )
 
-        # Instantiate our sin LUT.
+        # Idle our DSP whenever the host isn't streaming audio to or from the device.
+        idle_in  = (uac2.alt_setting_in  == 0)
+        idle_out = (uac2.alt_setting_out == 0)
+
+        if self.loopback is not None:
+            self.elaborate_loopback(m, uac2, idle_out)
+            return m
+
+        # Instantiate our quarter-wave sin LUT.
         gain  = 1.0
         #gain = 0.794328 # -2dB
         #gain = 0.501187 # -6dB
-        m.submodules.lut = lut = Memory(
+        lut = Memory(
             shape  = signed(self.bit_depth),
             depth  = self.lut_length,
-            init   = dsp.sinusoid_lut(self.bit_depth, self.lut_length, gain=gain, signed=True),
+            init   = dsp.sinusoid_lut(self.bit_depth, self.lut_length, gain=gain, signed=True, quarter=True),
         )
+        m.submodules.lut = DomainRenamer({"sync": "usb"})(lut)
+
+        # Instantiate our oscillator bank, with a tone for each channel.
+        tones = [
+            # frequency, amplitude, channel
+            (1000.,  1.0, 0),
+            (10000., 1.0, 1),
+        ]
+        amplitude_bits = 16
+        m.submodules.ncobank = ncobank = DomainRenamer({"sync": "usb"})(ResetInserter(idle_in)(
+            dsp.NCOBank(
+                lut,
+                oscillators    = len(tones),
+                outputs        = self.channels,
+                rates          = len(self.sample_rates),
+                quarter        = True,
+                amplitude_bits = amplitude_bits,
+                phi_deltas     = [[int(frequency * (1 << 32) / rate) for rate in self.sample_rates]
+                                  for frequency, _, _ in tones],
+                amplitudes     = [min(int(amplitude * (1 << amplitude_bits)), (1 << amplitude_bits) - 1)
+                                  for _, amplitude, _ in tones],
+                routes         = [channel for _, _, channel in tones],
+                fifo_depth     = max(64, uac2.frames_per_packet),
+            )
+        ))
+        m.d.comb += ncobank.rate.eq(uac2.rate)
 
-        # Instantiate our NCOs.
-        m.submodules.nco0 = nco0 = DomainRenamer({"sync": "usb"})(dsp.NCO(lut))
-        m.submodules.nco1 = nco1 = DomainRenamer({"sync": "usb"})(dsp.NCO(lut))
+        # Retune our oscillators from vendor registers: an oscillator's phase increment at a rate, its
+        # amplitude and its route are staged, then written together by a strobe.
+        osc_index     = Signal(range(len(tones)))
+        osc_rate      = Signal(range(len(self.sample_rates)))
+        osc_phi_delta = Signal(signed(32))
+        osc_amplitude = Signal(amplitude_bits)
+        osc_route     = Signal(range(self.channels))
+        osc_write     = Signal()
+        m.d.usb  += osc_write.eq(0)
         m.d.comb += [
-            nco0.phi_delta.eq(int(1000.  * nco0.phi_tau / self.sample_rate)),
-            nco1.phi_delta.eq(int(10000. * nco1.phi_tau / self.sample_rate)),
+            ncobank.w_index              .eq(osc_index),
+            ncobank.w_rate               .eq(osc_rate),
+            ncobank.w_phi_delta          .eq(osc_phi_delta),
+            ncobank.w_settings.amplitude .eq(osc_amplitude),
+            ncobank.w_settings.route     .eq(osc_route),
+            ncobank.w_en                 .eq(osc_write),
         ]
 
-        # Connect our NCO's to the UAC 2.0 device's inputs
-        wiring.connect(m, nco0.output, uac2.inputs[0])
-        wiring.connect(m, nco1.output, uac2.inputs[1])
+        # Instantiate our routing matrix mixer, from the host and our oscillators to our ∆Σ DAC and
+        # the host, paced by the host's audio while it's streaming, and by its IN path while recording.
+        m.submodules.mixer = mixer = DomainRenamer({"sync": "usb"})(
+            dsp.Mixer(
+                bit_depth = self.bit_depth,
+                inputs    = 2 * self.channels,
+                outputs   = 2 * self.channels,
+                gains     = self.mixer_gains,
+            )
+        )
+        m.d.comb += [
+            mixer.inputs_active .eq(Cat((~idle_out).replicate(self.channels), (~idle_in).replicate(self.channels))),
+            mixer.outputs_paced .eq(Cat((~idle_out).replicate(self.channels), (~idle_in).replicate(self.channels))),
+        ]
+        mix_dac  = mixer.outputs[:self.channels]
+        mix_host = mixer.outputs[self.channels:]
+
+        # Filter the mix for our ∆Σ DAC through our biquad cascade, with its sections designed for each rate.
+        if self.dac_eq is not None:
+            m.submodules.eq = eq = DomainRenamer({"sync": "usb"})(ResetInserter(idle_out)(
+                dsp.BiquadCascade(
+                    bit_depth    = self.bit_depth,
+                    channels     = self.channels,
+                    sections     = len(self.dac_eq),
+                    coefficients = [[dsp.biquad_coefficients(kind, frequency, rate, q, gain)
+                                     for kind, frequency, q, gain in self.dac_eq]
+                                    for rate in self.sample_rates],
+                    rates        = len(self.sample_rates),
+                )
+            ))
+            m.d.comb += eq.rate.eq(uac2.rate)
+            for n in range(self.channels):
+                wiring.connect(m, mix_dac[n], eq.inputs[n])
+            mix_dac = eq.outputs
+
+        # Connect the UAC 2.0 device and our oscillator bank to the mixer, and the mixer to the UAC 2.0
+        # device through FIFOs, which are mixed into ahead of demand as the IN path takes whole packets
+        # of frames far faster than the mixer mixes them.
+        for n in range(self.channels):
+            wiring.connect(m, uac2.outputs[n], mixer.inputs[n])
+            wiring.connect(m, ncobank.outputs[n], mixer.inputs[self.channels + n])
+
+            fifo = DomainRenamer({"sync": "usb"})(ResetInserter(idle_in)(
+                SyncFIFOBuffered(width=self.bit_depth, depth=2 * uac2.frames_per_packet)
+            ))
+            m.submodules[f"in_fifo{n}"] = fifo
+            m.d.comb += [
+                fifo.w_data              .eq(mix_host[n].payload),
+                fifo.w_en                .eq(mix_host[n].valid),
+                mix_host[n].ready        .eq(fifo.w_rdy),
+                uac2.inputs[n].valid     .eq(fifo.r_rdy),
+                uac2.inputs[n].payload   .eq(fifo.r_data),
+                fifo.r_en                .eq(uac2.inputs[n].ready),
+            ]
 
         # Instantiate our VU meter.
-        m.submodules.vu = vu = DomainRenamer({"sync": "usb"})(
+        m.submodules.vu = vu = DomainRenamer({"sync": "usb"})(ResetInserter(idle_out)(
             dsp.VU(
                 sample_rate     = self.sample_rate,
                 bit_depth       = self.bit_depth,
-                clock_frequency = self.clock_frequencies["usb"]  * 1e6,
+                channels        = self.channels,
                 segments        = 6,
+                sample_rates    = self.sample_rates,
+                scale           = self.vu_scale,
             )
-        )
+        ))
+        m.d.comb += vu.rate.eq(uac2.rate)
 
-        # Connect the UAC device's outputs to our VU meter.
-        wiring.connect(m, uac2.outputs[0], vu.input)
+        # Meter every sample taken from the UAC device's outputs.
+        for n in range(self.channels):
+            m.d.comb += [
+                vu.inputs[n].valid   .eq(uac2.outputs[n].valid & uac2.outputs[n].ready),
+                vu.inputs[n].payload .eq(uac2.outputs[n].payload),
+            ]
 
         # Connect the VU meter's led output to Cynthion USER LEDs.
         leds: Signal(6) = Cat(platform.request("led", n).o for n in range(0, 6))
         m.d.comb += leds.eq(vu.leds)
 
         # Instantiate our ∆Σ DAC.
-        m.submodules.dac = dac = DomainRenamer({"sync": "usb"})(
+        m.submodules.dac = dac = DomainRenamer({"sync": "usb"})(ResetInserter(idle_out)(
             dsp.DAC(
-                sample_rate     = self.sample_rate,
-                bit_depth       = self.bit_depth,
-                channels        = self.channels,
-                clock_frequency = self.clock_frequencies["usb"]  * 1e6,
-                signed          = True,
+                sample_rate        = self.sample_rate,
+                bit_depth          = self.bit_depth,
+                channels           = self.channels,
+                clock_frequency    = self.clock_frequencies["usb"]  * 1e6,
+                signed             = True,
+                sample_rates       = self.sample_rates,
+                order              = self.dac_order,
+                interpolation_rate = self.dac_interp_rate,
+                external_clock     = self.adaptive_clock,
             )
-        )
+        ))
+        m.d.comb += dac.rate.eq(uac2.rate)
+
+        # Recover the host's sample clock for our ∆Σ DAC and VU meter.
+        if self.adaptive_clock:
+            m.submodules.recovery = recovery = DomainRenamer({"sync": "usb"})(ResetInserter(idle_out)(
+                dsp.ClockRecovery(
+                    sample_rate     = self.sample_rate,
+                    clock_frequency = self.clock_frequencies["usb"]  * 1e6,
+                    sample_rates    = self.sample_rates,
+                    multipliers     = [round(hz / rate) for hz, rate in zip(dac.strobe_hzs, self.sample_rates)],
+                )
+            ))
+            m.d.comb += [
+                recovery.sof  .eq(uac2.sof),
+                recovery.rate .eq(uac2.rate),
+                dac.stb       .eq(recovery.stb),
+            ]
+
+        # Connect our mixer's outputs to our ∆Σ DAC's inputs, through our jitter buffer
+        if self.jitter_depth is not None:
+            m.submodules.jitter = jitter = DomainRenamer({"sync": "usb"})(ResetInserter(idle_out)(
+                dsp.JitterBuffer(
+                    bit_depth = self.bit_depth,
+                    channels  = self.channels,
+                    depth     = self.jitter_depth,
+                    target    = self.jitter_target,
+                )
+            ))
+            for n in range(self.channels):
+                wiring.connect(m, mix_dac[n], jitter.inputs[n])
+                wiring.connect(m, jitter.outputs[n], dac.inputs[n])
+
+            # the prefill target, and a strobe to clear the fill's extremes, set from vendor registers
+            jitter_target = Signal.like(jitter.target, init=jitter.target.init)
+            jitter_clear  = Signal()
+            m.d.usb  += jitter_clear.eq(0)
+            m.d.comb += [
+                jitter.target .eq(jitter_target),
+                jitter.clear  .eq(jitter_clear),
+            ]
+        else:
+            for n in range(self.channels):
+                wiring.connect(m, mix_dac[n], dac.inputs[n])
 
-        # Connect our UAC 2.0 device's outputs to our ∆Σ DAC's inputs
-        wiring.connect(m, uac2.outputs[0], dac.inputs[0])
-        wiring.connect(m, uac2.outputs[1], dac.inputs[1])
+        # Report the rate at which the ∆Σ DAC consumes samples back to the host.
+        m.d.comb += uac2.sample_stb.eq(dac.latch)
 
         # Connect our ∆Σ DAC outputs to our USER PMOD pins.
         pmod1 = platform.request("user_pmod", 1)
         m.d.comb += [
             pmod1.oe.eq(1),
-            pmod1.o[0].eq(dac.outputs[0]),
-            pmod1.o[1].eq(dac.outputs[1]),
+            *[pmod1.o[n].eq(dac.outputs[n]) for n in range(self.channels)],
+        ]
+
+        # Expose each channel's levels as vendor registers, the mean square as its top 32 bits.
+        registers = []
+        for n in range(self.channels):
+            registers += [
+                # register,         writable
+                (vu.peaks[n],        False),   # 0x00 + 2n: channel n's peak
+                (vu.powers[n][-32:], False),   # 0x01 + 2n: channel n's mean square
+            ]
+
+        # ... our oscillators' settings after them, from 0x00 + 2c for c channels ...
+        registers += [
+            # register,         writable
+            (osc_index,          True),    # 0x00 + 2c: oscillator to write
+            (osc_rate,           True),    # 0x01 + 2c: rate to write its phase increment for, an index into sample_rates
+            (osc_phi_delta,      True),    # 0x02 + 2c: phase increment, frequency * 2**32 / rate
+            (osc_amplitude,      True),    # 0x03 + 2c: amplitude, a fraction of 2**amplitude_bits
+            (osc_route,          True),    # 0x04 + 2c: output channel
+            (osc_write,          True),    # 0x05 + 2c: write to set the oscillator's phase increment and settings
         ]
 
+        # ... and the jitter buffer's telemetry after those.
+        if self.jitter_depth is not None:
+            registers += [
+                # register,         writable
+                (jitter.fill,        False),   # 0x06 + 2c: frames held
+                (jitter.min_fill,    False),   # 0x07 + 2c: fewest frames held since cleared
+                (jitter.max_fill,    False),   # 0x08 + 2c: most frames held since cleared
+                (jitter.underruns,   False),   # 0x09 + 2c: underruns
+                (jitter.overruns,    False),   # 0x0a + 2c: overruns
+                (jitter_clear,       True),    # 0x0b + 2c: write to clear the fewest and most frames held
+                (jitter_target,      True),    # 0x0c + 2c: frames to prefill before starting
+            ]
+        self.elaborate_registers(m, uac2, registers)
+
+        # Expose the mixer's crosspoint gains as writable vendor registers from 0x100, see dsp.Mixer,
+        # and the biquad cascade's coefficients from 0x200, see dsp.BiquadCascade.
+        self.elaborate_register_window(m, uac2, 0x100, len(mixer.inputs) * len(mixer.outputs),
+            mixer.gain_addr, mixer.gain_r_data, mixer.gain_w_data, mixer.gain_w_en)
+        if self.dac_eq is not None:
+            self.elaborate_register_window(m, uac2, 0x200, len(eq.coefficients),
+                eq.coefficient_addr, eq.coefficient_r_data, eq.coefficient_w_data, eq.coefficient_w_en)
+
         # debug
         debug = platform.request("user_pmod", 0)
         m.d.comb += debug.oe.eq(1)
@@ -113,6 +336,77 @@ class Top(Elaboratable):
         return m
 
 
+    def elaborate_loopback(self, m, uac2, idle_out):
+        # Loop our UAC 2.0 device's outputs back to its inputs through a delay line.
+        m.submodules.loopback = loopback = DomainRenamer({"sync": "usb"})(ResetInserter(idle_out)(
+            dsp.Loopback(
+                bit_depth = self.bit_depth,
+                channels  = self.channels,
+                max_delay = self.loopback,
+            )
+        ))
+        for n in range(self.channels):
+            wiring.connect(m, uac2.outputs[n], loopback.inputs[n])
+            wiring.connect(m, loopback.outputs[n], uac2.inputs[n])
+
+        # Timestamp markers on the first channel as they leave the OUT path and come back on the IN path.
+        m.submodules.probe = probe = DomainRenamer({"sync": "usb"})(dsp.LatencyProbe(self.bit_depth))
+        out_stb = uac2.outputs[0].valid & uac2.outputs[0].ready
+        m.d.comb += [
+            probe.sof         .eq(uac2.sof),
+            probe.frame       .eq(uac2.frame),
+            probe.out_sample  .eq(uac2.outputs[0].payload),
+            probe.out_stb     .eq(out_stb),
+            probe.in_sample   .eq(uac2.inputs[0].payload),
+            probe.in_stb      .eq(uac2.inputs[0].valid & uac2.inputs[0].ready),
+        ]
+
+        # Frames are taken as fast as the host sends them, so report exactly that back to it.
+        m.d.comb += uac2.sample_stb.eq(out_stb)
+
+        # Expose the measurements, and the delay and marker threshold, as vendor registers.
+        delay     = Signal.like(loopback.delay)
+        threshold = Signal.like(probe.threshold, init=probe.threshold.init)
+        m.d.comb += [
+            loopback.delay   .eq(delay),
+            probe.threshold  .eq(threshold),
+        ]
+        clock_hz  = C(self.clock_frequencies["usb"] * 1_000_000, 32)
+        self.elaborate_registers(m, uac2, [
+            # register,        writable
+            (probe.out_time,    False),   # 0x00: Cat(cycle, microframe, frame) of the last marker out
+            (probe.in_time,     False),   # 0x01: Cat(cycle, microframe, frame) of the last marker back
+            (probe.latency,     False),   # 0x02: usb cycles from the last marker out to it coming back
+            (probe.round_trips, False),   # 0x03: markers back
+            (clock_hz,          False),   # 0x04: usb clock frequency, Hz
+            (delay,             True),    # 0x05: loopback delay, frames
+            (threshold,         True),    # 0x06: marker threshold
+        ])
+
+
+    def elaborate_registers(self, m, uac2, registers):
+        """ Map a list of (register, writable) onto our UAC 2.0 device's vendor registers, by index. """
+        with m.Switch(uac2.reg_addr):
+            for address, (register, writable) in enumerate(registers):
+                with m.Case(address):
+                    m.d.comb += uac2.reg_r_data.eq(register)
+                    if writable:
+                        with m.If(uac2.reg_w_en):
+                            m.d.usb += register.eq(uac2.reg_w_data)
+
+
+    def elaborate_register_window(self, m, uac2, base, length, addr, r_data, w_data, w_en):
+        """ Map ``length`` of our UAC 2.0 device's vendor registers from ``base`` onto a memory's ports. """
+        window = (uac2.reg_addr >= base) & (uac2.reg_addr < base + length)
+        m.d.comb += [
+            addr    .eq(uac2.reg_addr - base),
+            w_data  .eq(uac2.reg_w_data),
+            w_en    .eq(uac2.reg_w_en & window),
+        ]
+        with m.If(window):
+            m.d.comb += uac2.reg_r_data.eq(r_data)
+
+
 if __name__ == "__main__":
     logging.getLogger().setLevel(logging.DEBUG)
     top_level_cli(Top)
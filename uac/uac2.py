@@ -25,40 +25,125 @@ from luna.usb2                            import (
 )
 from luna.gateware.usb.usb2.request       import StallOnlyRequestHandler
 
-from .stream  import UAC2StreamToSamples, SamplesToUAC2Stream
-from .request import UAC2RequestHandler
+from .feedback  import FeedbackGenerator
+from .scheduler import PacketScheduler
+from .stream    import UAC2StreamToSamples, SamplesToUAC2Stream
+from .request   import UAC2RequestHandler, VendorRegisterRequestHandler
+from .volume    import Volume
 
 
 class USBAudioClass2Device(wiring.Component):
     """ USB Audio Class 2 Audio Interface Device """
 
-    def __init__(self, sample_rate, bit_depth, channels, bus):
-        self.sample_rate = sample_rate
-        self.bit_depth   = bit_depth
-        self.channels    = channels
-        self.bus         = bus
+    def __init__(self, sample_rate, bit_depth, channels, bus, feedback_interval=4, sample_rates=None,
+                 data_interval=1, registers=False):
+        self.sample_rate  = sample_rate
+        self.sample_rates = sorted(sample_rates or [sample_rate])
+        self.bit_depth    = bit_depth
+        self.channels     = channels
+        self.bus          = bus
+        self.registers    = registers
+
+        # EP 0x82 polling interval, 2^(n-1) microframes
+        if feedback_interval not in range(1, 5):
+            logging.error(f"Invalid feedback_interval '{feedback_interval}'. Supported values are 1, 2, 3, 4")
+            sys.exit(1)
+        self.feedback_interval = feedback_interval
+
+        # EP 0x01 and EP 0x83 polling interval, 2^(n-1) microframes
+        if data_interval not in range(1, 5):
+            logging.error(f"Invalid data_interval '{data_interval}'. Supported values are 1, 2, 3, 4")
+            sys.exit(1)
+        self.data_interval          = data_interval
+        self.microframes_per_packet = 2**(data_interval - 1)
 
+        # Subslot sizes offered to the host, one per active alternate setting. 24-bit
+        # audio can be sent padded to 4 bytes, or packed into 3 bytes to save bandwidth.
         if self.bit_depth == 24:
-            self.subslot_size = 4
+            subslot_sizes = [4, 3]
         elif bit_depth in [8, 16, 32]:
-            self.subslot_size = bit_depth / 8
+            subslot_sizes = [bit_depth // 8]
         else:
             logging.error(f"Invalid bit_depth '{bit_depth}'. Supported values are 8, 16, 24, 32")
             sys.exit(1)
 
-        microframes_per_second = 1000 / 0.125 # = 8000
-        samples_per_microframe = self.sample_rate / microframes_per_second
-        bytes_per_microframe   = samples_per_microframe * self.subslot_size * self.channels
-        logging.info(f"bytes_per_microframe: {bytes_per_microframe}")
+        if self.sample_rate not in self.sample_rates:
+            logging.error(f"Invalid sample_rate '{sample_rate}'. Supported values are {self.sample_rates}")
+            sys.exit(1)
 
-        self.bytes_per_microframe = int(bytes_per_microframe)
-        if self.bytes_per_microframe > 1024:
-            logging.error(f"Configuration requires > 1024 bytes per microframe: {self.bytes_per_microframe}")
+        microframes_per_second = 1000 / 0.125 # = 8000
+        for rate in self.sample_rates:
+            samples_per_packet = rate / microframes_per_second * self.microframes_per_packet
+            for subslot_size in subslot_sizes:
+                bytes_per_packet = samples_per_packet * subslot_size * self.channels
+                logging.info(f"bytes_per_packet @ {rate / 1000} kHz, {subslot_size} byte subslots: {bytes_per_packet}")
+
+        # Endpoints are sized for the most audio frames we'll send or receive in a
+        # packet at our highest sample rate, i.e. the whole part of the samples per
+        # service interval plus one for the fractional part and for the host's
+        # adjustments in response to feedback.
+        self.frames_per_packet = int(max(self.sample_rates) * self.microframes_per_packet // microframes_per_second) + 1
+
+        # Only offer the subslot sizes whose packets fit in a microframe, using up to
+        # three transactions per microframe (high-bandwidth isochronous) where needed.
+        self.subslot_sizes = []
+        self.packet_sizes  = []
+        for subslot_size in subslot_sizes:
+            bytes_per_packet = self.frames_per_packet * subslot_size * self.channels
+            packet_size = self._packet_size(subslot_size * self.channels)
+            if packet_size is None:
+                logging.warning(f"Omitting {subslot_size} byte subslots, requires > 3072 bytes per microframe: {bytes_per_packet}")
+                continue
+            logging.info(f"{subslot_size} byte subslots: {packet_size[0]} transaction(s) of {packet_size[1]} bytes per packet")
+            self.subslot_sizes.append(subslot_size)
+            self.packet_sizes.append(packet_size)
+        if not self.subslot_sizes:
+            logging.error(f"Configuration requires > 3072 bytes per microframe: {bytes_per_packet}")
             sys.exit(1)
 
+        self.bytes_per_frame       = [subslot_size * self.channels for subslot_size in self.subslot_sizes]
+        self.bytes_per_packet      = self.frames_per_packet * max(self.bytes_per_frame)
+
+        # EP 0x83 splits each packet into transactions of a fixed size, so if that takes
+        # more than one transaction every alternate setting advertises the largest size.
+        self.max_packet_size       = max(packet_size[1] for packet_size in self.packet_sizes)
+        self.in_packet_sizes       = self.packet_sizes
+        if self.packet_sizes[0][0] > 1: # subslot sizes are in decreasing order
+            self.in_packet_sizes   = [self.packet_sizes[0]] * len(self.packet_sizes)
+
         super().__init__({
-            "inputs"  : In  (stream.Signature(signed(self.bit_depth))).array(channels),
-            "outputs" : Out (stream.Signature(signed(self.bit_depth))).array(channels),
+            "inputs"         : In  (stream.Signature(signed(self.bit_depth))).array(channels),
+            "outputs"        : Out (stream.Signature(signed(self.bit_depth))).array(channels),
+
+            # strobed once per period of the clock consuming samples from `outputs`
+            "sample_stb"     : In  (1),
+
+            # strobed on each start-of-frame packet from the host
+            "sof"            : Out (1),
+
+            # index into sample_rates of the sample rate selected by the host
+            "rate"           : Out (range(len(self.sample_rates)), init=self.sample_rates.index(self.sample_rate)),
+
+            # alternate settings selected by the host for interfaces #1 and #2, 0 when idle
+            "alt_setting_out": Out (8),
+            "alt_setting_in" : Out (8),
+
+            # EP 0x01 OUT glitch counters, see UAC2StreamToSamples
+            "dropped"        : Out (16),
+            "framing_errors" : Out (16),
+            "short_packets"  : Out (16),
+
+            # USB frame and microframe number, as Cat(microframe, frame)
+            "frame"          : Out (14),
+
+            # with registers, a bank of registers the host can access with vendor requests,
+            # see VendorRegisterRequestHandler
+            **({
+                "reg_addr"   : Out (16),
+                "reg_r_data" : In  (32),
+                "reg_w_data" : Out (32),
+                "reg_w_en"   : Out (1),
+            } if registers else {}),
         })
 
 
@@ -79,15 +164,51 @@ class USBAudioClass2Device(wiring.Component):
         ep_control = usb.add_control_endpoint()
         ep_control.add_standard_request_handlers(descriptors, skiplist=[
             # We have multiple interfaces so we will need to handle
-            # SET_INTERFACE ourselves.
+            # SET_INTERFACE and GET_INTERFACE ourselves.
             lambda setup: (setup.type == USBRequestType.STANDARD) &
-                          (setup.request == USBStandardRequests.SET_INTERFACE)
+                          ((setup.request == USBStandardRequests.SET_INTERFACE) |
+                           (setup.request == USBStandardRequests.GET_INTERFACE))
         ])
 
+        # Our feature unit's volume and mute, applied to the audio from the host.
+        volume = Volume(self.bit_depth, self.channels)
+
         # Attach our class request handlers.
-        ep_control.add_request_handler(UAC2RequestHandler(sample_rate=self.sample_rate))
+        request_handler = UAC2RequestHandler(
+            sample_rate  = self.sample_rate,
+            sample_rates = self.sample_rates,
+            interfaces   = (1, 1 + len(self.subslot_sizes), 1 + len(self.subslot_sizes)),
+            feature_unit = 6,
+            channels     = self.channels,
+            volume_range = (-(len(volume.gains) - 1) * round(volume.step * 256), 0, round(volume.step * 256)),
+        )
+        ep_control.add_request_handler(request_handler)
+        m.d.comb += [
+            self.rate             .eq(request_handler.rate),
+            self.alt_setting_out  .eq(request_handler.alt_settings[1]),
+            self.alt_setting_in   .eq(request_handler.alt_settings[2]),
+        ]
 
-        # Attach class-request handlers that stall any vendor or reserved requests,
+        # Our streaming interfaces are idle in alt 0, and otherwise each active
+        # alternate setting selects a subslot size.
+        idle_out = (self.alt_setting_out == 0)
+        idle_in  = (self.alt_setting_in  == 0)
+
+        def subslot_format(alt_setting):
+            return Mux(alt_setting == 0, 0, alt_setting - 1)
+
+        # Attach a vendor-request handler for our registers, if we have any.
+        if self.registers:
+            register_handler = VendorRegisterRequestHandler()
+            ep_control.add_request_handler(register_handler)
+            m.d.comb += [
+                self.reg_addr            .eq(register_handler.addr),
+                register_handler.r_data  .eq(self.reg_r_data),
+                self.reg_w_data          .eq(register_handler.w_data),
+                self.reg_w_en            .eq(register_handler.w_en),
+            ]
+
+        # Attach class-request handlers that stall any other vendor or reserved requests,
         # as we don't have or need any.
         stall_condition = lambda setup : \
             (setup.type == USBRequestType.VENDOR) | \
@@ -97,21 +218,39 @@ class USBAudioClass2Device(wiring.Component):
 
         # - EP 0x01 OUT - audio from the host to the device --
 
-        ep1_out = USBIsochronousStreamOutEndpoint(
+        # Hold the OUT path in reset while idle, so that it starts afresh with
+        # empty FIFOs when the host next starts streaming.
+        ep1_out = ResetInserter({"usb": idle_out})(USBIsochronousStreamOutEndpoint(
             endpoint_number=1,
-            max_packet_size=self.bytes_per_microframe + 1,
-        )
+            max_packet_size=self.max_packet_size,
+            buffer_size=(max(transactions for transactions, _ in self.packet_sizes) + 1) * self.max_packet_size,
+        ))
         usb.add_endpoint(ep1_out)
 
         # Serialise UAC 2.0 stream to samples
-        m.submodules.uac2_out = uac2_out = UAC2StreamToSamples(
+        m.submodules.uac2_out = uac2_out = ResetInserter({"usb": idle_out})(UAC2StreamToSamples(
             self.bit_depth,
             self.channels,
-            self.subslot_size,
-        )
+            self.subslot_sizes,
+        ))
+        m.d.comb += uac2_out.format.eq(subslot_format(self.alt_setting_out))
         wiring.connect(m, uac2_out.input, ep1_out.stream)
+
+        # Apply the host's volume and mute, ramping gains from silence when streaming starts.
+        m.submodules.volume = volume = ResetInserter({"usb": idle_out})(DomainRenamer({"sync": "usb"})(volume))
+        m.d.comb += [
+            volume.mutes  .eq(request_handler.mutes),
+            *[control.eq(value) for control, value in zip(volume.volumes, request_handler.volumes)],
+        ]
         for n in range(self.channels):
-            wiring.connect(m, uac2_out.outputs[n], wiring.flipped(self.outputs[n]))
+            wiring.connect(m, uac2_out.outputs[n], volume.inputs[n])
+            wiring.connect(m, volume.outputs[n], wiring.flipped(self.outputs[n]))
+
+        m.d.comb += [
+            self.dropped         .eq(uac2_out.dropped),
+            self.framing_errors  .eq(uac2_out.framing_errors),
+            self.short_packets   .eq(uac2_out.short_packets),
+        ]
 
 
         # - EP 0x82 IN - feedback to the host from the device --
@@ -125,18 +264,25 @@ class USBAudioClass2Device(wiring.Component):
         # Feedback value is 32 bits wide = 4 bytes
         m.d.comb += ep2_in.bytes_in_frame.eq(4),
 
-        # Calculate samples per microframe for our audio sample rate.
-        microframes_per_second = 1000 // 0.125 # 8000
-        samples_per_microframe = self.sample_rate / microframes_per_second
+        # Measure the rate at which our sample clock consumes samples.
+        m.submodules.feedback = feedback = ResetInserter({"usb": idle_out})(
+            FeedbackGenerator(self.sample_rate, sample_rates=self.sample_rates)
+        )
+        m.d.comb += [
+            feedback.sof     .eq(usb.sof_detected),
+            feedback.sample  .eq(self.sample_stb),
+            feedback.rate    .eq(self.rate),
+            self.sof         .eq(usb.sof_detected),
+            self.frame       .eq(Cat(usb.microframe_number, usb.frame_number)),
+        ]
 
-        logging.info(f"samples_per_microframe: {samples_per_microframe}")
-        logging.info(f"feedback_value: {hex(round(samples_per_microframe * (2**16)))}")
+        logging.info(f"feedback_value: {hex(feedback.nominal)}")
 
         feedbackValue = Signal(32)  # 4-byte feedback value to transmit
         offset        = Signal(5)   # offset of the byte currently being transmitted
 
-        # Represent feedback value as a Q12.16 Fixed Point value.
-        m.d.comb += feedbackValue.eq(int(samples_per_microframe * (2 << 16)))
+        # Represent feedback value as a Q16.16 Fixed Point value.
+        m.d.comb += feedbackValue.eq(feedback.value)
 
         # Transmit the feedback value.
         m.d.comb += [
@@ -149,19 +295,32 @@ class USBAudioClass2Device(wiring.Component):
 
         ep3_in = USBIsochronousStreamInEndpoint(
             endpoint_number=3,
-            max_packet_size=self.bytes_per_microframe + 1,
+            max_packet_size=max(packet_size[1] for packet_size in self.in_packet_sizes),
         )
         usb.add_endpoint(ep3_in)
 
-        # fs / 8000 * subslot_size * channels
-        m.d.comb += ep3_in.bytes_in_frame.eq(self.bytes_per_microframe),
+        # Schedule fs / 8000 audio frames per microframe, including the fractional part,
+        # aggregated over each service interval.
+        m.submodules.scheduler = scheduler = ResetInserter({"usb": idle_in})(
+            PacketScheduler(self.sample_rate, sample_rates=self.sample_rates, interval=self.microframes_per_packet)
+        )
+        m.d.comb += [
+            scheduler.sof  .eq(usb.sof_detected),
+            scheduler.rate .eq(self.rate),
+        ]
 
-        # Serialise samples to UAC 2.0 stream
-        m.submodules.uac2_in = uac2_in = SamplesToUAC2Stream(
+        # Serialise samples to UAC 2.0 stream, held in reset while idle so that
+        # streams always start at the first channel of a frame.
+        m.submodules.uac2_in = uac2_in = ResetInserter({"usb": idle_in})(SamplesToUAC2Stream(
             self.bit_depth,
             self.channels,
-            self.subslot_size,
-        )
+            self.subslot_sizes,
+        ))
+        m.d.comb += uac2_in.format.eq(subslot_format(self.alt_setting_in))
+
+        # frames * subslot_size * channels
+        bytes_per_frame = Array(Const(n, range(max(self.bytes_per_frame) + 1)) for n in self.bytes_per_frame)
+        m.d.comb += ep3_in.bytes_in_frame.eq(scheduler.frames * bytes_per_frame[uac2_in.format]),
         for n in range(self.channels):
             wiring.connect(m, uac2_in.inputs[n], wiring.flipped(self.inputs[n]))
         wiring.connect(m, uac2_in.output, wiring.flipped(ep3_in.stream))
@@ -210,10 +369,16 @@ class USBAudioClass2Device(wiring.Component):
             interface = uac2.ClassSpecificAudioControlInterfaceDescriptorEmitter()
 
             # 1: CS clock source
+            if len(self.sample_rates) > 1:
+                clock_attributes = uac2.ClockAttributes.INTERNAL_PROGRAMMABLE_CLOCK
+                clock_controls   = uac2.ClockFrequencyControl.HOST_PROGRAMMABLE
+            else:
+                clock_attributes = uac2.ClockAttributes.INTERNAL_FIXED_CLOCK
+                clock_controls   = uac2.ClockFrequencyControl.HOST_READ_ONLY
             interface.add_subordinate_descriptor(uac2.ClockSourceDescriptor.build({
                 "bClockID"     : 1,
-                "bmAttributes" : uac2.ClockAttributes.INTERNAL_FIXED_CLOCK,
-                "bmControls"   : uac2.ClockFrequencyControl.HOST_READ_ONLY,
+                "bmAttributes" : clock_attributes,
+                "bmControls"   : clock_controls,
             }))
 
             # 2: IT streaming input terminal from the host to the USB device
@@ -224,11 +389,18 @@ class USBAudioClass2Device(wiring.Component):
                 "bCSourceID"    : 1,
             }))
 
+            # 6: FU volume and mute of the audio from the host, for the master channel and each channel
+            interface.add_subordinate_descriptor(uac2.FeatureUnitDescriptor.build({
+                "bUnitID"       : 6,
+                "bSourceID"     : 2,
+                "bmaControls"   : [0b1111] * (self.channels + 1), # mute and volume, host programmable
+            }))
+
             # 3: OT audio output terminal to the USB device's speaker output
             interface.add_subordinate_descriptor(uac2.OutputTerminalDescriptor.build({
                 "bTerminalID"   : 3,
                 "wTerminalType" : uac2.OutputTerminalTypes.SPEAKER,
-                "bSourceID"     : 2,
+                "bSourceID"     : 6,
                 "bCSourceID"    : 1,
             }))
 
@@ -260,55 +432,32 @@ class USBAudioClass2Device(wiring.Component):
                 })
             )
 
-            # Audio Streaming Interface Descriptor (Audio Streaming OUT, alt 1 - active setting)
-            configuration.add_subordinate_descriptor(
-                uac2.AudioStreamingInterfaceDescriptor.build({
-                    "bInterfaceNumber"  : 1,
-                    "bAlternateSetting" : 1,
-                    "bNumEndpoints"     : 2,
-                })
-            )
-
-            # Class Specific Audio Streaming Interface Descriptor
-            configuration.add_subordinate_descriptor(
-                uac2.ClassSpecificAudioStreamingInterfaceDescriptor.build({
-                    "bTerminalLink" : 2,
-                    "bFormatType"   : uac2.FormatTypes.FORMAT_TYPE_I,
-                    "bmFormats"     : uac2.TypeIFormats.PCM,
-                    "bNrChannels"   : self.channels,
-                })
-            )
-
-            # Type I Format Type Descriptor
-            configuration.add_subordinate_descriptor(uac2.TypeIFormatTypeDescriptor.build({
-                "bSubslotSize"   : self.subslot_size,
-                "bBitResolution" : self.bit_depth,
-            }))
-
-            # Endpoint Descriptor (Audio OUT from the host)
-            configuration.add_subordinate_descriptor(standard.EndpointDescriptor.build({
-                "bEndpointAddress" : USBDirection.OUT.to_endpoint_address(1), # EP 0x01 OUT
-                "bmAttributes"     : USBTransferType.ISOCHRONOUS \
-                                   | (USBSynchronizationType.ASYNC << 2) \
-                                   | (USBUsageType.DATA << 4),
-                "wMaxPacketSize"   : self.bytes_per_microframe + 1,
-                "bInterval"        : 1,
-            }))
-
-            # Isochronous Audio Data Endpoint Descriptor
-            configuration.add_subordinate_descriptor(
-                uac2.ClassSpecificAudioStreamingIsochronousAudioDataEndpointDescriptor.build({})
-            )
-
-            # Endpoint Descriptor (Feedback IN to the host)
-            configuration.add_subordinate_descriptor(standard.EndpointDescriptor.build({
-                "bEndpointAddress" : USBDirection.IN.to_endpoint_address(2),  # EP 0x82 IN
-                "bmAttributes"     : USBTransferType.ISOCHRONOUS \
-                                   | (USBSynchronizationType.NONE << 2)  \
-                                   | (USBUsageType.FEEDBACK << 4),
-                "wMaxPacketSize"   : 4,
-                "bInterval"        : 4, # 2^(n-1) = 8 * 125 us = 1 ms
-            }))
+            # Audio Streaming Interface Descriptors (Audio Streaming OUT, alt 1.. - active settings)
+            for alt_setting, subslot_size in enumerate(self.subslot_sizes, start=1):
+                self._add_streaming_alt_setting(configuration, 1, alt_setting, subslot_size, terminal_link=2, num_endpoints=2, endpoints=[
+                    # Endpoint Descriptor (Audio OUT from the host)
+                    standard.EndpointDescriptor.build({
+                        "bEndpointAddress" : USBDirection.OUT.to_endpoint_address(1), # EP 0x01 OUT
+                        "bmAttributes"     : USBTransferType.ISOCHRONOUS \
+                                           | (USBSynchronizationType.ASYNC << 2) \
+                                           | (USBUsageType.DATA << 4),
+                        "wMaxPacketSize"   : self._wMaxPacketSize(*self.packet_sizes[alt_setting - 1]),
+                        "bInterval"        : self.data_interval, # 2^(n-1) * 125 us
+                    }),
+
+                    # Isochronous Audio Data Endpoint Descriptor
+                    uac2.ClassSpecificAudioStreamingIsochronousAudioDataEndpointDescriptor.build({}),
+
+                    # Endpoint Descriptor (Feedback IN to the host)
+                    standard.EndpointDescriptor.build({
+                        "bEndpointAddress" : USBDirection.IN.to_endpoint_address(2),  # EP 0x82 IN
+                        "bmAttributes"     : USBTransferType.ISOCHRONOUS \
+                                           | (USBSynchronizationType.NONE << 2)  \
+                                           | (USBUsageType.FEEDBACK << 4),
+                        "wMaxPacketSize"   : 4,
+                        "bInterval"        : self.feedback_interval, # 2^(n-1) * 125 us
+                    }),
+                ])
 
 
             # - Interface #2: Audio input to the host from the USB device --
@@ -321,44 +470,73 @@ class USBAudioClass2Device(wiring.Component):
                 })
             )
 
-            # Audio Streaming Interface Descriptor (Audio Streaming IN, alt 1 - active setting)
-            configuration.add_subordinate_descriptor(
-                uac2.AudioStreamingInterfaceDescriptor.build({
-                    "bInterfaceNumber"  : 2,
-                    "bAlternateSetting" : 1,
-                    "bNumEndpoints"     : 1,
-                })
-            )
+            # Audio Streaming Interface Descriptors (Audio Streaming IN, alt 1.. - active settings)
+            for alt_setting, subslot_size in enumerate(self.subslot_sizes, start=1):
+                self._add_streaming_alt_setting(configuration, 2, alt_setting, subslot_size, terminal_link=5, num_endpoints=1, endpoints=[
+                    # Endpoint Descriptor (Audio IN to the host)
+                    standard.EndpointDescriptor.build({
+                        "bEndpointAddress" : USBDirection.IN.to_endpoint_address(3), # EP 0x83 IN
+                        "bmAttributes"     : USBTransferType.ISOCHRONOUS  \
+                                           | (USBSynchronizationType.ASYNC << 2) \
+                                           | (USBUsageType.DATA << 4),
+                        "wMaxPacketSize"   : self._wMaxPacketSize(*self.in_packet_sizes[alt_setting - 1]),
+                        "bInterval"        : self.data_interval, # 2^(n-1) * 125 us
+                    }),
+
+                    # Isochronous Audio Data Endpoint Descriptor
+                    uac2.ClassSpecificAudioStreamingIsochronousAudioDataEndpointDescriptor.build({}),
+                ])
 
-            # Class Specific Audio Streaming Interface Descriptor
-            configuration.add_subordinate_descriptor(
-                uac2.ClassSpecificAudioStreamingInterfaceDescriptor.build({
-                    "bTerminalLink" : 5,
-                    "bFormatType"   : uac2.FormatTypes.FORMAT_TYPE_I,
-                    "bmFormats"     : uac2.TypeIFormats.PCM,
-                    "bNrChannels"   : self.channels,
-                })
-            )
+        return descriptors
 
-            # Type I Format Type Descriptor
-            configuration.add_subordinate_descriptor(uac2.TypeIFormatTypeDescriptor.build({
-                "bSubslotSize"   : self.subslot_size,
-                "bBitResolution" : self.bit_depth,
-            }))
 
-            # Endpoint Descriptor (Audio IN to the host)
-            configuration.add_subordinate_descriptor(standard.EndpointDescriptor.build({
-                "bEndpointAddress" : USBDirection.IN.to_endpoint_address(3), # EP 0x83 IN
-                "bmAttributes"     : USBTransferType.ISOCHRONOUS  \
-                                   | (USBSynchronizationType.ASYNC << 2) \
-                                   | (USBUsageType.DATA << 4),
-                "wMaxPacketSize"   : self.bytes_per_microframe + 1,
-                "bInterval"        : 1,
-            }))
+    def _packet_size(self, bytes_per_frame):
+        """ Split a packet's audio frames over as few transactions as possible.
 
-            # Isochronous Audio Data Endpoint Descriptor
-            configuration.add_subordinate_descriptor(
-                uac2.ClassSpecificAudioStreamingIsochronousAudioDataEndpointDescriptor.build({})
-            )
+        Each transaction carries whole audio frames, so that every packet received on
+        EP 0x01 starts a new frame. Returns ``(transactions, max_packet_size)``, or
+        ``None`` if three transactions of up to 1024 bytes aren't enough.
+        """
+        for transactions in range(1, 4):
+            max_packet_size = -(-self.frames_per_packet // transactions) * bytes_per_frame
+            if max_packet_size <= 1024:
+                return transactions, max_packet_size
+        return None
 
-        return descriptors
+
+    @staticmethod
+    def _wMaxPacketSize(transactions, max_packet_size):
+        """ Encode an endpoint's wMaxPacketSize, with additional transactions per microframe in bits 12:11. """
+        return max_packet_size | ((transactions - 1) << 11)
+
+
+    def _add_streaming_alt_setting(self, configuration, interface_number, alt_setting, subslot_size, terminal_link, num_endpoints, endpoints):
+        """ Add an active alternate setting of an audio streaming interface. """
+
+        # Audio Streaming Interface Descriptor
+        configuration.add_subordinate_descriptor(
+            uac2.AudioStreamingInterfaceDescriptor.build({
+                "bInterfaceNumber"  : interface_number,
+                "bAlternateSetting" : alt_setting,
+                "bNumEndpoints"     : num_endpoints,
+            })
+        )
+
+        # Class Specific Audio Streaming Interface Descriptor
+        configuration.add_subordinate_descriptor(
+            uac2.ClassSpecificAudioStreamingInterfaceDescriptor.build({
+                "bTerminalLink" : terminal_link,
+                "bFormatType"   : uac2.FormatTypes.FORMAT_TYPE_I,
+                "bmFormats"     : uac2.TypeIFormats.PCM,
+                "bNrChannels"   : self.channels,
+            })
+        )
+
+        # Type I Format Type Descriptor
+        configuration.add_subordinate_descriptor(uac2.TypeIFormatTypeDescriptor.build({
+            "bSubslotSize"   : subslot_size,
+            "bBitResolution" : self.bit_depth,
+        }))
+
+        for endpoint in endpoints:
+            configuration.add_subordinate_descriptor(endpoint)
@@ -0,0 +1,229 @@
+import math
+import random
+import sys
+
+from amaranth             import *
+from amaranth.lib         import stream, wiring
+from amaranth.lib.wiring  import In, Out
+from amaranth.lib.memory  import Memory
+
+from amaranth.sim         import *
+
+
+class Volume(wiring.Component):
+    """ Volume and Mute, as for a UAC 2.0 Feature Unit
+
+    Scales the samples of each channel by a master and a per-channel ``volumes``, in
+    1/256 dB as for UAC 2.0 volume controls, and silences them if ``mutes`` are set,
+    the master control first. Volumes are rounded to ``step`` dB and limited to 0 dB,
+    and looked up in a table of ``attenuation_steps`` gains.
+
+    Samples are scaled one at a time through a single multiplier, two cycles each,
+    and each channel's gain approaches its setting by ``2**-ramp_shift`` of the
+    difference every sample, so that changes in volume, and mutes, fade in and out
+    rather than zipper, and snaps to it once within a step of it, so that 0 dB passes
+    samples through unchanged. Gains start at zero, fading in after reset.
+    """
+
+    def __init__(self, bit_depth, channels, step=0.5, attenuation_steps=256, gain_bits=18, ramp_shift=8):
+        self.bit_depth  = bit_depth
+        self.channels   = channels
+        self.step       = step
+        self.gain_bits  = gain_bits
+        self.ramp_shift = ramp_shift
+
+        # gains as fractions of 2**(gain_bits - 1), for each step of attenuation
+        unity = 1 << (gain_bits - 1)
+        self.gains = [round(unity * 10 ** (-n * step / 20)) for n in range(attenuation_steps)]
+
+        super().__init__({
+            "inputs"  : In  (stream.Signature(signed(bit_depth))).array(channels),
+            "outputs" : Out (stream.Signature(signed(bit_depth))).array(channels),
+            "volumes" : In  (signed(16)).array(channels + 1),
+            "mutes"   : In  (channels + 1),
+        })
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.table = table = Memory(shape=self.gain_bits, depth=len(self.gains), init=self.gains)
+        table_r = table.read_port()
+
+        # each channel's attenuation, in steps, and whether it's muted
+        step_units   = round(self.step * 256)
+        attenuations = []
+        for n in range(self.channels):
+            volume      = Signal(signed(17), name=f"volume_{n}")
+            attenuation = Signal(range(len(self.gains)), name=f"attenuation_{n}")
+            m.d.comb += volume.eq(self.volumes[0] + self.volumes[n + 1])
+            with m.If(volume >= 0):
+                m.d.comb += attenuation.eq(0)
+            with m.Elif(-volume >= (len(self.gains) - 1) * step_units):
+                m.d.comb += attenuation.eq(len(self.gains) - 1)
+            with m.Else():
+                m.d.comb += attenuation.eq((step_units // 2 - volume) // step_units)
+            attenuations.append(attenuation)
+        attenuations = Array(attenuations)
+        muted        = Array(self.mutes[0] | self.mutes[n + 1] for n in range(self.channels))
+
+        # each channel's gain, with extra bits to ramp it by
+        gains   = Array(Signal(self.gain_bits + self.ramp_shift, name=f"gain_{n}") for n in range(self.channels))
+
+        channel = Signal(range(self.channels))
+        sample  = Signal(signed(self.bit_depth))
+
+        for output in self.outputs:
+            with m.If(output.ready):
+                m.d.sync += output.valid.eq(0)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                # take a sample from the lowest channel with one, once its output is free
+                for n in reversed(range(self.channels)):
+                    input  = self.inputs[n]
+                    output = self.outputs[n]
+                    with m.If(input.valid & (~output.valid | output.ready)):
+                        m.d.comb += table_r.addr.eq(attenuations[n])
+                        m.d.comb += [self.inputs[k].ready.eq(k == n) for k in range(self.channels)]
+                        m.d.sync += [
+                            channel .eq(n),
+                            sample  .eq(input.payload),
+                        ]
+                        m.next = "SCALE"
+
+            with m.State("SCALE"):
+                gain   = gains[channel]
+                target = Mux(muted[channel], 0, table_r.data)
+
+                # scale the sample by the channel's gain ...
+                product = sample * gain[self.ramp_shift:]
+                for n, output in enumerate(self.outputs):
+                    with m.If(channel == n):
+                        m.d.sync += [
+                            output.valid   .eq(1),
+                            output.payload .eq(product >> (self.gain_bits - 1)),
+                        ]
+
+                # ... and ramp the gain towards its setting, snapping to it once it's less than a step away
+                difference = Signal(signed(len(gain) + 1))
+                m.d.comb += difference.eq((target << self.ramp_shift) - gain)
+                with m.If((difference > -(1 << self.ramp_shift)) & (difference < (1 << self.ramp_shift))):
+                    m.d.sync += gain.eq(target << self.ramp_shift)
+                with m.Else():
+                    m.d.sync += gain.eq(gain + (difference >> self.ramp_shift))
+
+                m.next = "IDLE"
+
+        return m
+
+
+# - model ---------------------------------------------------------------------
+
+def volume_model(volume, frames, volumes, mutes):
+    """ Bit-exact model of a :class:`Volume`, given each frame's samples, and the ``volumes`` and ``mutes``
+    in effect for it. """
+    step_units = round(volume.step * 256)
+    gains      = [0] * volume.channels
+
+    outputs = []
+    for frame, frame_volumes, frame_mutes in zip(frames, volumes, mutes):
+        scaled = []
+        for n, sample in enumerate(frame):
+            level = frame_volumes[0] + frame_volumes[n + 1]
+            if level >= 0:
+                attenuation = 0
+            elif -level >= (len(volume.gains) - 1) * step_units:
+                attenuation = len(volume.gains) - 1
+            else:
+                attenuation = (step_units // 2 - level) // step_units
+            target = 0 if frame_mutes & 1 or frame_mutes >> (n + 1) & 1 else volume.gains[attenuation]
+
+            scaled.append(sample * (gains[n] >> volume.ramp_shift) >> (volume.gain_bits - 1))
+            difference = (target << volume.ramp_shift) - gains[n]
+            if abs(difference) < 1 << volume.ramp_shift:
+                gains[n] = target << volume.ramp_shift
+            else:
+                gains[n] += difference >> volume.ramp_shift
+        outputs.append(scaled)
+
+    return outputs
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(dut, frames, volumes, mutes):
+    """ Collect each frame's scaled samples from a :class:`Volume` simulation. """
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+
+    outputs = []
+
+    async def testbench(ctx):
+        for frame, frame_volumes, frame_mutes in zip(frames, volumes, mutes):
+            for control, value in zip(dut.volumes, frame_volumes):
+                ctx.set(control, value)
+            ctx.set(dut.mutes, frame_mutes)
+
+            # present every channel's sample at once, and take them all back
+            for input, sample in zip(dut.inputs, frame):
+                ctx.set(input.valid,   1)
+                ctx.set(input.payload, sample)
+            for output in dut.outputs:
+                ctx.set(output.ready, 1)
+
+            scaled = {}
+            while len(scaled) < dut.channels:
+                for n, output in enumerate(dut.outputs):
+                    if ctx.get(output.valid):
+                        scaled[n] = ctx.get(output.payload)
+                taken = [ctx.get(input.ready) for input in dut.inputs]
+                await ctx.tick()
+                for input, ready in zip(dut.inputs, taken):
+                    if ready:
+                        ctx.set(input.valid, 0)
+            outputs.append([scaled[n] for n in range(dut.channels)])
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return outputs
+
+
+if __name__ == "__main__":
+    bit_depth = 24
+    channels  = 2
+
+    # a full scale square wave on both channels, the second turned down, then muted, then all turned down
+    length  = 4000
+    frames  = [[(1 << (bit_depth - 1)) - 1 if n % 32 < 16 else -(1 << (bit_depth - 1))] * channels for n in range(length)]
+    volumes = [[0, 0, -12 * 256]] * 1000 + [[0, 0, -12 * 256]] * 1000 + [[-20 * 256, 0, -12 * 256]] * 2000
+    mutes   = [0b000] * 1000 + [0b100] * 1000 + [0b000] * 2000
+
+    dut     = Volume(bit_depth, channels)
+    outputs = simulate(dut, frames, volumes, mutes)
+    if outputs != volume_model(dut, frames, volumes, mutes):
+        print("gateware doesn't match model")
+        sys.exit(1)
+    print(f"gateware matches model over {length} frames")
+
+    # settled levels, and the largest step between samples of the same sign, which ramps keep small
+    full_scale = 1 << (bit_depth - 1)
+    for start, name in [(0, "first channel at 0 dB, second at -12 dB"), (1000, "second channel muted"),
+                        (2000, "both turned down by 20 dB")]:
+        settled = outputs[start + 999]
+        levels  = [f"{20 * math.log10(abs(sample) / full_scale) if sample else -math.inf:6.1f} dBFS" for sample in settled]
+        steps   = [max(abs(outputs[n][k] - outputs[n - 32][k]) for n in range(start + 32, start + 1000))
+                   for k in range(channels)]
+        print(f"{name:40}: settled at {', '.join(levels)}, steps of at most "
+              f"{', '.join(f'{step / full_scale:.4f}' for step in steps)} of full scale per cycle")
+
+    # once faded in, 0 dB without mutes passes samples through unchanged
+    rng     = random.Random(0)
+    frames  = [[rng.randrange(-full_scale, full_scale) for _ in range(channels)] for _ in range(length)]
+    outputs = simulate(dut, frames, [[0] * (channels + 1)] * length, [0b000] * length)
+    settled = next((n for n in range(length) if outputs[n:] == frames[n:]), None)
+    if settled is None:
+        print("gateware doesn't pass samples through at 0 dB")
+        sys.exit(1)
+    print(f"{'0 dB':40}: passes samples through unchanged after fading in over {settled} samples")
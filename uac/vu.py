@@ -1,76 +1,302 @@
-import logging
+import math
+import sys
 
 from amaranth             import *
-from amaranth.lib         import fifo, stream, wiring
+from amaranth.lib         import stream, wiring
 from amaranth.lib.wiring  import In, Out
-from amaranth.utils       import log2_int, ceil_log2
 
-from .clockgen            import ClockGen
+from amaranth.sim         import *
 
 
 
 class VU(wiring.Component):
-    def __init__(self, sample_rate, bit_depth, clock_frequency, segments):
-        super().__init__({
-            "input"  : In  (stream.Signature(signed(bit_depth))),
-            "output" : Out (unsigned(bit_depth)),
-            "leds"   : Out (segments),
-        })
+    """ Peak and RMS Level Meter
+
+    Meters every sample on each of the ``inputs`` channels, which are always ready,
+    with two engines sharing a single multiplier:
+
+        * a peak meter, with instantaneous attack, holding each peak for ``peak_hold``
+          seconds before releasing exponentially, 20 dB every ``peak_release`` seconds.
+        * an RMS meter, averaging the squared samples with a time constant of ``rms_time``
+          seconds, as for a VU meter's 300 ms rise time.
+
+    Each channel's level is presented on ``peaks``, as an amplitude, and on ``powers``,
+    as a mean square. Time constants are rounded to a power of two samples.
+
+    ``leds`` show the loudest channel as a bar graph of its RMS level, with its peak as a
+    single segment above, and ``bar`` and ``dot`` the number of segments each lights, for
+    other displays. Each segment lights at a threshold from a table chosen by ``scale``:
+
+        * ``"log"``    -- the original logarithmic scale.
+        * ``"dbfs"``   -- evenly spaced in dB, from ``floor`` dBFS up to full scale.
+        * ``"linear"`` -- evenly spaced amplitudes, up to full scale.
+        * a sequence of thresholds in dBFS, one for each segment, in increasing order.
+    """
+
+    def __init__(self, sample_rate, bit_depth, channels, segments, sample_rates=None,
+                 peak_hold=1.0, peak_release=1.7, rms_time=0.065, scale="log", floor=-60):
+        self.sample_rates = sample_rates or [sample_rate]
 
         self.bit_depth = bit_depth
+        self.channels  = channels
         self.segments  = segments
 
-        self.sample_cycles = ClockGen.derive(
-            clock_name = "sample",
-            input_hz   = clock_frequency,
-            output_hz  = sample_rate,
-            logger     = logging,
-            max_deviation_ppm = 0,
-        )
+        # segment thresholds, as amplitudes
+        self.thresholds = segment_thresholds(bit_depth, segments, scale, floor)
 
-        self.clock = ClockGen(self.sample_cycles)
-        self.fifo  = fifo.SyncFIFOBuffered(width=bit_depth, depth=16)
+        # ballistics, in samples, for each sample rate
+        self.hold_samples   = [round(peak_hold * rate) for rate in self.sample_rates]
+        self.release_shifts = [round(math.log2(peak_release / math.log(10) * rate)) for rate in self.sample_rates]
+        self.rms_shifts     = [round(math.log2(rms_time * rate)) for rate in self.sample_rates]
 
+        # levels are held with enough fractional bits for the slowest ballistics
+        self.peak_frac_bits = max(self.release_shifts)
+        self.rms_frac_bits  = max(self.rms_shifts)
 
-    def logscale(self, x):
-        """ scale an input value logarithmically """
-        U = (2. ** (self.bit_depth - 1)) - 1.
-        y = (self.segments ** (x / self.segments)) / self.segments
-        l = int(y * U)
-        return l
+        super().__init__({
+            "inputs" : In  (stream.Signature(signed(bit_depth))).array(channels),
+            "peaks"  : Out (unsigned(bit_depth - 1)).array(channels),
+            "powers" : Out (unsigned(2 * (bit_depth - 1))).array(channels),
+            "leds"   : Out (segments),
+            "bar"    : Out (range(segments + 1)),
+            "dot"    : Out (range(segments + 1)),
+            "rate"   : In  (range(len(self.sample_rates)), init=self.sample_rates.index(sample_rate)),
+        })
 
 
     def elaborate(self, platform):
         m = Module()
 
-        m.submodules.clock = clock = self.clock
-        m.submodules.fifo  = fifo  = self.fifo
-
-        # connect input to fifo
-        wiring.connect(m, wiring.flipped(self.input), fifo.w_stream)
-
-        # always accept data from producer
-        m.d.comb += self.input.ready.eq(1)
-
-        # calculate vu raw output signal
-        with m.If(clock.stb_r):
-            m.d.comb += fifo.r_en.eq(fifo.r_rdy)
-            m.d.sync += self.output.eq(abs(fifo.r_data.as_signed()))
-
-            # led control
-            with m.If(self.output >= self.logscale(5)):
-                m.d.sync += self.leds.eq(0b111111)
-            with m.Elif(self.output >= self.logscale(4)):
-                m.d.sync += self.leds.eq(0b011111)
-            with m.Elif(self.output >= self.logscale(3)):
-                m.d.sync += self.leds.eq(0b001111)
-            with m.Elif(self.output >= self.logscale(2)):
-                m.d.sync += self.leds.eq(0b000111)
-            with m.Elif(self.output >= self.logscale(1)):
-                m.d.sync += self.leds.eq(0b000011)
-            with m.Elif(self.output > self.logscale(0)):
-                m.d.sync += self.leds.eq(0b000001)
-            with m.Else():
-                m.d.sync += self.leds.eq(0b000000)
+        magnitude_bits = self.bit_depth - 1
+        peak_bits      = magnitude_bits + self.peak_frac_bits
+        power_bits     = 2 * magnitude_bits + self.rms_frac_bits
+
+        hold_samples   = Array(Const(n, range(max(self.hold_samples) + 1)) for n in self.hold_samples)
+        release_shifts = Array(Const(n, range(self.peak_frac_bits + 1)) for n in self.release_shifts)
+        rms_shifts     = Array(Const(n, range(self.rms_frac_bits + 1)) for n in self.rms_shifts)
+
+
+        # - inputs --
+
+        # each channel's latest sample, until metered
+        samples = [Signal(signed(self.bit_depth), name=f"sample_{n}") for n in range(self.channels)]
+        pending = Signal(self.channels)
+
+        for n, input in enumerate(self.inputs):
+            m.d.comb += input.ready.eq(1)
+
+
+        # - engines --
+
+        peaks  = Array(Signal(peak_bits,  name=f"peak_{n}")  for n in range(self.channels))
+        holds  = Array(Signal(range(max(self.hold_samples) + 1), name=f"hold_{n}") for n in range(self.channels))
+        powers = Array(Signal(power_bits, name=f"power_{n}") for n in range(self.channels))
+
+        channel   = Signal(range(self.channels))
+        magnitude = Signal(magnitude_bits)
+        square    = Signal(2 * magnitude_bits)
+        taken     = Signal(self.channels)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                # take the lowest channel with a sample pending, and its magnitude, to within an lsb
+                for n in reversed(range(self.channels)):
+                    with m.If(pending[n]):
+                        m.d.comb += taken.eq(1 << n)
+                        m.d.sync += [
+                            channel   .eq(n),
+                            magnitude .eq(Mux(samples[n][-1], ~samples[n], samples[n])),
+                        ]
+                        m.next = "SQUARE"
+
+            with m.State("SQUARE"):
+                m.d.sync += square.eq(magnitude * magnitude)
+                m.next = "UPDATE"
+
+            with m.State("UPDATE"):
+                peak  = peaks[channel]
+                hold  = holds[channel]
+                power = powers[channel]
+
+                # peaks attack instantly, then hold, then release
+                with m.If((magnitude << self.peak_frac_bits) >= peak):
+                    m.d.sync += [
+                        peak .eq(magnitude << self.peak_frac_bits),
+                        hold .eq(hold_samples[self.rate]),
+                    ]
+                with m.Elif(hold != 0):
+                    m.d.sync += hold.eq(hold - 1)
+                with m.Else():
+                    m.d.sync += peak.eq(peak - (peak >> release_shifts[self.rate]))
+
+                # mean square follows the squared samples through a first-order lowpass
+                difference = Signal(signed(power_bits + 1))
+                m.d.comb += difference.eq((square << self.rms_frac_bits) - power)
+                m.d.sync += power.eq(power + (difference >> rms_shifts[self.rate]))
+
+                m.next = "IDLE"
+
+        # a new sample is pending until it's taken, replacing any that is still pending
+        for n, input in enumerate(self.inputs):
+            with m.If(input.valid):
+                m.d.sync += samples[n].eq(input.payload)
+        m.d.sync += pending.eq((pending & ~taken) | Cat(input.valid for input in self.inputs))
+
+        for n in range(self.channels):
+            m.d.comb += [
+                self.peaks[n]  .eq(peaks[n]  >> self.peak_frac_bits),
+                self.powers[n] .eq(powers[n] >> self.rms_frac_bits),
+            ]
+
+
+        # - leds --
+
+        # the loudest channel's levels
+        loudest_peak  = Signal(magnitude_bits)
+        loudest_power = Signal(2 * magnitude_bits)
+        m.d.sync += [
+            loudest_peak  .eq(_maximum(list(self.peaks))),
+            loudest_power .eq(_maximum(list(self.powers))),
+        ]
+
+        # every threshold each level is at or above, as a thermometer code
+        bar = Cat(loudest_power >= threshold ** 2 for threshold in self.thresholds)
+        dot = Cat(loudest_peak  >= threshold      for threshold in self.thresholds)
+
+        # a bar up to the rms level, and a segment at the peak level
+        m.d.sync += self.leds.eq(bar | (dot & ~(dot >> 1)))
+        m.d.sync += [
+            self.bar .eq(_segments(bar)),
+            self.dot .eq(_segments(dot)),
+        ]
 
         return m
+
+
+def segment_thresholds(bit_depth, segments, scale="log", floor=-60):
+    """ A table of meter segment thresholds, as amplitudes, see :class:`VU`. """
+    full_scale = (1 << (bit_depth - 1)) - 1
+    if scale == "log":
+        thresholds = [int((segments ** (n / segments)) / segments * full_scale) for n in range(segments)]
+    elif scale == "dbfs":
+        thresholds = [round(full_scale * 10 ** (floor * (segments - 1 - n) / (segments - 1) / 20))
+                      for n in range(segments)]
+    elif scale == "linear":
+        thresholds = [round(full_scale * (n + 1) / segments) for n in range(segments)]
+    elif isinstance(scale, str):
+        raise ValueError(f"scale must be 'log', 'dbfs', 'linear' or a sequence of thresholds, not '{scale}'")
+    else:
+        if len(scale) != segments or list(scale) != sorted(scale):
+            raise ValueError(f"custom scales need {segments} thresholds in increasing order, not {scale}")
+        thresholds = [round(full_scale * 10 ** (db / 20)) for db in scale]
+
+    # a threshold of zero would always be lit
+    return [min(max(threshold, 1), full_scale) for threshold in thresholds]
+
+
+def _segments(thermometer):
+    """ The number of segments lit by a thermometer code, encoded by a tree of its halves. """
+    if len(thermometer) == 1:
+        return thermometer
+    half  = len(thermometer) // 2
+    upper = _segments(thermometer[half:])
+    lower = _segments(thermometer[:half])
+    return Mux(thermometer[half], half + upper, lower)
+
+
+def _maximum(values):
+    """ The largest of ``values``, as a tree of comparisons. """
+    if len(values) == 1:
+        return values[0]
+    a = _maximum(values[:len(values) // 2])
+    b = _maximum(values[len(values) // 2:])
+    return Mux(a > b, a, b)
+
+
+# - model ---------------------------------------------------------------------
+
+def vu_model(vu, frames, rate=0):
+    """ Bit-exact model of a :class:`VU`, returning each channel's peak and mean square after each frame. """
+    hold_samples  = vu.hold_samples[rate]
+    release_shift = vu.release_shifts[rate]
+    rms_shift     = vu.rms_shifts[rate]
+
+    peaks  = [0] * vu.channels
+    holds  = [0] * vu.channels
+    powers = [0] * vu.channels
+
+    levels = []
+    for frame in frames:
+        for n, sample in enumerate(frame):
+            magnitude = ~sample if sample < 0 else sample
+
+            if magnitude << vu.peak_frac_bits >= peaks[n]:
+                peaks[n] = magnitude << vu.peak_frac_bits
+                holds[n] = hold_samples
+            elif holds[n]:
+                holds[n] -= 1
+            else:
+                peaks[n] -= peaks[n] >> release_shift
+
+            powers[n] += ((magnitude * magnitude << vu.rms_frac_bits) - powers[n]) >> rms_shift
+
+        levels.append([(peak >> vu.peak_frac_bits, power >> vu.rms_frac_bits) for peak, power in zip(peaks, powers)])
+
+    return levels
+
+
+# - simulation ----------------------------------------------------------------
+
+def simulate(dut, frames, sample_cycles=4):
+    """ Collect each channel's peak and mean square after each frame from a :class:`VU` simulation. """
+
+    sim = Simulator(dut)
+    sim.add_clock(1e-6)
+
+    levels = []
+
+    async def testbench(ctx):
+        for frame in frames:
+            for input, sample in zip(dut.inputs, frame):
+                ctx.set(input.valid,   1)
+                ctx.set(input.payload, sample)
+                await ctx.tick()
+                ctx.set(input.valid,   0)
+                await ctx.tick().repeat(sample_cycles - 1)
+            levels.append([(ctx.get(peak), ctx.get(power)) for peak, power in zip(dut.peaks, dut.powers)])
+
+    sim.add_testbench(testbench)
+    sim.run()
+
+    return levels
+
+
+if __name__ == "__main__":
+    bit_depth   = 24
+    channels    = 2
+    sample_rate = 8000
+    full_scale  = (1 << (bit_depth - 1)) - 1
+
+    def dbfs(level, power=False):
+        return 10 * math.log10(max(level, 1) / full_scale ** (2 if power else 1)) * (1 if power else 2)
+
+    # a -6 dBFS 1 kHz tone on the first channel for half a second, then silence, and silence on the second
+    tone   = [round(full_scale / 2 * math.sin(2 * math.pi * 1000 * n / sample_rate)) for n in range(sample_rate // 2)]
+    frames = [[sample, 0] for sample in tone + [0] * (5 * sample_rate // 2)]
+
+    dut    = VU(sample_rate, bit_depth, channels, segments=6)
+    levels = simulate(dut, frames)
+    if levels != vu_model(dut, frames):
+        print("gateware doesn't match model")
+        sys.exit(1)
+    print(f"gateware matches model over {len(frames)} frames")
+
+    # segment thresholds for each scale
+    for scale in ["log", "dbfs", "linear", [-40, -20, -12, -6, -3, 0]]:
+        thresholds = segment_thresholds(bit_depth, 6, scale)
+        print(f"{str(scale):30} scale thresholds: {' '.join(f'{dbfs(threshold):6.1f}' for threshold in thresholds)} dBFS")
+
+    # peak and rms ballistics, through the tone, the peak's hold, and its release
+    for seconds in [0.05, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0]:
+        peak, power = levels[round(seconds * sample_rate) - 1][0]
+        print(f"{seconds:4.2f} s: peak {dbfs(peak):6.1f} dBFS, rms {dbfs(power, power=True):6.1f} dBFS")